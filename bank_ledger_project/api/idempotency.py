@@ -0,0 +1,195 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from api.models import IdempotencyRecord
+
+
+class ResponseCache:
+    """In-process LRU of the responses given to broker transfers, entries expire after `ttl` seconds"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, transaction_id: str):
+        with self._lock:
+            entry = self._entries.get(transaction_id)
+            if entry is None:
+                return None
+            expires_at, response = entry
+            if expires_at < time.monotonic():
+                del self._entries[transaction_id]
+                return None
+            self._entries.move_to_end(transaction_id)
+            return response
+
+    def set(self, transaction_id: str, response: tuple):
+        with self._lock:
+            self._entries[transaction_id] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(transaction_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, transaction_id: str):
+        with self._lock:
+            self._entries.pop(transaction_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ResponseCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_CACHE_TTL)
+
+# One lock per transfer being handled in this process, with the number of threads holding or waiting on it
+_claims = {}
+_claims_lock = threading.Lock()
+
+
+def _key(transaction_id) -> str:
+    # Normalizes the different spellings of the same uuid
+    return str(uuid.UUID(str(transaction_id)))
+
+
+def fingerprint(origin, destination, amount) -> str:
+    """Hash of the money a transfer moves, stored with its response so a reused `transaction_id` is noticed
+
+    The ids and the amount are normalized first, `"20"` and `"20.00"` are the same transfer. The comment
+    is left out, a replay with another comment still moves the same money.
+    Throws `ValueError` or `decimal.InvalidOperation` for values that are not ids and amounts
+    """
+    fields = [_key(origin), _key(destination), f"{Decimal(str(amount)):.2f}"]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+def reused_response(transaction_id) -> tuple:
+    return ({
+        "error": "TransactionIdReusedError",
+        "detail": f"Transaction '{_key(transaction_id)}' was already used for a different transfer",
+    }, 422)
+
+
+def _answer(key: str, stored: tuple, request_fingerprint: str = None) -> tuple:
+    data, status_code, stored_fingerprint = stored
+    # Records stored before fingerprints were kept have none, and are not checked
+    if request_fingerprint and stored_fingerprint and request_fingerprint != stored_fingerprint:
+        return reused_response(key)
+    return data, status_code
+
+
+def lookup(transaction_id, request_fingerprint: str = None):
+    """Returns the stored `(data, status_code)` of an already handled transfer, or None
+
+    The in-process cache is asked first, then the `IdempotencyRecord` table. When the transfer stored under
+    `transaction_id` has another `fingerprint` than `request_fingerprint` a 422 `reused_response` is returned.
+    """
+    key = _key(transaction_id)
+    stored = cache.get(key)
+    if stored is None:
+        record = IdempotencyRecord.objects.filter(pk=key).first()
+        if record is None:
+            return None
+        stored = (json.loads(record.response), record.status_code, record.fingerprint)
+        cache.set(key, stored)
+    return _answer(key, stored, request_fingerprint)
+
+
+def remember(transaction_id, data, status_code: int, request_fingerprint: str = "", encoder=None):
+    """Stores the response given to a transfer, call it in the transaction that saved the transfer"""
+    key = _key(transaction_id)
+    encoded = json.dumps(data, cls=encoder)
+    IdempotencyRecord.objects.create(
+        transaction_id=key, status_code=status_code, response=encoded, fingerprint=request_fingerprint
+    )
+    # Decoded again so cached and stored responses look the same, and only cached once the transfer is saved
+    transaction.on_commit(lambda: cache.set(key, (json.loads(encoded), status_code, request_fingerprint)))
+
+
+def lookup_many(request_fingerprints: dict) -> dict:
+    """`lookup` for many transfers at once, `request_fingerprints` maps their ids to their `fingerprint`
+
+    Returns `{transaction_id: (data, status_code)}` of the handled ones. The ids missing from the in-process
+    cache are read from the `IdempotencyRecord` table in a single query.
+    """
+    stored = {}
+    missing = []
+    for transaction_id in request_fingerprints:
+        key = _key(transaction_id)
+        stored[key] = cache.get(key)
+        if stored[key] is None:
+            missing.append(key)
+
+    if missing:
+        for record in IdempotencyRecord.objects.filter(pk__in=missing):
+            key = _key(record.transaction_id)
+            stored[key] = (json.loads(record.response), record.status_code, record.fingerprint)
+            cache.set(key, stored[key])
+
+    responses = {}
+    for transaction_id, request_fingerprint in request_fingerprints.items():
+        key = _key(transaction_id)
+        if stored[key] is not None:
+            responses[key] = _answer(key, stored[key], request_fingerprint)
+    return responses
+
+
+def remember_many(responses: dict, encoder=None):
+    """`remember` for many transfers at once, `responses` maps their ids to `(data, status_code, fingerprint)`"""
+    encoded = {
+        _key(transaction_id): (json.dumps(data, cls=encoder), status_code, request_fingerprint)
+        for transaction_id, (data, status_code, request_fingerprint) in responses.items()
+    }
+    IdempotencyRecord.objects.bulk_create([
+        IdempotencyRecord(transaction_id=key, status_code=status_code, response=response, fingerprint=request_fingerprint)
+        for key, (response, status_code, request_fingerprint) in encoded.items()
+    ])
+
+    def fill_cache():
+        for key, (response, status_code, request_fingerprint) in encoded.items():
+            cache.set(key, (json.loads(response), status_code, request_fingerprint))
+
+    transaction.on_commit(fill_cache)
+
+
+def forget(transaction_id):
+    """Drops the stored response of a transfer, when it is deleted
+
+    Only the cache of this process is cleared, the other processes keep answering from their cache until the
+    entry expires after IDEMPOTENCY_CACHE_TTL seconds. That is harmless for the broker, which never commits
+    a compensated transfer again, and the reason the TTL is kept short.
+    """
+    key = _key(transaction_id)
+    IdempotencyRecord.objects.filter(pk=key).delete()
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@contextmanager
+def claim(transaction_id):
+    """Lets a single thread of this process handle a transfer at a time, duplicates wait for it to finish
+
+    Deliveries of the same transfer to other processes are serialized by the primary key of the ledger.
+    """
+    key = _key(transaction_id)
+    with _claims_lock:
+        lock, waiting = _claims.get(key, (threading.Lock(), 0))
+        _claims[key] = (lock, waiting + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _claims_lock:
+            lock, waiting = _claims[key]
+            if waiting == 1:
+                del _claims[key]
+            else:
+                _claims[key] = (lock, waiting - 1)
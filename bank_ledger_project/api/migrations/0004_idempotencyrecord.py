@@ -0,0 +1,22 @@
+# Generated by Django 4.1.13 on 2026-10-18 08:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_transaction_other_bank_ip_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyRecord',
+            fields=[
+                ('transaction_id', models.UUIDField(primary_key=True, serialize=False)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('response', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencyrecord',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
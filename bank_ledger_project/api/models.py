@@ -22,4 +22,16 @@ class TransferFunds(models.Model):
     created = models.DateTimeField(auto_now_add=True)
 
     def __str__(self) -> str:
-        return f'transaction_id: {self.transaction_id}, origin: {self.origin}, destination: {self.destination}, transfer_amount: {self.transfer_amount}, comment: {self.comment}, created: {self.created}'
\ No newline at end of file
+        return f'transaction_id: {self.transaction_id}, origin: {self.origin}, destination: {self.destination}, transfer_amount: {self.transfer_amount}, comment: {self.comment}, created: {self.created}'
+
+class IdempotencyRecord(models.Model):
+    """The response given to a transfer from the broker, returned again when the same transfer is delivered twice"""
+    transaction_id = models.UUIDField(null=False, primary_key=True)
+    status_code = models.PositiveSmallIntegerField(null=False)
+    response = models.TextField(null=False)
+    # `idempotency.fingerprint` of the transfer, empty for records stored before it was kept
+    fingerprint = models.CharField(max_length=64, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f'transaction_id: {self.transaction_id}, status_code: {self.status_code}, created: {self.created}'
@@ -1,7 +1,13 @@
+import json
+import uuid
+from unittest import mock
+from django.db import IntegrityError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from api import idempotency
 from api.views import create_transaction
-from .models import Transaction
+from .models import IdempotencyRecord, Transaction
 from django.core.exceptions import ValidationError
 from rest_framework.test import APITestCase
 from bank_ledger_app.models import Ledger
@@ -18,7 +24,18 @@ OTHER_ACCOUNT_ID = "1f4bc043-804c-4a77-b3dc-a9ac499f562b"
 # Create your tests here.
 class ApiTests(TestCase):
     def setUp(self):
-        ...
+        idempotency.cache.clear()
+
+    def post_transfer(self, transaction_id: str, amount: str = "20"):
+        # The broker sends the transfer as a JSON encoded string
+        transfer = {
+            "transaction_id": transaction_id,
+            "origin_id": OWN_ACCOUNT_ID,
+            "destination_id": OTHER_ACCOUNT_ID,
+            "amount": amount,
+            "comment": "From the broker",
+        }
+        return self.client.post("/api/transfer-funds/", json.dumps(json.dumps(transfer)), content_type="application/json")
 
     def test_create_transaction(self):
 
@@ -38,6 +55,184 @@ class ApiTests(TestCase):
             print('-\n', error)
             assert False
 
+    def test_delete_transaction(self):
+        """The broker undoes a transfer with a DELETE, which should also work for unknown transactions"""
+        Ledger.objects.create(
+            transaction_id=TRANS_ID,
+            origin=OWN_ACCOUNT_ID,
+            destination=OTHER_ACCOUNT_ID,
+            amount="20",
+            comment="From the broker",
+        )
+
+        response = self.client.delete(f"/api/transaction/{TRANS_ID}/")
+        assert response.status_code == 200
+        assert response.json() == {"ok": "Transaction has been deleted"}
+        assert not Ledger.objects.filter(pk=TRANS_ID).exists()
+
+        response = self.client.delete(f"/api/transaction/{TRANS_ID}/")
+        assert response.status_code == 200
+        assert response.json() == {"ok": "Transaction does not exist"}
+
+    def test_transfer_funds_replay(self):
+        """A transfer delivered again should get the original response without touching the ledger"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post_transfer(TRANS_ID)
+        assert response.status_code == 200
+        assert Ledger.objects.filter(pk=TRANS_ID).count() == 1
+        assert IdempotencyRecord.objects.filter(pk=TRANS_ID).exists()
+
+        # Answered from the in-process cache
+        with self.assertNumQueries(0):
+            replay = self.post_transfer(TRANS_ID)
+        assert replay.status_code == 200
+        assert replay.json() == response.json()
+
+        # Answered from the stored record, the ledger is not read
+        idempotency.cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            replay = self.post_transfer(TRANS_ID)
+        assert replay.json() == response.json()
+        assert not [query for query in queries if "bank_ledger_app_ledger" in query["sql"]]
+        assert Ledger.objects.count() == 1
+
+    def test_transfer_funds_replay_after_delete(self):
+        """Undoing a transfer should drop its stored response, so delivering it again saves it again"""
+        self.post_transfer(TRANS_ID)
+        self.client.delete(f"/api/transaction/{TRANS_ID}/")
+        assert not IdempotencyRecord.objects.filter(pk=TRANS_ID).exists()
+        assert not Ledger.objects.filter(pk=TRANS_ID).exists()
+
+        response = self.post_transfer(TRANS_ID)
+        assert response.status_code == 200
+        assert Ledger.objects.filter(pk=TRANS_ID).exists()
+
+    def test_transfer_funds_already_in_ledger(self):
+        """A transfer saved before responses were stored should still be answered as a replay"""
+        Ledger.objects.create(transaction_id=TRANS_ID, origin=OWN_ACCOUNT_ID, destination=OTHER_ACCOUNT_ID, amount="20")
+
+        response = self.post_transfer(TRANS_ID)
+        assert response.status_code == 200
+        assert response.json()["ok"]["transaction_id"] == TRANS_ID
+        assert IdempotencyRecord.objects.filter(pk=TRANS_ID).exists()
+        assert Ledger.objects.count() == 1
+
+    def test_transfer_funds_reused_id(self):
+        """A transaction id used again for a different transfer should be refused, not answered as a replay"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post_transfer(TRANS_ID, amount="20")
+        assert response.status_code == 200
+
+        # The same amount written differently is a replay
+        assert self.post_transfer(TRANS_ID, amount="20.00").json() == response.json()
+        for clear_cache in (False, True):
+            if clear_cache:
+                idempotency.cache.clear()
+            reused = self.post_transfer(TRANS_ID, amount="30")
+            assert reused.status_code == 422
+            assert reused.json()["error"] == "TransactionIdReusedError"
+        assert Ledger.objects.get(pk=TRANS_ID).amount == 20
+
+    def test_transfer_funds_reused_id_in_ledger(self):
+        """A transfer saved before responses were stored is compared with the ledger entry"""
+        Ledger.objects.create(transaction_id=TRANS_ID, origin=OWN_ACCOUNT_ID, destination=OTHER_ACCOUNT_ID, amount="20")
+
+        assert self.post_transfer(TRANS_ID, amount="30").status_code == 422
+        assert not IdempotencyRecord.objects.filter(pk=TRANS_ID).exists()
+        assert self.post_transfer(TRANS_ID, amount="20").status_code == 200
+
+    def test_transfer_funds_batch_reused_id(self):
+        """Items of a batch reusing an id for a different transfer are refused on their own"""
+        stored_id, ledger_id = str(uuid.uuid4()), str(uuid.uuid4())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_transfer(stored_id, amount="20")
+        Ledger.objects.create(transaction_id=ledger_id, origin=OWN_ACCOUNT_ID, destination=OTHER_ACCOUNT_ID, amount="20")
+        new_id = str(uuid.uuid4())
+        batch = [
+            {"transaction_id": transaction_id, "origin_id": OWN_ACCOUNT_ID, "destination_id": OTHER_ACCOUNT_ID, "amount": "30", "comment": "Batch"}
+            for transaction_id in (stored_id, ledger_id, new_id)
+        ]
+
+        response = self.client.post("/api/transfer-funds/batch/", json.dumps(batch), content_type="application/json")
+        assert response.status_code == 200
+        results = response.json()["ok"]
+        assert [result.get("error") for result in results] == ["TransactionIdReusedError", "TransactionIdReusedError", None]
+        assert results[2]["ok"] == "Transaction saved"
+        assert not IdempotencyRecord.objects.filter(pk=ledger_id).exists()
+        assert Ledger.objects.filter(pk__in=[stored_id, ledger_id], amount=20).count() == 2
+
+    def test_transfer_funds_batch(self):
+        """A batch should save the new transfers in one go and report every item on its own"""
+        Ledger.objects.create(
+            transaction_id=TRANS_ID,
+            origin=OWN_ACCOUNT_ID,
+            destination=OTHER_ACCOUNT_ID,
+            amount="20",
+        )
+        new_ids = [str(uuid.uuid4()) for _ in range(3)]
+        batch = [
+            {"transaction_id": new_id, "origin_id": OWN_ACCOUNT_ID, "destination_id": OTHER_ACCOUNT_ID, "amount": "10", "comment": "Batch"}
+            for new_id in new_ids
+        ]
+        batch.append({"transaction_id": TRANS_ID, "origin_id": OWN_ACCOUNT_ID, "destination_id": OTHER_ACCOUNT_ID, "amount": "20", "comment": "Replayed"})
+        batch.append(dict(batch[0]))
+        batch.append({"transaction_id": str(uuid.uuid4()), "origin_id": "not-a-uuid", "destination_id": OTHER_ACCOUNT_ID, "amount": "10", "comment": "Invalid origin"})
+        batch.append({"transaction_id": str(uuid.uuid4()), "origin_id": OWN_ACCOUNT_ID, "destination_id": OTHER_ACCOUNT_ID, "amount": "-5", "comment": "Negative amount"})
+
+        # One lookup for the existing ids, no matter how many transfers are sent
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/transfer-funds/batch/", json.dumps(batch), content_type="application/json")
+        lookups = [query for query in queries if query["sql"].startswith("SELECT") and "bank_ledger_app_ledger" in query["sql"]]
+
+        assert response.status_code == 200
+        assert len(lookups) == 1
+        results = response.json()["ok"]
+        assert [result.get("ok") for result in results[:5]] == [
+            "Transaction saved",
+            "Transaction saved",
+            "Transaction saved",
+            "Transaction already exists",
+            "Duplicate in batch",
+        ]
+        assert results[5]["error"] == "ValidationError"
+        assert results[6]["error"] == "ValidationError"
+        assert Ledger.objects.filter(pk__in=new_ids).count() == 3
+        assert Ledger.objects.count() == 4
+
+        # Stored for the saved transfers and the one found in the ledger
+        assert IdempotencyRecord.objects.filter(pk__in=new_ids + [TRANS_ID]).count() == 4
+
+        # The same batch sent again as NDJSON only finds duplicates, in the idempotency store
+        idempotency.cache.clear()
+        ndjson = "\n".join(json.dumps(item) for item in batch[:4])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/transfer-funds/batch/", ndjson, content_type="application/x-ndjson")
+        assert response.status_code == 200
+        assert {result["ok"] for result in response.json()["ok"]} == {"Transaction already exists"}
+        assert not [query for query in queries if "bank_ledger_app_ledger" in query["sql"]]
+        assert Ledger.objects.count() == 4
+
+        # A transfer of a batch delivered again on its own is a replay as well
+        response = self.post_transfer(new_ids[0], amount="10")
+        assert response.status_code == 200
+        assert response.json()["ok"]["transaction_id"] == new_ids[0]
+        assert Ledger.objects.count() == 4
+
+    def test_transfer_funds_batch_failed(self):
+        """The transfers of a batch and their stored responses should be saved together or not at all"""
+        new_id = str(uuid.uuid4())
+        batch = [{"transaction_id": new_id, "origin_id": OWN_ACCOUNT_ID, "destination_id": OTHER_ACCOUNT_ID, "amount": "10", "comment": "Batch"}]
+
+        with mock.patch.object(idempotency, "remember_many", side_effect=IntegrityError("UNIQUE constraint failed")):
+            response = self.client.post("/api/transfer-funds/batch/", json.dumps(batch), content_type="application/json")
+        assert response.status_code == 409
+        assert not Ledger.objects.filter(pk=new_id).exists()
+        assert not IdempotencyRecord.objects.filter(pk=new_id).exists()
+
+        response = self.client.post("/api/transfer-funds/batch/", json.dumps(batch), content_type="application/json")
+        assert response.json()["ok"][0]["ok"] == "Transaction saved"
+        assert IdempotencyRecord.objects.filter(pk=new_id).exists()
+
 
 # class ApiTestsOptimized(APITestCase):
 #     def setUp(self):
@@ -4,5 +4,7 @@ from . import views
 urlpatterns = [
     path("balance/<str:pk>/", views.get_account_balance_by_id),
     path("transfer-funds/", views.transfer_funds),
+    path("transfer-funds/batch/", views.transfer_funds_batch),
     path("transaction/<str:pk>/", views.delete_transaction),
+    path("broker-transfers/", views.broker_transfers),
 ]
@@ -1,15 +1,20 @@
 # Create your views here.
 from decimal import Decimal
 import decimal
+import hmac
 import json
 import uuid
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
+from api import idempotency
 from api.models import Transaction, TransferFunds
 import requests
 from requests.exceptions import InvalidSchema
 from django.core.exceptions import ValidationError
+from bank_ledger_app import reconcile
 from bank_ledger_app.models import Account, Ledger
 from bank_ledger_project.settings import OWN_BANK_IP, OTHER_BANK_IP
 from django.db.models import Model
@@ -88,8 +93,9 @@ def create_transaction(
         print("UnknownException in create_transaction: ", err)
         return Response({"error": "InternalServerError", "detail": "Something unexpected  went wrong"}, status=500)
 
-    if r.status_code == 200:
-        return Response({"ok": data}, status=200)
+    # 202: the broker has accepted the transaction and commits it on both banks in the background
+    if r.status_code in (200, 202):
+        return Response({"ok": data}, status=r.status_code)
     else:
         return Response({"error": r.status_code, "detail": data}, status=r.status_code)
 
@@ -124,6 +130,20 @@ def transfer_funds(request):
 
     print("Dict of request data: ", json_request)
 
+    # A transfer delivered again (the broker retries) gets its original response back,
+    # without being validated again or touching the ledger
+    try:
+        request_fingerprint = idempotency.fingerprint(
+            json_request.get("origin_id"), json_request.get("destination_id"), json_request.get("amount")
+        )
+        stored_response = idempotency.lookup(json_request.get("transaction_id"), request_fingerprint)
+    except (ValueError, TypeError, ValidationError, decimal.InvalidOperation):
+        # Not a valid transfer, reported by the validation below
+        stored_response = None
+    if stored_response is not None:
+        data, status_code = stored_response
+        return Response(data, status=status_code)
+
     transfer_object = TransferFunds(
         transaction_id=json_request.get("transaction_id"),
         origin=json_request.get("origin_id"),
@@ -134,7 +154,7 @@ def transfer_funds(request):
     )
     try:
         print("Validating transfer object...")
-        transfer_object.full_clean()
+        transfer_object.full_clean(validate_unique=False)
     except ValidationError as error:
         print("ValidationError: ", error)
         return Response({"error": "ValidationError", "detail": error}, status=400)
@@ -145,32 +165,57 @@ def transfer_funds(request):
         print("UnknownError: ", error)
         return Response({"error": "UnexpectedError", "detail": err}, status=500)
 
-    # CHECK IF TRANSFER ID EXISTS IN LEDGER
-    try:
-        transaction_by_id = Ledger.objects.get(pk=transfer_object.transaction_id)
-    except Exception as error:
-        print(f"[INFO]   Ledger entry with id: {transfer_object.transaction_id} was not found. Detail : ", error)
-        transaction_by_id = None
+    request_fingerprint = idempotency.fingerprint(transfer_object.origin, transfer_object.destination, transfer_object.transfer_amount)
+    # Duplicates arriving at the same time wait here, and find the response of the first one once it is done
+    with idempotency.claim(transfer_object.transaction_id):
+        stored_response = idempotency.lookup(transfer_object.transaction_id, request_fingerprint)
+        if stored_response is not None:
+            data, status_code = stored_response
+            return Response(data, status=status_code)
 
-    if transaction_by_id is None:
-        response = broker_unsafe_transfer(
-            transaction_id=transfer_object.transaction_id,
-            origin=transfer_object.origin,
-            destination=transfer_object.destination,
-            amount=transfer_object.transfer_amount,
-            comment=transfer_object.comment,
-        )
-        print("Response data:", response)
-        return response
-    else:
-        new_transfer_funds = {
-            "transaction_id": transaction_by_id.transaction_id,
-            "origin": transfer_object.origin,
-            "destination": transfer_object.destination,
-            "transfer_amount": transfer_object.transfer_amount,
-            "comment": transfer_object.comment,
-        }
-        return Response({"ok": new_transfer_funds})
+        with transaction.atomic():
+            response = broker_unsafe_transfer(
+                transaction_id=transfer_object.transaction_id,
+                origin=transfer_object.origin,
+                destination=transfer_object.destination,
+                amount=transfer_object.transfer_amount,
+                comment=transfer_object.comment,
+            )
+            # Only successes are stored, a failed transfer can be tried again
+            if response.status_code == 200:
+                idempotency.remember(
+                    transfer_object.transaction_id, response.data, 200, request_fingerprint, encoder=ObjectDecoder
+                )
+
+        if response.data.get("error") == "IntegrityError":
+            # Saved by another process in the meantime, or saved before responses were stored
+            stored_response = idempotency.lookup(transfer_object.transaction_id, request_fingerprint)
+            if stored_response is not None:
+                data, status_code = stored_response
+                return Response(data, status=status_code)
+
+            entry = Ledger.objects.filter(pk=transfer_object.transaction_id).values_list(
+                "origin", "destination", "amount"
+            ).first()
+            if entry is not None and idempotency.fingerprint(*entry) != request_fingerprint:
+                data, status_code = idempotency.reused_response(transfer_object.transaction_id)
+                return Response(data, status=status_code)
+
+            new_transfer_funds = {
+                "transaction_id": transfer_object.transaction_id,
+                "origin": transfer_object.origin,
+                "destination": transfer_object.destination,
+                "transfer_amount": transfer_object.transfer_amount,
+                "comment": transfer_object.comment,
+            }
+            with transaction.atomic():
+                idempotency.remember(
+                    transfer_object.transaction_id, {"ok": new_transfer_funds}, 200, request_fingerprint, encoder=ObjectDecoder
+                )
+            return Response({"ok": new_transfer_funds})
+
+    print("Response data:", response)
+    return response
 
 
 def broker_unsafe_transfer(
@@ -216,18 +261,163 @@ def broker_unsafe_transfer(
         return Response({"error": "UnexpectedError", "detail": err}, status=500)
 
 
+# Largest number of transfers accepted in a single batch
+TRANSFER_BATCH_LIMIT = 1000
+
+
+def parse_transfer_batch(request) -> list:
+    """Reads a batch of transfers, sent either as a JSON array or as NDJSON (one transfer per line)"""
+    if request.content_type == "application/x-ndjson":
+        return [json.loads(line) for line in request.body.splitlines() if line.strip()]
+
+    batch = request.data
+    # Like single transfers, the broker may send the array as a JSON encoded string
+    if isinstance(batch, str):
+        batch = json.loads(batch)
+    if not isinstance(batch, list):
+        raise ValueError("Expected an array of transfers")
+    return batch
+
+
+# TODO: Prevent external calls
+# url: transfer-funds/batch/
+@api_view(["POST"])
+def transfer_funds_batch(request):
+    try:
+        batch = parse_transfer_batch(request)
+    except ValueError as error:
+        return Response({"error": "ParseError", "detail": str(error)}, status=400)
+
+    if len(batch) > TRANSFER_BATCH_LIMIT:
+        return Response({
+            "error": "BatchTooLargeError",
+            "detail": f"A batch can hold at most {TRANSFER_BATCH_LIMIT} transfers, received: {len(batch)}",
+        }, status=400)
+
+    # Validate every transfer without touching the database, uniqueness is checked for the whole batch below
+    results = []
+    valid_transfers = {}
+    for item in batch:
+        try:
+            transfer_object = TransferFunds(
+                transaction_id=item.get("transaction_id"),
+                origin=item.get("origin_id"),
+                destination=item.get("destination_id"),
+                transfer_amount=Decimal(str(item.get("amount"))),
+                comment=item.get("comment"),
+            )
+            transfer_object.full_clean(validate_unique=False)
+            if transfer_object.transfer_amount <= 0:
+                raise ValidationError(
+                    f"The amount of money being transferred can not be negative, amount set: {transfer_object.transfer_amount}"
+                )
+        except (ValidationError, AttributeError, decimal.InvalidOperation) as error:
+            transaction_id = item.get("transaction_id") if isinstance(item, dict) else None
+            results.append({"transaction_id": transaction_id, "error": type(error).__name__, "detail": str(error)})
+            continue
+
+        transaction_id = str(transfer_object.transaction_id)
+        if transaction_id in valid_transfers:
+            results.append({"transaction_id": transaction_id, "ok": "Duplicate in batch"})
+            continue
+        valid_transfers[transaction_id] = transfer_object
+        results.append({"transaction_id": transaction_id, "ok": None})
+
+    request_fingerprints = {
+        transaction_id: idempotency.fingerprint(transfer_object.origin, transfer_object.destination, transfer_object.transfer_amount)
+        for transaction_id, transfer_object in valid_transfers.items()
+    }
+    # Replayed transfers are not an error, they are found in the idempotency store with a single query
+    stored_responses = idempotency.lookup_many(request_fingerprints)
+    # Transfers saved before responses were stored are only in the ledger, their responses are stored below
+    unrecorded = {}
+    unknown_ids = [transaction_id for transaction_id in valid_transfers if transaction_id not in stored_responses]
+    if unknown_ids:
+        entries = Ledger.objects.filter(pk__in=unknown_ids).values_list("pk", "origin", "destination", "amount")
+        unrecorded = {str(pk): idempotency.fingerprint(*fields) for pk, *fields in entries}
+    existing_ids = set(stored_responses) | set(unrecorded)
+
+    # Ids already used for a different transfer, only successes are stored so anything else is a refusal
+    refused = {
+        transaction_id: data for transaction_id, (data, status_code) in stored_responses.items() if status_code != 200
+    }
+    for transaction_id, saved_fingerprint in unrecorded.items():
+        if saved_fingerprint != request_fingerprints[transaction_id]:
+            refused[transaction_id] = idempotency.reused_response(transaction_id)[0]
+
+    new_entries = []
+    responses = {}
+    for transaction_id, transfer_object in valid_transfers.items():
+        if transaction_id not in existing_ids:
+            new_entries.append(Ledger(
+                transaction_id=transfer_object.transaction_id,
+                origin=transfer_object.origin,
+                destination=transfer_object.destination,
+                amount=transfer_object.transfer_amount,
+                loan_id=None,
+                comment=transfer_object.comment,
+            ))
+        elif transaction_id not in unrecorded or transaction_id in refused:
+            continue
+        # The response `transfer_funds` gives, so the transfer is a replay for both endpoints
+        responses[transaction_id] = ({"ok": {
+            "transaction_id": transfer_object.transaction_id,
+            "origin": transfer_object.origin,
+            "destination": transfer_object.destination,
+            "transfer_amount": transfer_object.transfer_amount,
+            "comment": transfer_object.comment,
+        }}, 200, request_fingerprints[transaction_id])
+
+    try:
+        # The responses are stored in the transaction that saves the transfers
+        with transaction.atomic():
+            Ledger.bulk_record(new_entries)
+            idempotency.remember_many(responses, encoder=ObjectDecoder)
+    except IntegrityError as err:
+        # Another request inserted one of these transfers meanwhile, nothing has been saved so the batch can be resent
+        print("IntegrityError: ", err)
+        return Response({"error": "IntegrityError", "detail": str(err)}, status=409)
+
+    for result in results:
+        if result.get("ok", False) is not None:
+            continue
+        if result["transaction_id"] in refused:
+            del result["ok"]
+            result.update(refused[result["transaction_id"]])
+        else:
+            result["ok"] = "Transaction already exists" if result["transaction_id"] in existing_ids else "Transaction saved"
+
+    return Response({"ok": results})
+
+
+# TODO: Prevent external calls
+# url: broker-transfers/
+@api_view(["GET"])
+def broker_transfers(request):
+    # The ledger entries of the transfers of the broker as NDJSON, compared by the `reconcile` command of the other bank.
+    # Only that command knows the RECONCILE_TOKEN both banks share
+    token = settings.RECONCILE_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    if not token or not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return Response({"error": "ForbiddenError", "detail": "A valid reconcile token is required."}, status=403)
+    return StreamingHttpResponse(reconcile.to_ndjson(reconcile.broker_entries("default")), content_type="application/x-ndjson")
+
+
 # TODO: Prevent external calls
 # url: transaction/<str:pk>/
-@api_view(["DEL"])
+@api_view(["DELETE"])
 def delete_transaction(request, pk):
 
-    [transaction_by_id] = Ledger.objects.filter(pk=pk) or None
+    transaction_by_id = Ledger.objects.filter(pk=pk).first()
 
     if transaction_by_id is None:
         return Response({"ok": "Transaction does not exist"})
     else:
         try:
-            delete_response = transaction_by_id.delete()
+            with transaction.atomic():
+                delete_response = transaction_by_id.delete()
+                # A transfer delivered again after being undone has to be saved again, not answered from the store
+                idempotency.forget(pk)
             print(delete_response)
 
             return Response({"ok": "Transaction has been deleted"})
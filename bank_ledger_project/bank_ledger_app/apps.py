@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BankLedgerAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bank_ledger_app'
+
+    def ready(self):
+        # Registers the signal receivers
+        from . import signals  # noqa: F401
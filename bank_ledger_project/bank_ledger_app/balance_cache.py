@@ -0,0 +1,135 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+_MISSING = object()
+
+
+class CacheStats:
+    """Hits and misses of the balance and history caches in this process"""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, kind: str, outcome: str):
+        with self._lock:
+            self._counts[(kind, outcome)] += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        report = {}
+        for kind in sorted({kind for kind, _ in counts}):
+            hits, misses = counts.get((kind, "hit"), 0), counts.get((kind, "miss"), 0)
+            report[kind] = {
+                "hits": hits,
+                "misses": misses,
+                # Misses that found the entry filled in by another reader instead of querying the database
+                "waited": counts.get((kind, "waited"), 0),
+                "errors": counts.get((kind, "error"), 0),
+                "hit_ratio": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+            }
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def _account_key(account_id) -> str:
+    # Normalizes the different spellings of the same uuid, throws `ValueError` for anything else
+    return str(uuid.UUID(str(account_id)))
+
+
+def _version_key(account_key: str) -> str:
+    return f"ledger:{account_key}:version"
+
+
+def _version(account_key: str) -> str:
+    """Current version of the cached entries of an account
+
+    A missing version is replaced by a new random one rather than a counter starting over, so entries
+    cached before the version key was evicted can never be read again.
+    """
+    key = _version_key(account_key)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def read_through(kind: str, account_id, variant: str, compute):
+    """Returns the cached `kind` entry of `account_id`, calling `compute` to fill it in on a miss
+
+    Only one reader at a time computes a missing entry, the others wait up to `BALANCE_CACHE_WAIT_MS` for it
+    before querying the database themselves. Reads inside a transaction skip the cache, they have to see the
+    writes of that transaction and must not publish them before it commits. A failing cache is skipped too.
+    """
+    if transaction.get_connection().in_atomic_block:
+        return compute()
+    try:
+        account_key = _account_key(account_id)
+    except ValueError:
+        return compute()
+
+    holds_lock = False
+    try:
+        key = f"ledger:{account_key}:{_version(account_key)}:{kind}:{variant}"
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            stats.count(kind, "hit")
+            return value
+        stats.count(kind, "miss")
+
+        lock_key = f"{key}:lock"
+        holds_lock = cache.add(lock_key, 1, timeout=settings.BALANCE_CACHE_LOCK_TIMEOUT)
+        if not holds_lock:
+            deadline = time.monotonic() + settings.BALANCE_CACHE_WAIT_MS / 1000
+            while time.monotonic() < deadline:
+                time.sleep(0.005)
+                value = cache.get(key, _MISSING)
+                if value is not _MISSING:
+                    stats.count(kind, "waited")
+                    return value
+    except Exception as error:
+        print(f"Balance cache is unavailable, reading from the database: {error}")
+        stats.count(kind, "error")
+        return compute()
+
+    value = compute()
+    try:
+        cache.set(key, value, timeout=settings.BALANCE_CACHE_TTL)
+        if holds_lock:
+            cache.delete(lock_key)
+    except Exception as error:
+        print(f"Could not cache the {kind} of account {account_key}: {error}")
+    return value
+
+
+def invalidate(*account_ids):
+    """Drops every cached entry of `account_ids` once the surrounding transaction commits
+
+    The accounts get a new version, which is only published after the commit: a reader that read the old
+    version and then the database before the commit caches its stale entry under a version nobody reads anymore.
+    """
+    keys = {_version_key(_account_key(account_id)) for account_id in account_ids}
+    if not keys:
+        return
+
+    def bump():
+        try:
+            cache.set_many({key: uuid.uuid4().hex for key in keys}, timeout=None)
+        except Exception as error:
+            # The entries expire after BALANCE_CACHE_TTL seconds anyway
+            print(f"Could not invalidate the cached balances of {len(keys)} accounts: {error}")
+
+    transaction.on_commit(bump)
@@ -3,8 +3,9 @@ from django.utils import timezone
 import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import *
-from .tasks import add_late_fee_task, add_interest_task, recusive_payment_task
+from .tasks import add_late_fee_task, add_interest_task, recusive_payment_task, write_balance_checkpoints_task
 import django_rq
+from django.core.management import call_command
 
 BANK_ACCOUNT_ID = "5bc6860e-61c2-4427-b9d8-b21c80c8370d"
 
@@ -19,3 +20,12 @@ def add_interest():
 
 def recusive_payment():
     django_rq.enqueue(recusive_payment_task)
+
+
+def write_balance_checkpoints():
+    django_rq.enqueue(write_balance_checkpoints_task)
+
+
+def reconcile():
+    # Runs in the cron process itself, on a large ledger it takes longer than the timeout of the rq jobs
+    call_command("reconcile")
@@ -0,0 +1,71 @@
+import csv
+import json
+from datetime import date, datetime, time, timedelta
+from django.db import transaction
+from django.utils import timezone
+from .models import Ledger
+
+COLUMNS = ("transaction_id", "timestamp", "origin", "destination", "amount", "loan_id", "comment")
+CHUNK_SIZE = 2000
+
+
+def parse_range(start: str = None, end: str = None) -> tuple:
+    """Turns the `YYYY-MM-DD` dates `start` and `end` into the `[start, end)` datetimes of `Ledger.export_queryset`
+
+    Both days are included, the range is in the current time zone and either side may be left out.
+    Throws `ValueError` for dates that can not be parsed
+    """
+    def midnight(day: date) -> datetime:
+        return timezone.make_aware(datetime.combine(day, time.min))
+
+    return (
+        midnight(date.fromisoformat(start)) if start else None,
+        midnight(date.fromisoformat(end) + timedelta(days=1)) if end else None,
+    )
+
+
+def export_rows(account_id: str = None, start: datetime = None, end: datetime = None, chunk_size: int = CHUNK_SIZE):
+    """Generator yielding a tuple of `COLUMNS` for every entry of `Ledger.export_queryset`
+
+    The rows are fetched `chunk_size` at a time, from a server-side cursor on PostgreSQL, so memory use does not
+    grow with the size of the export. The transaction keeps the cursor open between chunks, without it PostgreSQL
+    runs the whole query upfront, and gives the export a consistent snapshot.
+    """
+    entries = Ledger.export_queryset(account_id, start, end).values_list(*COLUMNS)
+    with transaction.atomic():
+        yield from entries.iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    """File-like object handing back what is written to it, so `csv.writer` can produce one line at a time"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def to_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for transaction_id, timestamp, origin, destination, amount, loan_id, comment in rows:
+        yield writer.writerow((transaction_id, timestamp.isoformat(), origin, destination, amount, loan_id or "", comment or ""))
+
+
+def to_ndjson(rows):
+    for transaction_id, timestamp, origin, destination, amount, loan_id, comment in rows:
+        yield json.dumps({
+            "transaction_id": str(transaction_id),
+            "timestamp": timestamp.isoformat(),
+            "origin": str(origin),
+            "destination": str(destination),
+            # A string keeps every decimal place, a JSON number would be read back as a float
+            "amount": str(amount),
+            "loan_id": str(loan_id) if loan_id else None,
+            "comment": comment,
+        }) + "\n"
+
+
+# Format name: (line generator, content type, file extension)
+FORMATS = {
+    "csv": (to_csv, "text/csv", "csv"),
+    "ndjson": (to_ndjson, "application/x-ndjson", "ndjson"),
+}
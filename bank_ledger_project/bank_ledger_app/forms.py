@@ -22,10 +22,27 @@ class CreateEmployeeForm(forms.ModelForm):
 
 
 # CUSTOMER FORMS
+class AccountChoiceField(forms.ModelChoiceField):
+    """Dropdown of accounts labelled with their balance
+
+    The queryset is annotated with `with_balance`, so the options cost a single query instead of
+    one balance lookup per account.
+    """
+
+    def _set_queryset(self, queryset):
+        super()._set_queryset(None if queryset is None else queryset.with_balance())
+
+    queryset = property(forms.ModelChoiceField._get_queryset, _set_queryset)
+
+    def label_from_instance(self, account):
+        # Annotated decimals are not rounded to the field's decimal places on every database
+        return f"{account.account_name} - {account.current_balance:.2f} kr"
+
+
 class LoanForm(forms.Form):
-    account = forms.ModelChoiceField(
+    account = AccountChoiceField(
         label="from_account",
-        queryset=Customer.objects.none(),
+        queryset=Account.objects.none(),
         widget=forms.Select(attrs={"class": "box box-light-border"}))
 
     amount = forms.DecimalField(
@@ -58,14 +75,14 @@ class PayLoanForm(forms.Form):
 
 
 class OwnTransferForm(forms.Form):
-    from_account = forms.ModelChoiceField(
+    from_account = AccountChoiceField(
         label="From account",
-        queryset=Customer.objects.none(),
+        queryset=Account.objects.none(),
         widget=forms.Select(attrs={"class": "box box-light-border"}))
 
-    to_account = forms.ModelChoiceField(
+    to_account = AccountChoiceField(
         label="To account",
-        queryset=Customer.objects.none(),
+        queryset=Account.objects.none(),
         widget=forms.Select(attrs={"class": "box box-light-border"}))
 
     amount = forms.DecimalField(
@@ -83,9 +100,9 @@ class OwnTransferForm(forms.Form):
 
 class OtherTransferForm(forms.Form):
 
-    from_account = forms.ModelChoiceField(
+    from_account = AccountChoiceField(
         label="From account",
-        queryset=Customer.objects.none(),
+        queryset=Account.objects.none(),
         widget=forms.Select(attrs={"class": "box box-light-border"}))
 
     to_account = forms.CharField(
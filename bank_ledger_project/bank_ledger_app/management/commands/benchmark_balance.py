@@ -0,0 +1,79 @@
+import time
+import uuid
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from bank_ledger_app.models import BANK_ACCOUNT_ID, AccountBalance, Ledger, Loan
+
+
+def legacy_balance(account_id) -> Decimal:
+    """The previous `Ledger.balance`, one model instance per entry summed in Python"""
+    all_movements = Ledger.objects.all()
+    total_arriving_in_account = sum([entry.amount for entry in all_movements.filter(destination=account_id)])
+    total_leaving_account = sum([entry.amount for entry in all_movements.filter(origin=account_id)])
+    return Decimal(total_arriving_in_account - total_leaving_account)
+
+
+def legacy_loan_balance(loan_id) -> Decimal:
+    """The previous `Ledger.loan_balance`, one model instance per repayment summed in Python"""
+    all_repayments = Ledger.objects.filter(loan_id=loan_id)
+    total_loaned = Ledger.objects.get(transaction_id=loan_id).amount
+    return Decimal(total_loaned - sum([entry.amount for entry in all_repayments]))
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Measures balance and loan balance latency against the amount of ledger rows, old vs new implementation"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", nargs="+", type=int, default=[1_000, 100_000, 1_000_000])
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the best run is reported")
+        parser.add_argument("--batch-size", type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'rows':>10} | {'path':<28} | {'best (ms)':>10}")
+        self.stdout.write("-" * 56)
+        for rows in options["rows"]:
+            # Every measurement runs in its own transaction that is rolled back, the database is left untouched
+            try:
+                with transaction.atomic():
+                    self.run_for(rows, options["repeat"], options["batch_size"])
+                    raise _Rollback()
+            except _Rollback:
+                pass
+
+    def run_for(self, rows: int, repeat: int, batch_size: int):
+        account_id = uuid.uuid4()
+        loan = Ledger.objects.create(origin=BANK_ACCOUNT_ID, destination=account_id, amount=rows * 2, comment="Benchmark loan")
+        Loan.open(loan)
+
+        # bulk_create skips `Ledger.save`, the materialized balance and loan are set once afterwards instead
+        for start in range(0, rows, batch_size):
+            Ledger.objects.bulk_create(
+                [
+                    Ledger(origin=account_id, destination=BANK_ACCOUNT_ID, amount=Decimal("1.00"), loan_id=loan)
+                    for _ in range(min(batch_size, rows - start))
+                ],
+                batch_size=batch_size,
+            )
+        AccountBalance.adjust(account_id, -rows)
+        Loan.repay(loan.transaction_id, rows)
+
+        measurements = [
+            ("balance (legacy, python sum)", lambda: legacy_balance(account_id)),
+            ("balance (aggregate)", lambda: Ledger.computed_balance(account_id)),
+            ("balance (materialized)", lambda: Ledger.balance(account_id)),
+            ("loan_balance (legacy)", lambda: legacy_loan_balance(loan.transaction_id)),
+            ("loan_balance (aggregate)", lambda: Ledger.computed_loan_balance(loan.transaction_id)),
+            ("loan_balance (materialized)", lambda: Ledger.loan_balance(loan.transaction_id)),
+        ]
+        for name, function in measurements:
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                function()
+                timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(f"{rows:>10} | {name:<28} | {min(timings):>10.2f}")
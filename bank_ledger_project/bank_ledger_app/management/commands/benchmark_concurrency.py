@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from bank_ledger_app.models import Account, AccountBalance, Customer, Ledger
+
+
+class Command(BaseCommand):
+    help = "Measures simultaneous transfers against the configured database, every thread with its own connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", nargs="+", type=int, default=[1, 4, 16])
+        parser.add_argument("--transfers", type=int, default=200, help="Transfers made by every thread")
+        parser.add_argument("--disjoint", action="store_true", help="Every thread pays into its own account")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Database: {connection.vendor}")
+        self.stdout.write(f"{'threads':>8} | {'transfers/s':>12} | {'p50 (ms)':>9} | {'p95 (ms)':>9} | results")
+        self.stdout.write("-" * 72)
+        for threads in options["threads"]:
+            customer, accounts, destinations = self.set_up(threads, options["disjoint"])
+            try:
+                self.run_for(accounts, destinations, options["transfers"])
+            finally:
+                self.tear_down(customer, accounts + destinations)
+
+    def set_up(self, threads: int, disjoint: bool):
+        """A customer with one funded account per thread, paying into one shared account or one account each"""
+        user = User.objects.create(username=f"benchmark-{uuid.uuid4()}")
+        customer = Customer.objects.create(email=f"{user.username}@benchmark.local", phone_number="00000000", user=user)
+        destinations = [
+            Account.objects.create(customer=customer, account_name="Benchmark destination")
+            for _ in range(threads if disjoint else 1)
+        ]
+        funding = Account.objects.create(customer=customer, account_name="Benchmark funding")
+        accounts = [Account.objects.create(customer=customer, account_name="Benchmark origin") for _ in range(threads)]
+        Ledger.bulk_record(
+            [Ledger(origin=funding.account_id, destination=account.account_id, amount=Decimal(1_000_000)) for account in accounts]
+        )
+        return customer, accounts + [funding], destinations
+
+    def run_for(self, accounts: list, destinations: list, transfers: int):
+        origins = [account for account in accounts if account.account_name == "Benchmark origin"]
+        latencies = []
+        results = Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(len(origins))
+
+        def transfer_from(origin, destination):
+            own_latencies = []
+            own_results = Counter()
+            start.wait()
+            try:
+                for _ in range(transfers):
+                    started = time.perf_counter()
+                    try:
+                        result = Ledger.transfer_money(origin.account_id, destination.account_id, Decimal("1.00"), "Benchmark")
+                        own_results["ok" if "ok" in result else result["error"]] += 1
+                    except Exception as error:
+                        own_results[type(error).__name__] += 1
+                    own_latencies.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+            with lock:
+                latencies.extend(own_latencies)
+                results.update(own_results)
+
+        workers = [
+            threading.Thread(target=transfer_from, args=(origin, destinations[index % len(destinations)]))
+            for index, origin in enumerate(origins)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+        self.stdout.write(
+            f"{len(origins):>8} | {len(latencies) / elapsed:>12.1f} | {p50:>9.1f} | {p95:>9.1f} | {dict(results)}"
+        )
+
+    def tear_down(self, customer, accounts: list):
+        account_ids = [account.account_id for account in accounts]
+        # Queryset deletes skip `Ledger.delete`, the balance rows of these accounts are dropped with them
+        Ledger.objects.filter(origin__in=account_ids).delete()
+        AccountBalance.objects.filter(account_id__in=account_ids).delete()
+        Account.objects.filter(account_id__in=account_ids).delete()
+        user = customer.user
+        customer.delete()
+        user.delete()
@@ -0,0 +1,48 @@
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from bank_ledger_app import export
+
+
+class Command(BaseCommand):
+    help = "Streams the ledger entries of an account, or of the whole bank, as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", help="Account id, the whole bank is exported when left out")
+        parser.add_argument("--start", help="First day to export, YYYY-MM-DD")
+        parser.add_argument("--end", help="Last day to export, YYYY-MM-DD")
+        parser.add_argument("--format", choices=sorted(export.FORMATS), default="csv")
+        parser.add_argument("--output", help="File to write to, standard output when left out")
+        parser.add_argument("--chunk-size", type=int, default=export.CHUNK_SIZE, help="Rows fetched from the database at a time")
+
+    def handle(self, *args, **options):
+        try:
+            start, end = export.parse_range(options["start"], options["end"])
+        except ValueError as error:
+            raise CommandError(f"Dates must be written as YYYY-MM-DD: {error}")
+        try:
+            account_id = uuid.UUID(options["account"]) if options["account"] else None
+        except ValueError:
+            raise CommandError(f"Invalid account id: {options['account']}")
+
+        to_lines = export.FORMATS[options["format"]][0]
+        rows = export.export_rows(account_id, start, end, chunk_size=options["chunk_size"])
+        lines = to_lines(rows)
+        output = open(options["output"], "w", newline="") if options["output"] else None
+        written = 0
+        try:
+            for line in lines:
+                if output:
+                    output.write(line)
+                else:
+                    self.stdout.write(line, ending="")
+                written += 1
+        finally:
+            # Releases the cursor and ends the transaction of an export that stopped early
+            lines.close()
+            rows.close()
+            if output:
+                output.close()
+
+        # The header line of CSV files is not an entry
+        entries = written - 1 if options["format"] == "csv" else written
+        self.stderr.write(self.style.SUCCESS(f"Exported {entries} ledger entries"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from bank_ledger_app.models import AccountBalance
+
+
+class Command(BaseCommand):
+    help = "Recomputes every materialized account balance from the ledger"
+
+    def handle(self, *args, **options):
+        drifted = AccountBalance.drift()
+        for row in drifted:
+            self.stdout.write(f"Fixing drift on account {row['account_id']}: stored {row['stored']} - computed {row['computed']}")
+
+        written = AccountBalance.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} account balances ({len(drifted)} had drifted)"))
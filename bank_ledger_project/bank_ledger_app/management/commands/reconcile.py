@@ -0,0 +1,92 @@
+import time
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from bank_ledger_app import reconcile
+from bank_ledger_app.reconcile import to_kr
+
+
+class Command(BaseCommand):
+    help = "Checks that the materialized balances add up to zero, match the ledger and agrees with the other bank on the transfers of the broker"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--other-database",
+            default="other_bank" if "other_bank" in settings.DATABASES else None,
+            help="Database alias of the other bank, 'other_bank' when configured, the comparison is skipped without it",
+        )
+        parser.add_argument(
+            "--other-bank-url",
+            default=settings.OTHER_BANK_API_URL,
+            help="Base URL of the API of the other bank, OTHER_BANK_API_URL by default, read when no database of the other bank is set",
+        )
+        parser.add_argument("--chunk-size", type=int, default=reconcile.CHUNK_SIZE, help="Transfers of the broker read from each database at a time")
+        parser.add_argument("--show", type=int, default=20, help="Differences printed of each kind")
+
+    def handle(self, *args, **options):
+        # An empty alias turns the comparison off
+        other_database = options["other_database"] or None
+        if other_database is not None and other_database not in settings.DATABASES:
+            raise CommandError(f"Unknown database alias: {other_database}")
+        if other_database == "default":
+            raise CommandError("The other bank must be a different database than 'default'")
+        other_bank_url = options["other_bank_url"] or None
+        show = options["show"]
+        problems = []
+
+        started = time.perf_counter()
+        report = reconcile.trial_balance(reconcile.net_positions())
+        self.stdout.write(f"Summed the ledger of {report['accounts']} accounts in {time.perf_counter() - started:.2f} seconds")
+        # The stored balances, each entry of the ledger adds to one and takes from another
+        self.stdout.write(f"Customers: {to_kr(report['customers'])} kr")
+        self.stdout.write(f"Bank: {to_kr(report['bank'])} kr")
+        self.stdout.write(f"Other banks: {to_kr(report['other_banks'])} kr")
+        self.stdout.write(f"Trial balance: {to_kr(report['total'])} kr")
+        if report["total"] != 0:
+            problems.append(f"the trial balance is off by {to_kr(report['total'])} kr")
+
+        for account_id, stored, computed in report["drifted"][:show]:
+            self.stdout.write(f"Account {account_id}: stored {to_kr(stored)} - computed {to_kr(computed)}")
+        if report["drifted"]:
+            problems.append(f"{len(report['drifted'])} materialized balance(s) have drifted, run 'rebuild_balances'")
+
+        if other_database is not None:
+            other_bank = f"'{other_database}'"
+        elif other_bank_url is not None:
+            other_bank = other_bank_url
+        else:
+            other_bank = None
+
+        if other_bank is None:
+            self.stdout.write("Neither a database nor the API of the other bank is configured, the transfers of the broker are not compared")
+        else:
+            started = time.perf_counter()
+            ours = reconcile.broker_entries("default", options["chunk_size"])
+            if other_database is not None:
+                theirs = reconcile.broker_entries(other_database, options["chunk_size"])
+            else:
+                theirs = reconcile.remote_broker_entries(other_bank_url, host=f"{settings.OTHER_BANK_IP}.nginx", token=settings.RECONCILE_TOKEN)
+            differences = {"only ours": 0, "only theirs": 0, "different": 0}
+            try:
+                for transaction_id, our_entry, their_entry in reconcile.diff_broker_entries(ours, theirs):
+                    kind = "only theirs" if our_entry is None else "only ours" if their_entry is None else "different"
+                    differences[kind] += 1
+                    if differences[kind] <= show:
+                        self.stdout.write(f"Transfer {transaction_id} ({kind}): ours {our_entry} - theirs {their_entry}")
+            except requests.RequestException as error:
+                raise CommandError(f"Could not read the transfers of the broker from {other_bank}: {error}")
+            finally:
+                # Releases the cursors and the connection of a comparison that failed halfway
+                ours.close()
+                theirs.close()
+            self.stdout.write(f"Compared the transfers of the broker with {other_bank} in {time.perf_counter() - started:.2f} seconds")
+            if any(differences.values()):
+                problems.append(
+                    f"{differences['only ours']} transfer(s) are missing in {other_bank}, {differences['only theirs']} "
+                    f"only exist there and {differences['different']} were recorded differently"
+                )
+
+        if problems:
+            raise CommandError("Reconciliation failed: " + "; ".join(problems))
+
+        self.stdout.write(self.style.SUCCESS("The ledger reconciles"))
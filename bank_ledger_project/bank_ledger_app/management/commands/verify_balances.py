@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from bank_ledger_app.models import AccountBalance
+
+
+class Command(BaseCommand):
+    help = "Reports every account whose materialized balance has drifted from the ledger"
+
+    def handle(self, *args, **options):
+        drifted = AccountBalance.drift()
+        for row in drifted:
+            self.stdout.write(f"Account {row['account_id']}: stored {row['stored']} - computed {row['computed']}")
+
+        if drifted:
+            raise CommandError(f"{len(drifted)} account balance(s) have drifted, run 'rebuild_balances' to fix them")
+
+        self.stdout.write(self.style.SUCCESS("All account balances match the ledger"))
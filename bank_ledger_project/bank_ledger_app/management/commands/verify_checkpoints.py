@@ -0,0 +1,43 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from bank_ledger_app.models import BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Compares the balance checkpoints with a full recompute from the ledger, the latest checkpoint by default"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--as-of", help="Checkpoint time to verify, in ISO format")
+        parser.add_argument("--all", action="store_true", help="Verify every checkpoint time")
+        parser.add_argument("--rewrite", action="store_true", help="Write the checkpoints of drifted times again, oldest first")
+
+    def handle(self, *args, **options):
+        times = BalanceCheckpoint.objects.order_by("as_of").values_list("as_of", flat=True).distinct()
+        if options["as_of"]:
+            try:
+                as_of = datetime.fromisoformat(options["as_of"])
+            except ValueError as error:
+                raise CommandError(f"Invalid time: {error}")
+            times = [as_of if timezone.is_aware(as_of) else timezone.make_aware(as_of)]
+        elif not options["all"]:
+            times = list(times)[-1:]
+
+        drifted_times = []
+        for as_of in times:
+            drifted = BalanceCheckpoint.drift(as_of)
+            for row in drifted:
+                self.stdout.write(f"Checkpoint {as_of} of account {row['account_id']}: stored {row['stored']} - computed {row['computed']}")
+            if drifted:
+                drifted_times.append(as_of)
+
+        if drifted_times and options["rewrite"]:
+            for as_of in drifted_times:
+                written = BalanceCheckpoint.write(as_of)
+                self.stdout.write(f"Rewrote {written} checkpoints as of {as_of}")
+            drifted_times = [as_of for as_of in drifted_times if BalanceCheckpoint.drift(as_of)]
+
+        if drifted_times:
+            raise CommandError(f"Checkpoints at {len(drifted_times)} time(s) have drifted, run with '--rewrite' to fix them")
+
+        self.stdout.write(self.style.SUCCESS(f"Checkpoints at {len(times)} time(s) match the ledger"))
@@ -14,13 +14,13 @@ class Migration(migrations.Migration):
     def generate_superuser(apps, schema_editor):
         from django.contrib.auth.models import User
 
-        superuser = User.objects.create_superuser(
+        superuser = User.objects.db_manager(schema_editor.connection.alias).create_superuser(
             username='admin',
             email='admin@admin',
             password='123'
         )
 
-        superuser.save()
+        superuser.save(using=schema_editor.connection.alias)
 
     # This ensures that a 'customer' and an 'account' with this information exists anytime the DB is created
     def create_bank_account(apps, schema_editor):
@@ -29,7 +29,16 @@ class Migration(migrations.Migration):
         AuthUser = apps.get_model('auth', 'User')
 
         bank_user = AuthUser(id=1, username="bank_user", password="temp_password", is_staff=True, is_active=True)
-        bank_user.save()
+        bank_user.save(using=schema_editor.connection.alias)
+
+        # Saving with an explicit id leaves the id sequence of PostgreSQL behind, the superuser would reuse id 1
+        connection = schema_editor.connection
+        if connection.vendor == 'postgresql':
+            from django.core.management.color import no_style
+
+            with connection.cursor() as cursor:
+                for statement in connection.ops.sequence_reset_sql(no_style(), [AuthUser]):
+                    cursor.execute(statement)
 
         bank = Customer(
             customer_id="40c49b66-8eb1-499b-a914-48f60dd48b7b",
@@ -38,13 +47,13 @@ class Migration(migrations.Migration):
             phone_number="illegal_num",
             # user=bank_user - Not needed as it defaults to user.id = 1 and that is hard defined above
         )
-        bank.save()
+        bank.save(using=schema_editor.connection.alias)
         bank_account = Account(
             account_id="5bc6860e-61c2-4427-b9d8-b21c80c8370d",
             account_name="Bank Loan Account",
             customer=bank
         )
-        bank_account.save()
+        bank_account.save(using=schema_editor.connection.alias)
 
     dependencies = [
     ]
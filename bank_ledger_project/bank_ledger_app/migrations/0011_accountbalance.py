@@ -0,0 +1,39 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:24
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+class Migration(migrations.Migration):
+
+    # Fill the materialized balances from the entries already in the ledger
+    def backfill_balances(apps, schema_editor):
+        Ledger = apps.get_model('bank_ledger_app', 'Ledger')
+        AccountBalance = apps.get_model('bank_ledger_app', 'AccountBalance')
+
+        balances = {}
+        for row in Ledger.objects.using(schema_editor.connection.alias).values('destination').annotate(total=Sum('amount')).order_by():
+            balances[row['destination']] = balances.get(row['destination'], Decimal(0)) + row['total']
+        for row in Ledger.objects.using(schema_editor.connection.alias).values('origin').annotate(total=Sum('amount')).order_by():
+            balances[row['origin']] = balances.get(row['origin'], Decimal(0)) - row['total']
+
+        AccountBalance.objects.using(schema_editor.connection.alias).bulk_create(
+            [AccountBalance(account_id=account_id, balance=balance) for account_id, balance in balances.items()],
+            batch_size=1000,
+        )
+
+    dependencies = [
+        ('bank_ledger_app', '0010_alter_ledger_origin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('account_id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('balance', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=15)),
+            ],
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
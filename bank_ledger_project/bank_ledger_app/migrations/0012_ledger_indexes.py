@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_ledger_app', '0011_accountbalance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(fields=['origin', 'timestamp'], name='ledger_origin_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(fields=['destination', 'timestamp'], name='ledger_destination_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(fields=['loan_id', 'origin'], name='ledger_loan_origin_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(condition=models.Q(('months__gt', 0)), fields=['months'], name='ledger_recurring_idx'),
+        ),
+    ]
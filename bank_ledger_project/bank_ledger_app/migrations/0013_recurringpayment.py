@@ -0,0 +1,58 @@
+# Generated by Django 4.1.13 on 2026-10-18 07:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    # Ledger entries with `months` left used to be the schedule, they are all due straight away
+    def create_schedules_from_ledger(apps, schema_editor):
+        from django.utils import timezone
+
+        Ledger = apps.get_model('bank_ledger_app', 'Ledger')
+        RecurringPayment = apps.get_model('bank_ledger_app', 'RecurringPayment')
+
+        now = timezone.now()
+        RecurringPayment.objects.using(schema_editor.connection.alias).bulk_create(
+            [
+                RecurringPayment(
+                    origin=entry.origin,
+                    destination=entry.destination,
+                    loan_id_id=entry.loan_id_id,
+                    amount=entry.amount,
+                    comment=entry.comment,
+                    remaining_payments=entry.months,
+                    next_run_at=now,
+                )
+                for entry in Ledger.objects.using(schema_editor.connection.alias).filter(months__gt=0)
+            ],
+            batch_size=1000,
+        )
+
+    dependencies = [
+        ('bank_ledger_app', '0012_ledger_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringPayment',
+            fields=[
+                ('payment_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('origin', models.UUIDField()),
+                ('destination', models.UUIDField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('comment', models.CharField(blank=True, max_length=254, null=True)),
+                ('remaining_payments', models.PositiveIntegerField()),
+                ('next_run_at', models.DateTimeField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('loan_id', models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='recurring_payments', to='bank_ledger_app.ledger')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recurringpayment',
+            index=models.Index(condition=models.Q(('remaining_payments__gt', 0)), fields=['next_run_at'], name='recurring_due_idx'),
+        ),
+        migrations.RunPython(create_schedules_from_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.1.13 on 2026-10-18 08:39
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    # Loans used to be the entries from the bank account with no loan_id, their state is summed from the ledger once
+    def backfill_loans(apps, schema_editor):
+        from django.db.models import Sum
+
+        Ledger = apps.get_model('bank_ledger_app', 'Ledger')
+        Loan = apps.get_model('bank_ledger_app', 'Loan')
+        entries = Ledger.objects.using(schema_editor.connection.alias)
+
+        BANK_ACCOUNT_ID = "5bc6860e-61c2-4427-b9d8-b21c80c8370d"
+        repaid = dict(
+            entries.filter(loan_id__isnull=False).values('loan_id').annotate(total=Sum('amount')).order_by().values_list('loan_id', 'total')
+        )
+        # The month-end jobs name the loan they charge in the comment
+        charged = {}
+        for prefix, field in (('Interest for loan: ', 'accrued_interest'), ('Late fee for loan: ', 'accrued_fees')):
+            rows = entries.filter(comment__startswith=prefix).values('comment').annotate(total=Sum('amount')).order_by()
+            for row in rows:
+                charged[(row['comment'][len(prefix):], field)] = row['total']
+
+        loans = []
+        for entry in entries.filter(origin=BANK_ACCOUNT_ID, loan_id=None).iterator(chunk_size=2000):
+            outstanding = entry.amount - repaid.get(entry.transaction_id, Decimal(0))
+            loans.append(Loan(
+                entry_id=entry.transaction_id,
+                account_id=entry.destination,
+                principal=entry.amount,
+                outstanding=outstanding,
+                accrued_interest=charged.get((str(entry.transaction_id), 'accrued_interest'), Decimal(0)),
+                accrued_fees=charged.get((str(entry.transaction_id), 'accrued_fees'), Decimal(0)),
+                status='Open' if outstanding > 0 else 'Repaid',
+            ))
+        Loan.objects.using(schema_editor.connection.alias).bulk_create(loans, batch_size=1000)
+
+    dependencies = [
+        ('bank_ledger_app', '0013_recurringpayment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Loan',
+            fields=[
+                ('entry', models.OneToOneField(editable=False, on_delete=django.db.models.deletion.PROTECT, primary_key=True, related_name='loan_record', serialize=False, to='bank_ledger_app.ledger')),
+                ('account_id', models.UUIDField(editable=False)),
+                ('principal', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('outstanding', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('accrued_interest', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=15)),
+                ('accrued_fees', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=15)),
+                ('status', models.CharField(choices=[('Open', 'Open'), ('Repaid', 'Repaid')], default='Open', max_length=6)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(fields=['account_id'], name='loan_account_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(condition=models.Q(('status', 'Open')), fields=['status'], name='loan_open_idx'),
+        ),
+        migrations.RunPython(backfill_loans, migrations.RunPython.noop),
+    ]
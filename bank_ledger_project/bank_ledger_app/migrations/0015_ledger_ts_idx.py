@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_ledger_app', '0014_loan'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(fields=['timestamp', 'transaction_id'], name='ledger_ts_idx'),
+        ),
+    ]
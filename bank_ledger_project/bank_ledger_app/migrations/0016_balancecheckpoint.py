@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_ledger_app', '0015_ledger_ts_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_id', models.UUIDField(editable=False)),
+                ('as_of', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=15)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='balancecheckpoint',
+            index=models.Index(fields=['as_of'], name='checkpoint_as_of_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='balancecheckpoint',
+            constraint=models.UniqueConstraint(fields=('account_id', 'as_of'), name='checkpoint_account_as_of_unique'),
+        ),
+    ]
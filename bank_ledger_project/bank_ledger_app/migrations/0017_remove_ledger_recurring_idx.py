@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bank_ledger_app', '0016_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ledger',
+            name='ledger_recurring_idx',
+        ),
+    ]
@@ -1,11 +1,17 @@
 from django.contrib.auth.models import User
 from decimal import Decimal
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.db.models.query import QuerySet
-from django.db.models import Q
+from django.db.models import Q, F, Sum, Max, Case, When, OuterRef, Subquery, Value, Prefetch
+from django.db.models.functions import Coalesce
+from django.db import IntegrityError, OperationalError
 import uuid
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from django.utils import timezone
+from . import balance_cache
 
 BANK_ID = "40c49b66-8eb1-499b-a914-48f60dd48b7b"
 BANK_ACCOUNT_ID = "5bc6860e-61c2-4427-b9d8-b21c80c8370d"
@@ -18,6 +24,11 @@ class CustomerRanks(models.TextChoices):
     GOLD = 'Gold'
 
 
+class LoanStatus(models.TextChoices):
+    OPEN = 'Open'
+    REPAID = 'Repaid'
+
+
 # Remember to validate with 'customer'.full_clean()
 class Customer(models.Model):
     customer_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -33,21 +44,7 @@ class Customer(models.Model):
     def _is_own_account_id(self, account_id: uuid.UUID) -> bool:
         """Helper function to see if the provided `account_id` belongs to the `Customer` instance
         """
-        own_accounts = Account.objects.filter(customer_id=self.customer_id)
-
-        def check_id(uuid: uuid.UUID) -> bool:
-            """Tiny filter function to remove any id's that do not match the one provided
-            """
-            if str(uuid) == str(account_id):
-                return True
-            else:
-                return False
-        result = list(filter(check_id, [str(account.account_id) for account in own_accounts]))
-
-        if len(result) >= 1:
-            return True
-        else:
-            return False
+        return Account.objects.filter(pk=account_id, customer_id=self.customer_id).exists()
 
     def transfer_money(self, own_account_id: str, other_account_id: str, amount: Decimal, comment: str = "", loan_id: str = None, months: int = None):
         """Transfer Money from a user's own account to any other existing account.
@@ -60,15 +57,17 @@ class Customer(models.Model):
         if own_account_id == other_account_id:
             return {"error": "SameAccountError", "detail": f"Attempted to send funds from '{own_account_id}' to '{other_account_id}' but these are the same."}
         
-        # Make sure that 'own_account_id' is indeed in the user's account list
-        is_own_id = self._is_own_account_id(own_account_id)
-
-        if not is_own_id:
+        # Both accounts in one query, the own account only if it belongs to the customer
+        accounts = {
+            str(account.account_id): account
+            for account in Account.objects.filter(Q(pk=own_account_id, customer_id=self.customer_id) | Q(pk=other_account_id))
+        }
+        own_account = accounts.get(str(own_account_id))
+        other_account = accounts.get(str(other_account_id))
+
+        if own_account == None:
             return {"error": "NotOwnAccountError", "detail": "Not able to transfer money from an account you do not own"}
 
-        # Search all accounts for 'other_account_id' to make sure it exists
-        other_account = Account.objects.filter(pk=other_account_id) or None
-
         if other_account == None:
             return {"error": "NotFoundError", "detail": f"other_account with id: '{other_account_id}' could not be found"}
 
@@ -78,7 +77,9 @@ class Customer(models.Model):
             amount=amount,
             comment=comment,
             loan_id=loan_id,
-            months=months
+            months=months,
+            origin=own_account,
+            destination=other_account,
         )
         return result
 
@@ -115,24 +116,36 @@ class Customer(models.Model):
 
     @property
     def loans(self) -> list[dict]:
-        accounts = self.all_accounts
+        """Returns every loan of the customer, across all of their accounts, with its balance and repayments
+
+        This costs the same two queries no matter how many accounts or loans the customer has: one for the
+        `Loan` rows joined with their ledger entries, and one prefetching all their repayments
+        """
+        own_account_ids = Account.objects.filter(customer_id=self.customer_id).values("account_id")
+        loans = (
+            Loan.objects.filter(account_id__in=own_account_ids)
+            .select_related("entry")
+            .prefetch_related(Prefetch("entry__ledger_set", queryset=Ledger.objects.order_by("timestamp", "transaction_id"), to_attr="repayments"))
+            .order_by("entry__timestamp", "entry__transaction_id")
+        )
+
         history = []
-        for account in accounts:
-            account_id = account.account_id
-
-            loans = Ledger.objects.all().filter(destination=account_id, loan_id=None, origin=BANK_ACCOUNT_ID)
-            for loan in loans:
-                history_list = {"loan_id": loan.transaction_id,
-                                "amount": loan.amount, "date": loan.timestamp,
-                                "comment": loan.comment,
-                                "current_balance": loan.loan_balance(loan.transaction_id),
-                                "from_account": account_id,
-                                "repayments": []
-                                }
-
-                history_list["repayments"] = [{"date": transaction.timestamp, "amount": transaction.amount, "from_account": account_id}
-                                              for transaction in Ledger.objects.filter(loan_id=loan.transaction_id)]
-                history.append(history_list)
+        for loan in loans:
+            account_id = loan.account_id
+            history_list = {"loan_id": loan.entry.transaction_id,
+                            "amount": loan.principal, "date": loan.entry.timestamp,
+                            "comment": loan.entry.comment,
+                            "current_balance": loan.outstanding,
+                            "accrued_interest": loan.accrued_interest,
+                            "accrued_fees": loan.accrued_fees,
+                            "status": loan.status,
+                            "from_account": account_id,
+                            "repayments": []
+                            }
+
+            history_list["repayments"] = [{"date": transaction.timestamp, "amount": transaction.amount, "from_account": account_id}
+                                          for transaction in loan.entry.repayments]
+            history.append(history_list)
         return history
 
     def loan_money(self, own_account_id: str, amount: Decimal, comment: str = "Default"):
@@ -142,12 +155,14 @@ class Customer(models.Model):
         if self.rank == "Silver" or self.rank == "Gold":
             if self._is_own_account_id(own_account_id):
                 try:
-                    entry = Ledger.objects.create(
-                        origin=Account.objects.get(account_id=BANK_ACCOUNT_ID).account_id,
-                        destination=Account.objects.get(account_id=own_account_id).account_id,
-                        amount=amount,
-                        comment=f"Bank Loan-({comment})"
-                    )
+                    with transaction.atomic():
+                        entry = Ledger.objects.create(
+                            origin=Account.objects.get(account_id=BANK_ACCOUNT_ID).account_id,
+                            destination=Account.objects.get(account_id=own_account_id).account_id,
+                            amount=amount,
+                            comment=f"Bank Loan-({comment})"
+                        )
+                        Loan.open(entry)
                 except Exception as error:
                     return {"error": "UnknownError", "detail": error}
                 return {"ok": entry}
@@ -162,31 +177,43 @@ class Customer(models.Model):
         if amount <= 0:
             return {"error": "NegativeNumberError", "detail": f"The amount of money being transferred can not be negative or 0, amount set: {amount}"}
         if self._is_own_account_id(own_account_id):
-            account_history = Account.objects.get(account_id=own_account_id).history
-            # Find all transactions from bank
-            is_loan = True if len([transaction for transaction in account_history if str(transaction.transaction_id) == str(loan_id)]) >= 1 else False
+            try:
+                with transaction.atomic():
+                    # The loan stays locked until the repayment is saved, concurrent repayments can not overpay it
+                    loan = Loan.objects.select_for_update().filter(pk=loan_id, account_id=own_account_id).first()
 
-            if not is_loan:
-                return {"error": "InvalidLoan", "detail": f"Loan ID of {loan_id} was not found in the customers transaction history"}
+                    if loan == None:
+                        return {"error": "InvalidLoan", "detail": f"Loan ID of {loan_id} was not found in the customers transaction history"}
 
-            loan_balance = Ledger.loan_balance(loan_id=loan_id)
+                    if loan.outstanding < amount:
+                        return {"error": "ExcessRepaymentError", "detail": f"The outstanding loan is of value: {loan.outstanding} and the customer attempted to repay: {amount}"}
 
-            if loan_balance < amount:
-                return {"error": "ExcessRepaymentError", "detail": f"The outstanding loan is of value: {loan_balance} and the customer attempted to repay: {amount}"}
-
-            result = self.transfer_money(
-                own_account_id=own_account_id,
-                other_account_id=BANK_ACCOUNT_ID,
-                amount=amount,
-                loan_id=loan_id,
-                comment="Loan Repayment",
-                months=months
-            )
+                    result = self.transfer_money(
+                        own_account_id=own_account_id,
+                        other_account_id=BANK_ACCOUNT_ID,
+                        amount=amount,
+                        loan_id=loan_id,
+                        comment="Loan Repayment",
+                        months=months
+                    )
+            except OperationalError as error:
+                # SQLite has no row locks, the transaction only takes the write lock when the repayment is saved.
+                # A concurrent write in between fails it with SQLITE_BUSY instead of waiting
+                return {"error": "DatabaseBusyError", "detail": f"The loan could not be repaid right now, try again: {error}"}
             return result
         else:
             return {"error": "NotOwnAccountError", "detail": "Not able to repay a loan from an account you do not own"}
 
 
+class AccountQuerySet(models.QuerySet):
+    def with_balance(self) -> 'AccountQuerySet':
+        """Annotates every account with `current_balance`, read from its `AccountBalance` row in the same query"""
+        balance = AccountBalance.objects.filter(account_id=OuterRef("pk")).values("balance")[:1]
+        return self.annotate(
+            current_balance=Coalesce(Subquery(balance), Value(Decimal(0)), output_field=AccountBalance._meta.get_field("balance"))
+        )
+
+
 class Account(models.Model):
     account_id = models.UUIDField(
         primary_key=True,
@@ -201,6 +228,7 @@ class Account(models.Model):
     )
     customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
 
+    objects = AccountQuerySet.as_manager()
 
     def __str__(self):
         # return f"account_id: ({self.account_id}) - account_name: ({self.account_name}) - customer: ({self.customer})"
@@ -300,6 +328,45 @@ class Ledger(models.Model):
     comment = models.CharField(max_length=254, blank=True, null=True)
     months = models.IntegerField(default=None, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Account history and balance recomputes, both directions ordered by time
+            models.Index(fields=["origin", "timestamp"], name="ledger_origin_ts_idx"),
+            models.Index(fields=["destination", "timestamp"], name="ledger_destination_ts_idx"),
+            # Repayments of a loan, summed by `computed_loan_balance`. The loans themselves are listed from `Loan`
+            models.Index(fields=["loan_id", "origin"], name="ledger_loan_origin_idx"),
+            # Exports of the whole bank, streamed in time order over a date range without sorting the table first
+            models.Index(fields=["timestamp", "transaction_id"], name="ledger_ts_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Saves the entry and, for new entries, applies the amount to both `AccountBalance` rows
+
+        Both writes happen in the same database transaction so the materialized balances can never
+        disagree with the ledger. Ledger entries are append-only, only new entries move money.
+        A new repayment also lowers the outstanding amount of its `Loan`.
+        """
+        with transaction.atomic():
+            is_new = self._state.adding
+            super().save(*args, **kwargs)
+            if is_new:
+                AccountBalance.record(self.origin, self.destination, self.amount)
+                if self.loan_id_id:
+                    Loan.repay(self.loan_id_id, self.amount)
+
+    def delete(self, *args, **kwargs):
+        """Deletes the entry and reverses its effect on both `AccountBalance` rows, on the `BalanceCheckpoint`
+        rows taken after it, and on its `Loan`
+        """
+        with transaction.atomic():
+            origin, destination, amount, loan_id = self.origin, self.destination, self.amount, self.loan_id_id
+            result = super().delete(*args, **kwargs)
+            AccountBalance.record(destination, origin, amount)
+            BalanceCheckpoint.revert(origin, destination, amount, self.timestamp)
+            if loan_id:
+                Loan.repay(loan_id, -amount)
+            return result
+
     def __str__(self):
         # The transaction from a bank to a customer will never have the loan_id attribute set
         # This throws an exception when attempting to print it as it is basically `self.None.transaction_id`
@@ -313,77 +380,226 @@ class Ledger(models.Model):
         return f"transaction_id: ({self.transaction_id}) - origin_id: ({self.origin}) - destination_id: ({self.destination})- loan_id: {temp_transaction_id} - amount: ({self.amount}) - timestamp: ({self.timestamp}) - comment: ({self.comment})"
 
     @classmethod
-    def history(cls, account_id: str) -> list['Ledger']:
-        """Returns a list of all transactions to and from `account_id`
+    def history_queryset(cls, account_id: str, after: tuple = None) -> QuerySet:
+        """Returns a queryset of all transactions to and from `account_id`, oldest first
 
-        If none are found an empty list is returned instead
+        The entries are ordered by the database on `(timestamp, transaction_id)`, which is unique, so it can be
+        used for keyset pagination: pass the `(timestamp, transaction_id)` of the last entry already seen as
+        `after` to only get the entries following it.
 
         Throws `ValueError` if the passed `account_id` is not a valid uuid
         """
-        from django.db.models import Q
-        # Get ALL transactions
-        all_movements = cls.objects.all()
-
-        # Filter only the transactions that contain the given `account_id` in both directions
-        # then sort by timestamp
-        #
         # The Q is needed to do both requests in one query: (query1 | query 2)
-        all_account_movements = sorted(all_movements.filter(Q(destination=account_id) | Q(origin=account_id)),
-                                       key=lambda x: x.timestamp)
+        movements = cls.objects.filter(Q(destination=account_id) | Q(origin=account_id))
+
+        if after is not None:
+            timestamp, transaction_id = after
+            movements = movements.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, transaction_id__gt=transaction_id))
+
+        return movements.order_by("timestamp", "transaction_id")
+
+    @classmethod
+    def history(cls, account_id: str, after: tuple = None, limit: int = None) -> list['Ledger']:
+        """Returns a list of all transactions to and from `account_id`, oldest first
+
+        At most `limit` entries following the `after` keyset are returned, see `history_queryset`
+
+        If none are found an empty list is returned instead. Pages with a `limit` are read through the cache
+        outside of a transaction, see `balance_cache`
+
+        Throws `ValueError` if the passed `account_id` is not a valid uuid
+        """
+        def entries():
+            return list(cls.history_queryset(account_id, after)[:limit])
+
+        if limit is None:
+            return entries()
+        variant = f"{after[0].isoformat()}_{after[1]}:{limit}" if after else f"start:{limit}"
+        return balance_cache.read_through("history", account_id, variant, entries)
+
+    @classmethod
+    def export_queryset(cls, account_id: str = None, start: datetime = None, end: datetime = None) -> QuerySet:
+        """Returns the entries of `account_id`, or of the whole bank when it is `None`, oldest first
+
+        Only entries from `start` (inclusive) until `end` (exclusive) are returned when they are set.
+
+        Throws `ValueError` if the passed `account_id` is not a valid uuid
+        """
+        entries = cls.history_queryset(account_id) if account_id else cls.objects.order_by("timestamp", "transaction_id")
+        if start is not None:
+            entries = entries.filter(timestamp__gte=start)
+        if end is not None:
+            entries = entries.filter(timestamp__lt=end)
+        return entries
+
+    @classmethod
+    def iter_history(cls, account_id: str, after: tuple = None, chunk_size: int = 2000):
+        """Generator yielding all transactions to and from `account_id`, oldest first
+
+        Entries are fetched `chunk_size` rows at a time, so any amount of history can be walked with bounded memory
+        """
+        yield from cls.history_queryset(account_id, after).iterator(chunk_size=chunk_size)
+
+    @classmethod
+    def history_page(cls, account_id: str, cursor: str = None, page_size: int = 50) -> tuple[list['Ledger'], str]:
+        """Returns one page of the history of `account_id` and the cursor to the next page
+
+        `cursor` is an opaque string returned by a previous call, when it is `None` the first page is returned.
+        The returned cursor is `None` when there are no more pages.
+
+        Throws `ValueError` if `cursor` is not a valid cursor
+        """
+        after = None
+        if cursor:
+            timestamp, _, transaction_id = cursor.partition("_")
+            after = (datetime.fromisoformat(timestamp), uuid.UUID(transaction_id))
 
-        return all_account_movements
+        # One extra entry is fetched to know if there is a next page
+        entries = cls.history(account_id, after=after, limit=page_size + 1)
+        if len(entries) <= page_size:
+            return entries, None
+
+        entries = entries[:page_size]
+        last_entry = entries[-1]
+        return entries, f"{last_entry.timestamp.isoformat()}_{last_entry.transaction_id}"
 
     @classmethod
-    def balance(cls, account_id: str) -> Decimal:
-        # Get ALL transactions
-        all_movements = cls.objects.all()
+    def balance(cls, account_id: str, as_of: datetime = None) -> Decimal:
+        """Returns the current balance of `account_id`, or its balance right before `as_of` when it is set
+
+        The balance is read from the materialized `AccountBalance` row, which is kept up to date
+        every time a `Ledger` entry is saved or deleted, so this is a single primary key lookup, and outside
+        of a transaction it is read through the cache, see `balance_cache`.
+        A past balance is the closest `BalanceCheckpoint` before `as_of` plus the entries between the two, so it
+        only costs as much as the entries since that checkpoint.
+        Accounts that have never been part of a transaction have a balance of 0
+        """
+        if as_of is not None:
+            checkpoint = BalanceCheckpoint.objects.filter(account_id=account_id, as_of__lte=as_of).order_by("-as_of").first()
+            if checkpoint is None:
+                return cls.computed_balance(account_id, until=as_of)
+            return checkpoint.balance + cls.computed_balance(account_id, since=checkpoint.as_of, until=as_of)
+
+        def lookup():
+            balance = AccountBalance.objects.filter(account_id=account_id).values_list("balance", flat=True).first()
+            return Decimal(balance or 0)
 
-        # Filter the transaction lits for transactions going into the account
-        incoming_transactions = all_movements.filter(destination=account_id)
-        # Filter the transaction list for transactions leaving the account
-        outgoing_transactions = all_movements.filter(origin=account_id)
+        return balance_cache.read_through("balance", account_id, "", lookup)
 
-        # Iterate the individual lists for the amounts, collect them all and sum the totals
-        total_arriving_in_account = sum([transaction.amount for transaction in incoming_transactions])
-        total_leaving_account = sum([transaction.amount for transaction in outgoing_transactions])
+    @classmethod
+    def bulk_record(cls, entries: list['Ledger'], batch_size: int = 1000) -> list['Ledger']:
+        """Inserts many new entries at once and applies them to the `AccountBalance` rows
+
+        `bulk_create` does not call `save()`, so the balances are updated here in the same transaction,
+        with one update per distinct account instead of two per entry. Repayments among the entries are
+        applied to their loans, one update per loan.
+        """
+        with transaction.atomic():
+            created = cls.objects.bulk_create(entries, batch_size=batch_size)
+            AccountBalance.record_many(created)
 
-        # Minus the arriving from the total (as all accounts start with 0 this is safe to do)
-        balance = total_arriving_in_account - total_leaving_account
+            repaid = {}
+            for entry in created:
+                if entry.loan_id_id:
+                    repaid[entry.loan_id_id] = repaid.get(entry.loan_id_id, Decimal(0)) + Decimal(entry.amount)
+            for loan_id, amount in repaid.items():
+                Loan.repay(loan_id, amount)
 
-        return Decimal(balance)
+        return created
+
+    @classmethod
+    def computed_balance(cls, account_id: str, since: datetime = None, until: datetime = None) -> Decimal:
+        """Computes the balance of `account_id` straight from the ledger entries
+
+        The incoming and outgoing totals are summed by the database in a single conditional aggregate
+        query, no `Ledger` instances are created. An entry from an account to itself counts both ways.
+        Only the entries from `since` (inclusive) until `until` (exclusive) are summed when they are set,
+        which gives how much the balance moved over that period.
+        """
+        entries = cls.objects.filter(Q(destination=account_id) | Q(origin=account_id))
+        if since is not None:
+            entries = entries.filter(timestamp__gte=since)
+        if until is not None:
+            entries = entries.filter(timestamp__lt=until)
+        totals = entries.aggregate(
+            incoming=Sum(Case(When(destination=account_id, then=F("amount")))),
+            outgoing=Sum(Case(When(origin=account_id, then=F("amount")))),
+        )
+
+        return Decimal((totals["incoming"] or 0) - (totals["outgoing"] or 0))
 
     @classmethod
     def loan_balance(cls, loan_id: str) -> Decimal:
-        all_repayments = Ledger.objects.filter(loan_id=loan_id)
-        total_loaned = Ledger.objects.get(transaction_id=loan_id).amount
-        total_returned = sum([transaction.amount for transaction in all_repayments])
+        """Returns the outstanding amount of the loan `loan_id`
+
+        The amount is read from the `Loan` row, kept up to date every time a repayment is saved or deleted,
+        so this is a single primary key lookup.
+
+        Throws `Ledger.DoesNotExist` if there is no loan with the id `loan_id`
+        """
+        outstanding = Loan.objects.filter(pk=loan_id).values_list("outstanding", flat=True).first()
+
+        if outstanding is None:
+            raise cls.DoesNotExist(f"Loan with the id {loan_id} does not exist")
+
+        return Decimal(outstanding)
 
-        loan_balance = total_loaned - total_returned
+    @classmethod
+    def computed_loan_balance(cls, loan_id: str) -> Decimal:
+        """Computes the outstanding amount of the loan `loan_id` straight from the ledger entries
+
+        The loaned amount and the sum of the repayments are computed in a single aggregate query
+
+        Throws `Ledger.DoesNotExist` if there is no ledger entry with the id `loan_id`
+        """
+        totals = cls.objects.filter(Q(transaction_id=loan_id) | Q(loan_id=loan_id)).aggregate(
+            total_loaned=Sum(Case(When(transaction_id=loan_id, then=F("amount")))),
+            total_returned=Sum(Case(When(loan_id=loan_id, then=F("amount")))),
+        )
+
+        if totals["total_loaned"] is None:
+            raise cls.DoesNotExist(f"Ledger entry with the id {loan_id} does not exist")
+
+        loan_balance = totals["total_loaned"] - (totals["total_returned"] or 0)
 
         return Decimal(loan_balance)
 
     @classmethod
-    def transfer_money(cls, origin_id: str, destination_id: str, amount: Decimal, comment: str = "", loan_id: str = None, months: int = None):
+    def transfer_money(cls, origin_id: str, destination_id: str, amount: Decimal, comment: str = "", loan_id: str = None, months: int = None,
+                       origin: 'Account' = None, destination: 'Account' = None):
+        """Moves `amount` from `origin_id` to `destination_id`
+
+        Callers that already loaded the accounts pass them as `origin` and `destination`, otherwise both are
+        fetched in a single query.
+        """
         if amount < 0:
             return {"error": "NegativeNumberError", "detail": f"The amount of money being transferred can not be negative, amount set: {amount}"}
 
-        [origin] = Account.objects.filter(account_id=origin_id) or None
-        [destination] = Account.objects.filter(account_id=destination_id) or None
+        if origin == None or destination == None:
+            accounts = {str(account.account_id): account for account in Account.objects.filter(pk__in=[origin_id, destination_id])}
+            origin = accounts.get(str(origin_id))
+            destination = accounts.get(str(destination_id))
 
         if origin == None or destination == None:
             problem_child = origin_id if origin == None else destination_id
             return {"error": "AccountNotFoundError", "detail": f"Could not find account: {problem_child}"}
 
-        origin_balance = origin.balance
-        if origin_balance < amount:
-            return {"error": "InsufficientFunds",
-                    "detail": f"Origin account has: '{origin_balance}' but attempted to transfer: '{amount}'"
-                    }
-
         if loan_id != None:
             loan_id = cls.objects.get(transaction_id=loan_id)
         try:
-            transfer = cls.objects.create(origin=origin_id, destination=destination_id,amount=amount, comment=comment, loan_id=loan_id, months=months)
+            with transaction.atomic():
+                # The balance rows of both accounts stay locked until the entry is saved, so concurrent transfers
+                # from the same account are checked one after the other while other accounts are not held up
+                balances = AccountBalance.lock(origin.account_id, destination.account_id)
+                origin_balance = balances[origin.account_id].balance
+                if origin_balance < amount:
+                    return {"error": "InsufficientFunds",
+                            "detail": f"Origin account has: '{origin_balance}' but attempted to transfer: '{amount}'"
+                            }
+
+                transfer = cls.objects.create(origin=origin_id, destination=destination_id,amount=amount, comment=comment, loan_id=loan_id, months=months)
+                if months:
+                    RecurringPayment.schedule(transfer, int(months))
             return {"ok": transfer}
 
         except ValueError as error:
@@ -392,10 +608,377 @@ class Ledger(models.Model):
     @classmethod
     def broker_delete_transaction(cls, transaction_id: uuid):
 
-        transaction = Ledger.objects.filter(transaction_id=transaction_id) or None
+        entry = Ledger.objects.filter(transaction_id=transaction_id).first()
 
-        if transaction:
-            result = transaction.delete()
+        if entry:
+            # Delete through the instance (not the queryset) so the balances are reversed as well
+            result = entry.delete()
             return {"ok": result}
         else:
             return {"error": "DoesNotExistError", "detail": f"The Ledger entry with the id {transaction_id} does not exist"}
+
+
+class AccountBalance(models.Model):
+    """Materialized running balance of a single account
+
+    Every `Ledger` write updates the rows of both the origin and the destination inside the same
+    database transaction, which turns `Ledger.balance` into a primary key lookup instead of a sum
+    over the full account history.
+
+    `account_id` is not a foreign key as ledger entries created by the transaction broker may
+    reference accounts that live in the other bank.
+    """
+    account_id = models.UUIDField(primary_key=True, editable=False)
+    balance = models.DecimalField(max_digits=15, decimal_places=2, default=Decimal(0))
+
+    def __str__(self):
+        return f"account_id: ({self.account_id}) - balance: ({self.balance})"
+
+    @classmethod
+    def _to_decimal(cls, amount) -> Decimal:
+        return cls._meta.get_field("balance").to_python(amount)
+
+    @classmethod
+    def adjust(cls, account_id: uuid.UUID, delta: Decimal):
+        """Adds `delta` to the balance of `account_id`, creating the row if it does not exist yet
+        """
+        delta = cls._to_decimal(delta)
+        updated = cls.objects.filter(account_id=account_id).update(balance=F("balance") + delta)
+        if updated:
+            return
+
+        try:
+            # The savepoint makes sure a concurrent insert of the same row does not break the
+            # surrounding transaction, in that case we simply retry as an update.
+            with transaction.atomic():
+                cls.objects.create(account_id=account_id, balance=delta)
+        except IntegrityError:
+            cls.objects.filter(account_id=account_id).update(balance=F("balance") + delta)
+
+    @classmethod
+    def lock(cls, *account_ids: uuid.UUID) -> dict:
+        """Locks the balance rows of `account_ids` until the end of the surrounding transaction
+
+        The rows are locked in `account_id` order so two transactions locking the same accounts can not
+        deadlock each other, missing rows are created so there is always a row to lock. SQLite has no row
+        locks, there the rows are created first as the insert takes the database write lock.
+
+        Returns a `{account_id: AccountBalance}` dict
+        """
+        account_ids = sorted({uuid.UUID(str(account_id)) for account_id in account_ids})
+        locked = cls.objects.select_for_update().filter(account_id__in=account_ids).order_by("account_id")
+
+        rows = {row.account_id: row for row in locked} if connection.features.has_select_for_update else {}
+        missing = [account_id for account_id in account_ids if account_id not in rows]
+        if missing:
+            # Rows created concurrently are simply skipped
+            cls.objects.bulk_create([cls(account_id=account_id) for account_id in missing], ignore_conflicts=True)
+            rows = {row.account_id: row for row in locked.all()}
+
+        return rows
+
+    @classmethod
+    def record(cls, origin: uuid.UUID, destination: uuid.UUID, amount: Decimal):
+        """Moves `amount` from the `origin` balance to the `destination` balance
+
+        The cached balances and histories of both accounts are dropped once the transaction commits,
+        every ledger write goes through here or `record_many`
+        """
+        amount = cls._to_decimal(amount)
+        with transaction.atomic():
+            balance_cache.invalidate(origin, destination)
+            if str(origin) == str(destination):
+                return
+            cls.adjust(origin, -amount)
+            cls.adjust(destination, amount)
+
+    @classmethod
+    def record_many(cls, entries: list['Ledger'], batch_size: int = 500):
+        """Applies the amounts of many ledger entries to the balances at once
+
+        The deltas are summed per account first, then the affected rows are locked with `lock` and written
+        back with `bulk_update`.
+        """
+        deltas = {}
+        for entry in entries:
+            if str(entry.origin) == str(entry.destination):
+                continue
+            amount = cls._to_decimal(entry.amount)
+            origin, destination = uuid.UUID(str(entry.origin)), uuid.UUID(str(entry.destination))
+            deltas[origin] = deltas.get(origin, Decimal(0)) - amount
+            deltas[destination] = deltas.get(destination, Decimal(0)) + amount
+
+        account_ids = sorted(deltas)
+        with transaction.atomic():
+            # Self transfers move no money but are still part of the history of their account
+            balance_cache.invalidate(*{account_id for entry in entries for account_id in (entry.origin, entry.destination)})
+            for start in range(0, len(account_ids), batch_size):
+                rows = list(cls.lock(*account_ids[start:start + batch_size]).values())
+                for row in rows:
+                    row.balance += deltas[row.account_id]
+                cls.objects.bulk_update(rows, ["balance"])
+
+    @classmethod
+    def computed_balances(cls, entries: QuerySet = None) -> dict:
+        """Recomputes the balance of every account straight from the `Ledger`, or only from `entries` when set
+
+        Returns a `{account_id: balance}` dict, two grouped aggregate queries are used no matter how many
+        accounts or ledger entries there are.
+        """
+        entries = Ledger.objects.all() if entries is None else entries
+        balances = {}
+        incoming = entries.values("destination").annotate(total=Sum("amount")).order_by()
+        outgoing = entries.values("origin").annotate(total=Sum("amount")).order_by()
+
+        for row in incoming:
+            balances[row["destination"]] = balances.get(row["destination"], Decimal(0)) + row["total"]
+        for row in outgoing:
+            balances[row["origin"]] = balances.get(row["origin"], Decimal(0)) - row["total"]
+
+        return balances
+
+    @classmethod
+    def drift(cls) -> list[dict]:
+        """Compares the materialized balances with a full recompute from the `Ledger`
+
+        Returns a list of `{"account_id": ..., "stored": ..., "computed": ...}` dicts, one for every
+        account where the two disagree. An empty list means there is no drift.
+        """
+        computed = cls.computed_balances()
+        stored = dict(cls.objects.values_list("account_id", "balance"))
+
+        drifted = []
+        for account_id in computed.keys() | stored.keys():
+            stored_balance = stored.get(account_id, Decimal(0))
+            computed_balance = computed.get(account_id, Decimal(0))
+            if stored_balance != computed_balance:
+                drifted.append({"account_id": account_id, "stored": stored_balance, "computed": computed_balance})
+
+        return drifted
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """Throws away every materialized balance and rebuilds them from the `Ledger`
+
+        Returns the amount of balance rows written
+        """
+        computed = cls.computed_balances()
+        with transaction.atomic():
+            balance_cache.invalidate(*computed.keys(), *cls.objects.values_list("account_id", flat=True))
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                [cls(account_id=account_id, balance=balance) for account_id, balance in computed.items()],
+                batch_size=1000,
+            )
+
+        return len(computed)
+
+
+class BalanceCheckpoint(models.Model):
+    """Balance of a single account right before `as_of`, every entry older than `as_of` included
+
+    Checkpoints are written by `write` for the accounts that moved since the previous checkpoint, a while
+    after `as_of` so the transfers saved just before it have committed. Deleting an entry takes it back out
+    of the checkpoints taken after it, see `revert`.
+    """
+    account_id = models.UUIDField(editable=False)
+    as_of = models.DateTimeField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            # Also serves the lookup of the closest checkpoint of an account
+            models.UniqueConstraint(fields=["account_id", "as_of"], name="checkpoint_account_as_of_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["as_of"], name="checkpoint_as_of_idx"),
+        ]
+
+    def __str__(self):
+        return f"account_id: ({self.account_id}) - as_of: ({self.as_of}) - balance: ({self.balance})"
+
+    @classmethod
+    def latest_before(cls, account_ids: list, before: datetime) -> dict:
+        """Returns the balance of the last checkpoint before `before` of every account in `account_ids` that has one
+
+        Returns a `{account_id: balance}` dict, in two queries
+        """
+        latest = (
+            cls.objects.filter(account_id__in=account_ids, as_of__lt=before)
+            .values("account_id").annotate(latest=Max("as_of")).order_by()
+        )
+        condition = Q()
+        for row in latest:
+            condition |= Q(account_id=row["account_id"], as_of=row["latest"])
+        if not condition:
+            return {}
+
+        return dict(cls.objects.filter(condition).values_list("account_id", "balance"))
+
+    @classmethod
+    def write(cls, as_of: datetime, chunk_size: int = 500) -> int:
+        """Writes a checkpoint at `as_of` for every account with entries since the previous checkpoint
+
+        Each new checkpoint is the last one of its account plus the entries since, the current balances are not
+        read so transfers running meanwhile do not matter. Checkpoints already written at `as_of` are replaced.
+        Returns the amount of checkpoints written
+        """
+        with transaction.atomic():
+            cls.objects.filter(as_of=as_of).delete()
+            previous = cls.objects.filter(as_of__lt=as_of).aggregate(previous=Max("as_of"))["previous"]
+            entries = Ledger.objects.filter(timestamp__lt=as_of)
+            if previous is not None:
+                entries = entries.filter(timestamp__gte=previous)
+            movements = AccountBalance.computed_balances(entries)
+
+            account_ids = sorted(movements)
+            for start in range(0, len(account_ids), chunk_size):
+                chunk = account_ids[start:start + chunk_size]
+                bases = cls.latest_before(chunk, as_of)
+                cls.objects.bulk_create(
+                    [cls(account_id=account_id, as_of=as_of, balance=bases.get(account_id, Decimal(0)) + movements[account_id])
+                     for account_id in chunk]
+                )
+
+        return len(account_ids)
+
+    @classmethod
+    def revert(cls, origin: uuid.UUID, destination: uuid.UUID, amount: Decimal, timestamp: datetime):
+        """Takes a deleted entry out of the checkpoints of both accounts taken after it
+        """
+        if str(origin) == str(destination):
+            return
+        cls.objects.filter(account_id=origin, as_of__gt=timestamp).update(balance=F("balance") + amount)
+        cls.objects.filter(account_id=destination, as_of__gt=timestamp).update(balance=F("balance") - amount)
+
+    @classmethod
+    def drift(cls, as_of: datetime) -> list[dict]:
+        """Compares the checkpoints at `as_of` with a full recompute from the `Ledger` of the entries before it
+
+        Returns a list of `{"account_id": ..., "stored": ..., "computed": ...}` dicts, one for every
+        checkpoint that disagrees. An empty list means there is no drift.
+        """
+        computed = AccountBalance.computed_balances(Ledger.objects.filter(timestamp__lt=as_of))
+        drifted = []
+        for account_id, stored in cls.objects.filter(as_of=as_of).values_list("account_id", "balance"):
+            computed_balance = computed.get(account_id, Decimal(0))
+            if stored != computed_balance:
+                drifted.append({"account_id": account_id, "stored": stored, "computed": computed_balance})
+
+        return drifted
+
+
+class Loan(models.Model):
+    """Running state of a loan handed out by the bank, one row per loan entry in the `Ledger`
+
+    The outstanding amount is lowered by every repayment inside the transaction that saves it, and the
+    month-end jobs add what they charge to the accrued interest and fees, so neither has to sum the
+    history of the loan. A loan is `Repaid` once nothing is outstanding.
+
+    `account_id` is the account the loan was paid into, the only account it can be repaid from.
+    """
+    entry = models.OneToOneField('Ledger', primary_key=True, on_delete=models.PROTECT, editable=False, related_name="loan_record")
+    account_id = models.UUIDField(editable=False)
+    principal = models.DecimalField(max_digits=15, decimal_places=2)
+    outstanding = models.DecimalField(max_digits=15, decimal_places=2)
+    accrued_interest = models.DecimalField(max_digits=15, decimal_places=2, default=Decimal(0))
+    accrued_fees = models.DecimalField(max_digits=15, decimal_places=2, default=Decimal(0))
+    status = models.CharField(max_length=6, choices=LoanStatus.choices, default=LoanStatus.OPEN)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["account_id"], name="loan_account_idx"),
+            # The month-end jobs only look at loans that are not repaid
+            models.Index(fields=["status"], name="loan_open_idx", condition=Q(status=LoanStatus.OPEN)),
+        ]
+
+    def __str__(self):
+        return f"loan_id: ({self.entry_id}) - account_id: ({self.account_id}) - principal: ({self.principal}) - outstanding: ({self.outstanding}) - status: ({self.status})"
+
+    @classmethod
+    def open(cls, entry: Ledger) -> 'Loan':
+        """Records the loan paid out by the ledger entry `entry`
+        """
+        return cls.objects.create(entry=entry, account_id=entry.destination, principal=entry.amount, outstanding=entry.amount)
+
+    @classmethod
+    def repay(cls, loan_id: uuid.UUID, amount: Decimal):
+        """Lowers the outstanding amount of `loan_id` by `amount`, a negative amount reverses a repayment
+        """
+        amount = cls._meta.get_field("outstanding").to_python(amount)
+        # The status is computed from the outstanding amount before the update
+        cls.objects.filter(pk=loan_id).update(
+            outstanding=F("outstanding") - amount,
+            status=Case(When(outstanding__lte=amount, then=Value(LoanStatus.REPAID)), default=Value(LoanStatus.OPEN)),
+        )
+
+
+class RecurringPayment(models.Model):
+    """A transfer that is repeated once a month, `remaining_payments` more times
+
+    Schedules are created by `Ledger.transfer_money` when `months` is set, the first payment being the
+    transfer itself. `recusive_payment_task` only picks up the schedules whose `next_run_at` has passed,
+    every execution is recorded as a new `Ledger` entry.
+    """
+    payment_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    origin = models.UUIDField(null=False)
+    destination = models.UUIDField(null=False)
+    loan_id = models.ForeignKey('Ledger', on_delete=models.PROTECT, editable=False, null=True, default=None, related_name="recurring_payments")
+    amount = models.DecimalField(max_digits=15, decimal_places=2)
+    comment = models.CharField(max_length=254, blank=True, null=True)
+    remaining_payments = models.PositiveIntegerField()
+    next_run_at = models.DateTimeField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Only schedules with payments left are indexed, finished ones are never looked at again
+            models.Index(fields=["next_run_at"], name="recurring_due_idx", condition=Q(remaining_payments__gt=0)),
+        ]
+
+    def __str__(self):
+        return f"payment_id: ({self.payment_id}) - origin_id: ({self.origin}) - destination_id: ({self.destination}) - amount: ({self.amount}) - remaining_payments: ({self.remaining_payments}) - next_run_at: ({self.next_run_at})"
+
+    @classmethod
+    def schedule(cls, first_payment: Ledger, months: int) -> 'RecurringPayment':
+        """Repeats `first_payment` once a month for `months` months, starting a month after it was made
+        """
+        return cls.objects.create(
+            origin=first_payment.origin,
+            destination=first_payment.destination,
+            loan_id=first_payment.loan_id,
+            amount=first_payment.amount,
+            comment=first_payment.comment,
+            remaining_payments=months,
+            next_run_at=first_payment.timestamp + relativedelta(months=1),
+        )
+
+    @classmethod
+    def due(cls, now: datetime = None) -> QuerySet:
+        """Returns the schedules with payments left whose `next_run_at` has passed, most overdue first
+        """
+        return cls.objects.filter(remaining_payments__gt=0, next_run_at__lte=now or timezone.now()).order_by("next_run_at")
+
+    def run(self) -> dict:
+        """Makes the next payment of the schedule
+
+        On success the schedule moves a month ahead, if the payment fails (for example on insufficient funds)
+        it is retried on the next run of `recusive_payment_task`. Returns the result of `Ledger.transfer_money`
+        """
+        with transaction.atomic():
+            result = Ledger.transfer_money(
+                origin_id=self.origin,
+                destination_id=self.destination,
+                amount=self.amount,
+                comment=self.comment,
+                loan_id=self.loan_id_id,
+            )
+            if result.get("ok"):
+                self.remaining_payments -= 1
+                # Counted from the planned date and not from now, so late runs do not make the schedule drift
+                self.next_run_at = self.next_run_at + relativedelta(months=1)
+            else:
+                self.next_run_at = timezone.now()
+            self.save(update_fields=["remaining_payments", "next_run_at"])
+
+        return result
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import Counter, deque
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class ProfileStore:
+    """In-process samples of the last `max_samples` requests to every URL name"""
+
+    def __init__(self, max_samples: int):
+        self.max_samples = max_samples
+        self._samples = {}
+        self._requests = Counter()
+        self._duplicates = Counter()
+        # The statement repeated the most in a single request, per URL name
+        self._worst_duplicate = {}
+        self._lock = threading.Lock()
+
+    def record(self, url_name: str, wall_ms: float, queries: int, sql_ms: float, duplicate: tuple = None):
+        with self._lock:
+            if url_name not in self._samples:
+                self._samples[url_name] = deque(maxlen=self.max_samples)
+            self._samples[url_name].append((wall_ms, queries, sql_ms))
+            self._requests[url_name] += 1
+            if duplicate is not None:
+                self._duplicates[url_name] += 1
+                sql, count = duplicate
+                if count > self._worst_duplicate.get(url_name, ("", 0))[1]:
+                    self._worst_duplicate[url_name] = (sql, count)
+
+    def report(self) -> list[dict]:
+        """Returns one row per URL name, slowest p95 first"""
+        with self._lock:
+            samples = {url_name: list(values) for url_name, values in self._samples.items()}
+            requests = dict(self._requests)
+            duplicates = dict(self._duplicates)
+            worst_duplicate = dict(self._worst_duplicate)
+
+        rows = []
+        for url_name, values in samples.items():
+            wall = sorted(value[0] for value in values)
+            queries = sorted(value[1] for value in values)
+            sql = sorted(value[2] for value in values)
+            sql_text, repeated = worst_duplicate.get(url_name, (None, 0))
+            rows.append({
+                "url_name": url_name,
+                "requests": requests[url_name],
+                "samples": len(values),
+                "wall_ms": {name: round(percentile(wall, fraction), 2) for name, fraction in PERCENTILES},
+                "sql_ms": {name: round(percentile(sql, fraction), 2) for name, fraction in PERCENTILES},
+                "queries": {name: percentile(queries, fraction) for name, fraction in PERCENTILES},
+                "duplicate_requests": duplicates.get(url_name, 0),
+                "worst_duplicate": {"sql": sql_text, "count": repeated} if sql_text else None,
+            })
+        return sorted(rows, key=lambda row: row["wall_ms"]["p95"], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._requests.clear()
+            self._duplicates.clear()
+            self._worst_duplicate.clear()
+
+
+store = ProfileStore(settings.PROFILING_SAMPLES)
+
+
+class QueryRecorder:
+    """Database `execute_wrapper` counting the statements of a request and the time spent in them"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # Statements are keyed by their SQL before the parameters are bound, a loop running the same
+        # query for different rows shows up as one statement with a high count
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def worst_duplicate(self, threshold: int):
+        """Returns `(sql, count)` of the statement run most often if it ran `threshold` times or more"""
+        if not self.statements:
+            return None
+        sql, count = self.statements.most_common(1)[0]
+        return (sql, count) if count >= threshold else None
+
+
+class ProfilingMiddleware:
+    """Records the wall time, SQL statement count and SQL time of every request per URL name
+
+    Requests repeating a statement `PROFILING_DUPLICATE_THRESHOLD` times or more (N+1 patterns) are
+    flagged. The numbers are added as a `Server-Timing` header, and aggregated in `store` for the
+    `profiling-report` view. Only loaded when `PROFILING_ENABLED` is set.
+
+    The body of a streaming response (the exports) runs its queries while it is sent, it is measured
+    until the last chunk, and is recorded without a `Server-Timing` header: that is sent before the body.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+
+        if response.streaming:
+            response.streaming_content = self.measured_stream(response.streaming_content, request, recorder, started)
+            return response
+
+        wall_ms, sql_ms = self.record(request, recorder, started)
+        response["Server-Timing"] = f'total;dur={wall_ms:.1f}, sql;dur={sql_ms:.1f};desc="{recorder.count} queries"'
+        return response
+
+    @staticmethod
+    def recording(recorder: QueryRecorder) -> ExitStack:
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    def measured_stream(self, content, request, recorder: QueryRecorder, started: float):
+        """Yields the chunks of a streaming response, counting the statements run to produce them"""
+        try:
+            with self.recording(recorder):
+                yield from content
+        finally:
+            # Also when the client went away and the server closed the stream early
+            self.record(request, recorder, started)
+
+    def record(self, request, recorder: QueryRecorder, started: float) -> tuple[float, float]:
+        wall_ms = (time.perf_counter() - started) * 1000
+        sql_ms = recorder.seconds * 1000
+
+        match = getattr(request, "resolver_match", None)
+        url_name = match.view_name if match else "<unresolved>"
+        duplicate = recorder.worst_duplicate(settings.PROFILING_DUPLICATE_THRESHOLD)
+        store.record(url_name, wall_ms, recorder.count, sql_ms, duplicate)
+
+        if wall_ms >= settings.PROFILING_SLOW_MS:
+            print(f"Slow request {request.method} {request.path} ({url_name}): {wall_ms:.1f} ms, {recorder.count} queries in {sql_ms:.1f} ms")
+        if duplicate is not None:
+            print(f"Repeated statement in {request.method} {request.path} ({url_name}), run {duplicate[1]} times: {duplicate[0][:200]}")
+        return wall_ms, sql_ms
@@ -0,0 +1,137 @@
+import json
+import requests
+from django.db import transaction
+from django.db.models import BigIntegerField, CharField, F, Q, Sum
+from django.db.models.functions import Cast, Round
+from .models import BANK_ACCOUNT_ID, Account, AccountBalance, Ledger
+
+CHUNK_SIZE = 10_000
+# Amounts are summed as integer øre, `Ledger.amount` has two decimal places
+SCALE = 100
+
+
+def _cents(field: str):
+    # Rounded by the database so SQLite's floating point amounts still land on whole øre
+    return Cast(Round(F(field) * SCALE), BigIntegerField())
+
+
+def to_kr(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // SCALE}.{abs(cents) % SCALE:02d}"
+
+
+def net_positions(using: str = "default") -> dict:
+    """Net position in øre of every account in the `Ledger` of the database `using`
+
+    Returns a `{account_id: position}` dict. Like `AccountBalance.computed_balances` the database sums the
+    ledger in two grouped aggregate queries, but over whole øre: SQLite adds decimals up as floating point
+    numbers, integers are summed exactly.
+    """
+    entries = Ledger.objects.using(using).annotate(cents=_cents("amount"))
+    positions = {}
+    for direction, sign in (("destination", 1), ("origin", -1)):
+        totals = entries.values(direction).annotate(total=Sum("cents")).order_by()
+        for row in totals:
+            positions[row[direction]] = positions.get(row[direction], 0) + sign * row["total"]
+    return positions
+
+
+def trial_balance(positions: dict, using: str = "default") -> dict:
+    """Splits the materialized `AccountBalance` rows into the customers, the bank itself and the accounts of
+    other banks, and compares them with the `net_positions` computed from the ledger
+
+    Every ledger entry moves money between two balances, so the stored balances have to add up to zero, a
+    `total` that is not zero means a balance was changed without a ledger entry. `drifted` lists the
+    `(account_id, stored, computed)` that disagree with the ledger.
+    """
+    local_accounts = set(Account.objects.using(using).values_list("account_id", flat=True))
+    bank_account = Account._meta.pk.to_python(BANK_ACCOUNT_ID)
+    totals = {"customers": 0, "bank": 0, "other_banks": 0}
+    drifted = []
+    unseen = dict(positions)
+    stored_balances = AccountBalance.objects.using(using).annotate(cents=_cents("balance")).values_list("account_id", "cents")
+    for account_id, stored in stored_balances.iterator(chunk_size=CHUNK_SIZE):
+        if account_id == bank_account:
+            totals["bank"] += stored
+        elif account_id in local_accounts:
+            totals["customers"] += stored
+        else:
+            totals["other_banks"] += stored
+        position = unseen.pop(account_id, 0)
+        if stored != position:
+            drifted.append((account_id, stored, position))
+    drifted.extend((account_id, 0, position) for account_id, position in unseen.items() if position)
+
+    return {"accounts": len(positions), "total": sum(totals.values()), **totals, "drifted": drifted}
+
+
+def broker_entries(using: str, chunk_size: int = CHUNK_SIZE):
+    """Generator yielding `(transaction_id, origin, destination, amount in øre)` for every ledger entry of the
+    database `using` that involves an account of another bank, ordered by `transaction_id`
+
+    Those entries were created by the transaction broker, which sends each transfer to both banks with the
+    same id. Entries between the accounts of the bank itself, loans included, are left out. The ids are read
+    as text, turning them into `uuid.UUID` objects costs more than the query. Like `export.export_rows` the
+    rows come from a server-side cursor on PostgreSQL, kept open by the transaction.
+    """
+    local_accounts = Account.objects.using(using).values("account_id")
+    entries = (
+        Ledger.objects.using(using)
+        .filter(~Q(origin__in=local_accounts) | ~Q(destination__in=local_accounts))
+        .annotate(
+            id_text=Cast("transaction_id", CharField()),
+            origin_text=Cast("origin", CharField()),
+            destination_text=Cast("destination", CharField()),
+            cents=_cents("amount"),
+        )
+        .order_by("transaction_id")
+        .values_list("id_text", "origin_text", "destination_text", "cents")
+    )
+    with transaction.atomic(using=using):
+        yield from entries.iterator(chunk_size=chunk_size)
+
+
+def to_ndjson(entries):
+    """`broker_entries` as JSON arrays, one per line, the way `remote_broker_entries` reads them"""
+    for entry in entries:
+        yield json.dumps(entry) + "\n"
+
+
+def remote_broker_entries(url: str, host: str = None, token: str = None, timeout: float = 30):
+    """Generator yielding the `broker_entries` of another bank, streamed from its `api/broker-transfers/`
+
+    `url` is the base URL of the bank, `host` the Host header nginx routes the request on and `token` the
+    `RECONCILE_TOKEN` the bank checks. The entries are
+    read line by line as they arrive, like `broker_entries` they are ordered by `transaction_id`. Throws
+    `requests.RequestException` when the bank can not be reached or answers with an error.
+    """
+    headers = {"Host": host} if host else {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    with requests.get(f"{url.rstrip('/')}/api/broker-transfers/", headers=headers, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield tuple(json.loads(line))
+
+
+def diff_broker_entries(ours, theirs):
+    """Merges two streams of `broker_entries` and yields `(transaction_id, our entry, their entry)` for every
+    transfer only one bank has, or that the banks recorded differently
+
+    The entry missing on one side is `None`. Both streams are read once, in order, so only the current entry
+    of each bank is held in memory.
+    """
+    ours, theirs = iter(ours), iter(theirs)
+    our_entry, their_entry = next(ours, None), next(theirs, None)
+    while our_entry is not None or their_entry is not None:
+        if their_entry is None or (our_entry is not None and our_entry[0] < their_entry[0]):
+            yield our_entry[0], our_entry, None
+            our_entry = next(ours, None)
+        elif our_entry is None or their_entry[0] < our_entry[0]:
+            yield their_entry[0], None, their_entry
+            their_entry = next(theirs, None)
+        else:
+            if our_entry[1:] != their_entry[1:]:
+                yield our_entry[0], our_entry, their_entry
+            our_entry, their_entry = next(ours, None), next(theirs, None)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Tunes every new SQLite connection for the rqworker, the cron jobs and the web server sharing one file
+
+    WAL lets readers carry on while a transfer is being written, `busy_timeout` makes writers wait for the
+    lock instead of failing at once, and `synchronous=NORMAL` only syncs to disk at checkpoints, which
+    is still safe against corruption in WAL mode.
+    """
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
@@ -1,72 +1,124 @@
-from .models import Account, Ledger
+from .models import Account, BalanceCheckpoint, Ledger, Loan, LoanStatus, RecurringPayment
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from django.utils import timezone
 from dateutil.relativedelta import relativedelta
+from datetime import datetime, time
 from decimal import *
 from django_rq import job
 
 BANK_ACCOUNT_ID = "5bc6860e-61c2-4427-b9d8-b21c80c8370d"
 
+# Amount of ledger entries read and written per round trip by the monthly jobs
+CHUNK_SIZE = 2000
+
+LATE_FEES = {"Base": Decimal(100), "Silver": Decimal(75), "Gold": Decimal(50)}
+INTEREST_RATES = {"Base": Decimal("0.05"), "Silver": Decimal("0.04"), "Gold": Decimal("0.03")}
+
+
+def overdue_loans():
+    """Returns the `Loan` rows that are over a year old and not repaid, annotated with `customer_rank`
+
+    Only the open loans are read, from their partial index, and the rank of the customer owning the
+    account is looked up by the database, so all the eligible loans come out of a single query.
+    """
+    customer_rank = Account.objects.filter(account_id=OuterRef("account_id")).values("customer__rank")[:1]
+
+    return (
+        Loan.objects.filter(status=LoanStatus.OPEN, entry__timestamp__lte=timezone.now() - relativedelta(years=1))
+        .annotate(customer_rank=Subquery(customer_rank))
+        .only("entry_id", "account_id", "outstanding", "accrued_interest", "accrued_fees")
+        .order_by()
+    )
+
+
+def charge_overdue_loans(charge, comment: str, accrued_field: str) -> int:
+    """Charges every overdue loan's account `charge(customer_rank, outstanding)` for the bank
+
+    The entries are written with `bulk_create`, `CHUNK_SIZE` at a time, and the charged amounts are added
+    to the `accrued_field` of the loans, all inside one transaction so a failing run leaves no partial
+    charges behind. Returns the amount of entries created.
+    """
+    charged = 0
+    with transaction.atomic():
+        entries = []
+        loans = []
+        for loan in overdue_loans().iterator(chunk_size=CHUNK_SIZE):
+            amount = charge(loan.customer_rank, loan.outstanding)
+            entries.append(Ledger(
+                origin=loan.account_id,
+                destination=BANK_ACCOUNT_ID,
+                amount=amount,
+                comment=f"{comment}: {loan.entry_id}",
+            ))
+            setattr(loan, accrued_field, getattr(loan, accrued_field) + amount)
+            loans.append(loan)
+            if len(entries) >= CHUNK_SIZE:
+                charged += len(Ledger.bulk_record(entries, batch_size=CHUNK_SIZE))
+                Loan.objects.bulk_update(loans, [accrued_field], batch_size=CHUNK_SIZE)
+                entries, loans = [], []
+        charged += len(Ledger.bulk_record(entries, batch_size=CHUNK_SIZE))
+        Loan.objects.bulk_update(loans, [accrued_field], batch_size=CHUNK_SIZE)
+
+    return charged
+
+
 @job
 def add_late_fee_task():
-    all_loans = Ledger.objects.filter(origin_id=BANK_ACCOUNT_ID)
-    for ledger in all_loans:
-        if (ledger.timestamp + relativedelta(years=1) <= timezone.now() and ledger.loan_balance(ledger.transaction_id) != 0):
-            customer = Account.objects.get(account_id=ledger.destination).customer
-            fee = 0
-            if (customer.rank == "Base"):
-                fee = 100
-            elif (customer.rank == "Silver"):
-                fee = 75
-            else:
-                fee = 50
-            Ledger.objects.create(
-                origin=ledger.destination,
-                destination=Account.objects.get(pk=BANK_ACCOUNT_ID),
-                amount=fee,
-                comment='Late fee for loan: ' + str(ledger.transaction_id)
-            )
-            print("Late fee added for user " + customer.email + " for loan: " + str(ledger.transaction_id) )
+    charged = charge_overdue_loans(
+        lambda customer_rank, outstanding: LATE_FEES.get(customer_rank, LATE_FEES["Gold"]),
+        comment="Late fee for loan",
+        accrued_field="accrued_fees",
+    )
+    print(f"Late fee added for {charged} loans")
 
 @job
 def add_interest_task():
-    all_loans = Ledger.objects.filter(origin_id=BANK_ACCOUNT_ID)
-    for ledger in all_loans:
-        if (ledger.timestamp + relativedelta(years=1) <= timezone.now() and ledger.loan_balance(ledger.transaction_id) != 0):
-            customer = Account.objects.get(account_id=ledger.destination).customer
-            interest:Decimal = 0.0
-            if (customer.rank == "Base"):
-                interest = 0.05
-            elif (customer.rank == "Silver"):
-                interest = 0.04
-            else:
-                interest = 0.03
-            Ledger.objects.create(
-                destination=Account.objects.get(pk=BANK_ACCOUNT_ID),
-                origin=ledger.destination,
-                amount=ledger.loan_balance(ledger.transaction_id) * Decimal(interest),
-                comment='Interest for loan: ' + str(ledger.transaction_id)
-            )
-            print("Interest added for user " + customer.email + " for loan: " + str(ledger.transaction_id) )
+    charged = charge_overdue_loans(
+        lambda customer_rank, outstanding: (
+            outstanding * INTEREST_RATES.get(customer_rank, INTEREST_RATES["Gold"])
+        ).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP),
+        comment="Interest for loan",
+        accrued_field="accrued_interest",
+    )
+    print(f"Interest added for {charged} loans")
 
 @job
 def recusive_payment_task():
-    all_payments = Ledger.objects.all().exclude(months=0).exclude(months=None)
-    for ledger in all_payments:
-        if (ledger.months == 0 or ledger.months == None or ledger.amount == 0 or ledger.amount == None or Account.objects.get(pk=ledger.origin).balance < ledger.amount):
-            continue
-        try:
-            Ledger.objects.create(
-                origin=ledger.origin,
-                destination=ledger.destination,
-                amount=ledger.amount,
-                comment=ledger.comment,
-                loan_id=ledger.loan_id
-            )
-            ledger.months = ledger.months - 1
-            ledger.save()
-            print("Payment created for account " + Account.objects.get(pk=ledger.origin).account_name+ " for transaction: " + str(ledger.transaction_id) )
-        except Exception as e:
-            print("Payment failed for account " + Account.objects.get(pk=ledger.origin).account_name+ " for transaction: " + str(ledger.transaction_id) )
-            print("ERROR ", e)
-            continue
+    """Makes every recurring payment that is due, each in its own short transaction
+
+    A schedule is claimed with `SKIP LOCKED`, so several workers can run this job at the same time
+    without making the same payment twice. Only the balance rows of that one payment are locked until
+    it commits, so workers and web transfers never wait on a whole batch of payments or deadlock over
+    them. Payments that fail are retried on the next run.
+    """
+    started_at = timezone.now()
+    while True:
+        with transaction.atomic():
+            payment = RecurringPayment.due(now=started_at).select_for_update(skip_locked=True).first()
+            if payment is None:
+                break
+
+            try:
+                result = payment.run()
+            except Exception as e:
+                # Pushed past `started_at` so this run does not pick the schedule up again
+                RecurringPayment.objects.filter(pk=payment.pk).update(next_run_at=timezone.now())
+                result = {"error": "UnknownError", "detail": e}
+
+        if result.get("ok"):
+            print(f"Payment created for account {payment.origin} for schedule: {payment.payment_id}")
+        else:
+            print(f"Payment failed for account {payment.origin} for schedule: {payment.payment_id}")
+            print("ERROR ", result.get("detail"))
+
+
+@job
+def write_balance_checkpoints_task():
+    """Checkpoints the balances of every account that moved, as they were at the start of today
 
+    Scheduled a little after midnight, so the transfers saved right before it have committed.
+    """
+    as_of = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+    written = BalanceCheckpoint.write(as_of)
+    print(f"Balance checkpoints written for {written} accounts as of {as_of}")
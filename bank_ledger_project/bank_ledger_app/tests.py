@@ -1,7 +1,14 @@
+import re
+import threading
 from decimal import Decimal
-from django.test import TestCase
-from .models import Customer, Account, Employee, Ledger
-from .tasks import recusive_payment_task
+from unittest import skipUnless
+from django.conf import settings
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from .models import BANK_ACCOUNT_ID, Customer, Account, Employee, Ledger, AccountBalance, BalanceCheckpoint, Loan, LoanStatus, RecurringPayment
+from . import reconcile
+from .tasks import add_interest_task, add_late_fee_task, recusive_payment_task
 from django_rq import enqueue
 from django_rq import get_worker
 
@@ -229,6 +236,26 @@ class BankLedgerAppTests(TestCase):
         # Assert that it should be an empty array
         assert transaction_history == []
 
+    def test_ledger_history_pages(self):
+        """Walking `history_page` cursors should return every entry exactly once, in the same order as `history`"""
+        customer_one_id = Customer.objects.get(email="customerOne@cust.com").customer_id
+        [account_one, account_two] = Account.objects.filter(customer_id=customer_one_id)
+
+        for amount in range(1, 8):
+            Ledger(origin=account_one.account_id, destination=account_two.account_id, amount=amount).save()
+
+        pages = []
+        entries, cursor = Ledger.history_page(account_one.account_id, page_size=3)
+        pages.append(entries)
+        while cursor:
+            entries, cursor = Ledger.history_page(account_one.account_id, cursor=cursor, page_size=3)
+            pages.append(entries)
+
+        assert [len(page) for page in pages] == [3, 3, 1]
+        full_history = Ledger.history(account_one.account_id)
+        assert [entry for page in pages for entry in page] == full_history
+        assert list(Ledger.iter_history(account_one.account_id, chunk_size=2)) == full_history
+
     def test_account_history_property(self):
         """Test to make sure the `Account.history` property retrieves the correct transaction history from Ledger"""
         # Get a customer ID
@@ -672,6 +699,240 @@ class BankLedgerAppTests(TestCase):
         # Assert that the customer's balance has not changed due to failed repayment
         assert customer_account.balance == 10_000
 
+    def test_account_balance_store_follows_ledger(self):
+        """The materialized `AccountBalance` rows should follow every ledger insert and delete"""
+        (
+            customer_one,
+            _,
+            customer_one_main_account,  # balance: 1000
+            customer_two_main_account,  # balance: 0
+        ) = self.set_up_two_accounts_and_funds()
+
+        result = customer_one.transfer_money(
+            own_account_id=str(customer_one_main_account.account_id),
+            other_account_id=str(customer_two_main_account.account_id),
+            amount=Decimal("250.50"),
+        )
+
+        assert AccountBalance.objects.get(pk=customer_one_main_account.account_id).balance == Decimal("749.50")
+        assert AccountBalance.objects.get(pk=customer_two_main_account.account_id).balance == Decimal("250.50")
+
+        # Deleting the entry (as the broker does on rollback) reverses it
+        Ledger.broker_delete_transaction(result["ok"].transaction_id)
+
+        assert customer_one_main_account.balance == 1000
+        assert customer_two_main_account.balance == 0
+        assert AccountBalance.drift() == []
+
+    def test_account_balance_drift_and_rebuild(self):
+        """`drift()` should report tampered balances and `rebuild()` should fix them"""
+        (_, _, customer_one_main_account, _) = self.set_up_two_accounts_and_funds()
+
+        AccountBalance.objects.filter(pk=customer_one_main_account.account_id).update(balance=5)
+
+        [drifted] = AccountBalance.drift()
+        assert drifted["account_id"] == customer_one_main_account.account_id
+        assert drifted["stored"] == 5
+        assert drifted["computed"] == 1000
+
+        AccountBalance.rebuild()
+
+        assert AccountBalance.drift() == []
+        assert customer_one_main_account.balance == 1000
+
+    def test_ledger_computed_balance_matches_balance(self):
+        """The aggregate `computed_balance` should agree with the materialized balance"""
+        (
+            customer_one,
+            _,
+            customer_one_main_account,  # balance: 1000
+            customer_two_main_account,  # balance: 0
+        ) = self.set_up_two_accounts_and_funds()
+
+        customer_one.transfer_money(
+            own_account_id=str(customer_one_main_account.account_id),
+            other_account_id=str(customer_two_main_account.account_id),
+            amount=Decimal("0.25"),
+        )
+        # An entry from an account to itself does not change its balance
+        Ledger(
+            origin=customer_two_main_account.account_id,
+            destination=customer_two_main_account.account_id,
+            amount=10,
+        ).save()
+
+        assert Ledger.computed_balance(customer_one_main_account.account_id) == Decimal("999.75")
+        assert Ledger.computed_balance(customer_two_main_account.account_id) == Decimal("0.25")
+        assert Ledger.computed_balance(customer_two_main_account.account_id) == customer_two_main_account.balance
+
+    def test_loan_balance_unknown_loan(self):
+        """`loan_balance` should throw `Ledger.DoesNotExist` for an id that is not in the ledger"""
+        import uuid
+
+        with self.assertRaises(Ledger.DoesNotExist):
+            Ledger.loan_balance(loan_id=uuid.uuid4())
+
+    def test_loan_record_follows_repayments(self):
+        """The `Loan` row should follow every repayment, including deleted ones, and only accept its own account"""
+        customer = Customer.objects.get(email="customerOne@cust.com")
+        [main_account, savings_account] = Account.objects.filter(customer_id=customer.customer_id)
+        customer = Employee.objects.all()[0].update_customer_rank(customer.customer_id, "Gold")["ok"]
+
+        loan_id = customer.loan_money(main_account.account_id, 1_000)["ok"].transaction_id
+        loan = Loan.objects.get(pk=loan_id)
+        assert (loan.account_id, loan.principal, loan.outstanding, loan.status) == (main_account.account_id, 1_000, 1_000, LoanStatus.OPEN)
+
+        repayment = customer.pay_loan(main_account.account_id, loan_id, 400)["ok"]
+        assert Ledger.loan_balance(loan_id) == 600
+
+        # Repaying from another account of the customer is refused
+        Ledger.bulk_record([Ledger(origin=BANK_ACCOUNT_ID, destination=savings_account.account_id, amount=1_000)])
+        assert customer.pay_loan(savings_account.account_id, loan_id, 100)["error"] == "InvalidLoan"
+
+        customer.pay_loan(main_account.account_id, loan_id, 600)
+        loan.refresh_from_db()
+        assert (loan.outstanding, loan.status) == (0, LoanStatus.REPAID)
+
+        # Rolling a repayment back opens the loan again
+        Ledger.broker_delete_transaction(repayment.transaction_id)
+        loan.refresh_from_db()
+        assert (loan.outstanding, loan.status) == (400, LoanStatus.OPEN)
+        assert Ledger.loan_balance(loan_id) == Ledger.computed_loan_balance(loan_id)
+
+    def test_pay_loan_database_busy(self):
+        """A repayment losing the SQLite write lock to another request should be refused, not throw"""
+        from unittest import mock
+        from django.db import OperationalError
+
+        customer = Customer.objects.get(email="customerOne@cust.com")
+        main_account = Account.objects.filter(customer_id=customer.customer_id)[0]
+        customer = Employee.objects.all()[0].update_customer_rank(customer.customer_id, "Gold")["ok"]
+        loan_id = customer.loan_money(main_account.account_id, 1_000)["ok"].transaction_id
+
+        busy = OperationalError("database is locked")
+        with mock.patch.object(AccountBalance, "lock", side_effect=busy):
+            result = customer.pay_loan(main_account.account_id, loan_id, 400)
+        assert result["error"] == "DatabaseBusyError"
+        assert Ledger.loan_balance(loan_id) == 1_000
+        assert Loan.objects.get(pk=loan_id).outstanding == 1_000
+
+    def test_customer_loans_constant_queries(self):
+        """`Customer.loans` should cost the same amount of queries for one loan as for many loans and accounts"""
+        customer = Customer.objects.get(email="customerOne@cust.com")
+        [main_account, savings_account] = Account.objects.filter(customer_id=customer.customer_id)
+        customer = Employee.objects.all()[0].update_customer_rank(customer.customer_id, "Gold")["ok"]
+
+        first_loan = customer.loan_money(main_account.account_id, 1_000)["ok"]
+        customer.pay_loan(main_account.account_id, first_loan.transaction_id, 100)
+
+        with CaptureQueriesContext(connection) as one_loan:
+            [loan] = customer.loans
+
+        # One query for the loans and their repaid totals, one for the repayments
+        assert len(one_loan.captured_queries) == 2
+        assert loan["current_balance"] == 900
+        assert len(loan["repayments"]) == 1
+
+        for account in [main_account, savings_account] * 5:
+            new_loan = customer.loan_money(account.account_id, 500)["ok"]
+            customer.pay_loan(account.account_id, new_loan.transaction_id, 200)
+            customer.pay_loan(account.account_id, new_loan.transaction_id, 50)
+
+        with self.assertNumQueries(len(one_loan.captured_queries)):
+            loans = customer.loans
+
+        assert len(loans) == 11
+        assert [loan["current_balance"] for loan in loans] == [900] + [250] * 10
+        assert all(len(loan["repayments"]) == 2 for loan in loans[1:])
+
+    def test_monthly_interest_and_late_fee(self):
+        """Loans older than a year that are not repaid should be charged interest and a late fee based on rank"""
+        from django.utils import timezone
+        from dateutil.relativedelta import relativedelta
+
+        customer = Customer.objects.get(email="customerOne@cust.com")
+        [main_account, savings_account] = Account.objects.filter(customer_id=customer.customer_id)
+        customer = Employee.objects.all()[0].update_customer_rank(customer.customer_id, "Silver")["ok"]
+
+        overdue_loan = customer.loan_money(main_account.account_id, 1_000)["ok"]
+        customer.pay_loan(main_account.account_id, overdue_loan.transaction_id, 333)
+        repaid_loan = customer.loan_money(savings_account.account_id, 500)["ok"]
+        customer.pay_loan(savings_account.account_id, repaid_loan.transaction_id, 500)
+        recent_loan = customer.loan_money(savings_account.account_id, 200)["ok"]
+
+        Ledger.objects.filter(pk__in=[overdue_loan.pk, repaid_loan.pk]).update(
+            timestamp=timezone.now() - relativedelta(years=1, days=1)
+        )
+
+        add_interest_task()
+        add_late_fee_task()
+
+        # Silver: 4% interest on the outstanding 667 and a late fee of 75
+        [interest] = Ledger.objects.filter(comment=f"Interest for loan: {overdue_loan.pk}")
+        [late_fee] = Ledger.objects.filter(comment=f"Late fee for loan: {overdue_loan.pk}")
+        assert interest.amount == Decimal("26.68")
+        assert late_fee.amount == 75
+        assert interest.origin == late_fee.origin == main_account.account_id
+        assert not Ledger.objects.filter(comment__contains=str(repaid_loan.pk)).exclude(loan_id=repaid_loan).exists()
+        assert not Ledger.objects.filter(comment__contains=str(recent_loan.pk)).exists()
+
+        assert main_account.balance == Decimal("1000") - 333 - Decimal("26.68") - 75
+        assert AccountBalance.drift() == []
+
+        loan = Loan.objects.get(pk=overdue_loan.pk)
+        assert (loan.outstanding, loan.accrued_interest, loan.accrued_fees) == (667, Decimal("26.68"), 75)
+        assert Loan.objects.get(pk=repaid_loan.pk).accrued_interest == 0
+
+    def test_recurring_loan_payment(self):
+        """A recurring repayment should be paid once per due run until no payments are left"""
+        from django.utils import timezone
+
+        customer = Customer.objects.get(email="customerTwo@cust.com")
+        [customer_account] = Account.objects.filter(customer_id=customer.customer_id)
+        customer = Employee.objects.all()[0].update_customer_rank(customer.customer_id, "Gold")["ok"]
+
+        loan_id = customer.loan_money(customer_account.account_id, 10_000)["ok"].transaction_id
+        result = customer.pay_loan(customer_account.account_id, loan_id, 100, months=2)
+
+        assert is_ok(result) == True
+        [schedule] = RecurringPayment.objects.all()
+        assert schedule.remaining_payments == 2
+        assert schedule.next_run_at > timezone.now()
+
+        # Nothing is due yet
+        recusive_payment_task()
+        assert Ledger.loan_balance(loan_id) == 9_900
+
+        for expected_balance in [9_800, 9_700, 9_700]:
+            RecurringPayment.objects.update(next_run_at=timezone.now())
+            recusive_payment_task()
+            assert Ledger.loan_balance(loan_id) == expected_balance
+
+        schedule.refresh_from_db()
+        assert schedule.remaining_payments == 0
+        assert customer_account.balance == 9_700
+
+    def test_recurring_payments_committed_one_at_a_time(self):
+        """A schedule that fails should not hold back or roll back the other due schedules"""
+        from django.utils import timezone
+
+        customer = Customer.objects.get(email="customerOne@cust.com")
+        main, savings = Account.objects.filter(customer_id=customer.customer_id).order_by("account_name")
+        Ledger.objects.create(origin=BANK_ACCOUNT_ID, destination=main.account_id, amount=100)
+        schedules = [
+            RecurringPayment.objects.create(origin=main.account_id, destination=savings.account_id, amount=amount, remaining_payments=1, next_run_at=timezone.now())
+            for amount in (10, 1_000, 20)
+        ]
+
+        with CaptureQueriesContext(connection) as context:
+            recusive_payment_task()
+        # One claim per schedule, plus the one finding nothing left
+        claims = [query for query in context.captured_queries if 'FROM "bank_ledger_app_recurringpayment"' in query["sql"] and "LIMIT 1" in query["sql"]]
+        assert len(claims) == 4
+
+        assert [RecurringPayment.objects.get(pk=schedule.pk).remaining_payments for schedule in schedules] == [0, 1, 0]
+        assert savings.balance == 30
+
     # def test_reccursive_payment(self):
     #     customer = Customer.objects.get(email="customerTwo@cust.com")
     #     [customer_account] = Account.objects.filter(
@@ -708,6 +969,257 @@ class BankLedgerAppTests(TestCase):
     #     assert result["ok"]
 
 
+@skipUnless(connection.vendor == "sqlite", "Relies on the output of SQLite's 'EXPLAIN QUERY PLAN'")
+class LedgerIndexTests(TestCase):
+    """Runs the hot ledger queries and asserts that SQLite answers them from an index instead of a full scan"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        user = User.objects.create(username="index_user", password="test_password")
+        self.customer = Customer.objects.create(email="index@cust.com", phone_number="12345678", user=user, rank="Gold")
+        self.account = Account.objects.create(customer=self.customer)
+
+        self.loan = self.customer.loan_money(self.account.account_id, 1_000)["ok"]
+        self.customer.pay_loan(self.account.account_id, self.loan.transaction_id, 100, months=2)
+
+    def assert_ledger_queries_use_indexes(self, function, model=Ledger):
+        table = model._meta.db_table
+        with CaptureQueriesContext(connection) as context:
+            function()
+
+        queries = [
+            query["sql"] for query in context.captured_queries
+            if query["sql"].startswith("SELECT") and f'FROM "{table}"' in query["sql"]
+        ]
+        assert len(queries) > 0
+
+        for sql in queries:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            # Older SQLite versions print 'SCAN TABLE <table>' instead of 'SCAN <table>', the ledger may be joined in
+            full_scans = [
+                step for step in plan
+                if re.match(rf"SCAN (TABLE )?({table}|{Ledger._meta.db_table})\b", step)
+            ]
+            assert full_scans == [], f"Full scan in: {sql}\n{plan}"
+
+    def test_history_uses_index(self):
+        self.assert_ledger_queries_use_indexes(lambda: Ledger.history(self.account.account_id))
+
+    def test_computed_balance_uses_index(self):
+        self.assert_ledger_queries_use_indexes(lambda: Ledger.computed_balance(self.account.account_id))
+
+    def test_loan_balance_uses_index(self):
+        self.assert_ledger_queries_use_indexes(lambda: Ledger.loan_balance(self.loan.transaction_id), model=Loan)
+        self.assert_ledger_queries_use_indexes(lambda: Ledger.computed_loan_balance(self.loan.transaction_id))
+
+    def test_customer_loans_uses_index(self):
+        self.assert_ledger_queries_use_indexes(lambda: self.customer.loans)
+
+    def test_monthly_tasks_use_index(self):
+        self.assert_ledger_queries_use_indexes(add_late_fee_task, model=Loan)
+        self.assert_ledger_queries_use_indexes(add_interest_task, model=Loan)
+
+    def test_recurring_payment_task_uses_index(self):
+        self.assert_ledger_queries_use_indexes(recusive_payment_task, model=RecurringPayment)
+
+
+class TransferViewQueryTests(TestCase):
+    """The transfer views run a fixed number of statements, no matter how many accounts a customer has"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.user = User.objects.create(username="view_user", password="test_password")
+        customer = Customer.objects.create(email="view@cust.com", phone_number="12345678", user=self.user)
+        self.main, self.savings = [Account.objects.create(customer=customer) for _ in range(2)]
+        other_user = User.objects.create(username="other_view_user", password="test_password")
+        other_customer = Customer.objects.create(email="other_view@cust.com", phone_number="12345678", user=other_user)
+        self.other = Account.objects.create(customer=other_customer)
+        Ledger.bulk_record(
+            [Ledger(origin=BANK_ACCOUNT_ID, destination=account.account_id, amount=1000) for account in (self.main, self.savings, self.other)]
+        )
+        self.client.force_login(self.user)
+
+    def post_transfer(self, url_name: str, to_account) -> int:
+        from django.urls import reverse
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                reverse(url_name),
+                {"from_account": self.main.pk, "to_account": to_account.pk, "amount": "10", "comment": "Queries"},
+            )
+        assert response.status_code == 302
+        return len(context.captured_queries)
+
+    def test_transfer_views_constant_queries(self):
+        # Session, user, customer, the form's account lookups, one lookup of both accounts, then the locked write:
+        # locking the balance rows (two statements on SQLite), the ledger INSERT, two balance UPDATEs and the savepoints
+        own_queries = self.post_transfer("bank_ledger_app:own-transfer", self.savings)
+        other_queries = self.post_transfer("bank_ledger_app:other-transfer", self.other)
+        assert own_queries <= 17, own_queries
+        assert other_queries <= 16, other_queries
+
+        for _ in range(5):
+            Account.objects.create(customer=self.main.customer)
+        assert self.post_transfer("bank_ledger_app:own-transfer", self.savings) == own_queries
+        assert self.post_transfer("bank_ledger_app:other-transfer", self.other) == other_queries
+
+        assert self.main.balance == 960
+        assert self.other.balance == 1020
+
+    def get_page(self, url_name: str) -> int:
+        from django.urls import reverse
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(url_name))
+        assert response.status_code == 200
+        return len(context.captured_queries)
+
+    def test_account_dropdowns_constant_queries(self):
+        from django.urls import reverse
+
+        pages = ("bank_ledger_app:own-transfer", "bank_ledger_app:other-transfer", "bank_ledger_app:loan")
+        queries = {url_name: self.get_page(url_name) for url_name in pages}
+        # Session, user, customer and one statement per dropdown
+        assert queries["bank_ledger_app:own-transfer"] <= 5, queries
+
+        for _ in range(5):
+            Account.objects.create(customer=self.main.customer)
+        assert {url_name: self.get_page(url_name) for url_name in pages} == queries
+
+        response = self.client.get(reverse("bank_ledger_app:own-transfer"))
+        self.assertContains(response, f"{self.main.account_name} - 1000.00 kr", count=4)
+        self.assertContains(response, f"{self.main.account_name} - 0.00 kr", count=10)
+
+
+@override_settings(PROFILING_ENABLED=True)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from . import profiling
+
+        profiling.store.clear()
+        self.admin = User.objects.create(username="profiling_admin", is_superuser=True, is_staff=True)
+        for number in range(4):
+            user = User.objects.create(username=f"profiling_employee_{number}")
+            Employee.objects.create(user=user, email=f"employee{number}@work.mail")
+
+    def test_report_per_url_name(self):
+        from django.urls import reverse
+
+        self.client.force_login(self.admin)
+        for _ in range(3):
+            response = self.client.get(reverse("bank_ledger_app:employee-list-info"))
+            assert "sql;dur=" in response["Server-Timing"]
+
+        report = self.client.get(reverse("bank_ledger_app:profiling-report"), {"format": "json"}).json()
+        [row] = [row for row in report["urls"] if row["url_name"] == "bank_ledger_app:employee-list-info"]
+        assert row["requests"] == 3
+        assert set(row["wall_ms"]) == {"p50", "p95", "p99"}
+        # Every employee row loads its user, the same statement is flagged once per request
+        assert row["duplicate_requests"] == 3
+        assert row["worst_duplicate"]["count"] >= 4
+        assert 'FROM "auth_user"' in row["worst_duplicate"]["sql"]
+
+        assert self.client.get(reverse("bank_ledger_app:profiling-report")).status_code == 200
+
+    def test_streaming_response_measured(self):
+        from django.urls import reverse
+        from . import profiling
+
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse("bank_ledger_app:ledger-export"), {"format": "ndjson"})
+        assert response.streaming
+        assert "Server-Timing" not in response
+        # Recorded once the body has been sent, with the queries of the export
+        assert not [row for row in profiling.store.report() if row["url_name"] == "bank_ledger_app:ledger-export"]
+        with CaptureQueriesContext(connection) as queries:
+            b"".join(response.streaming_content)
+
+        [row] = [row for row in profiling.store.report() if row["url_name"] == "bank_ledger_app:ledger-export"]
+        assert row["requests"] == 1
+        assert len(queries) > 0
+        assert row["queries"]["p50"] > len(queries)
+
+    def test_report_is_admin_only(self):
+        from django.contrib.auth.models import User
+        from django.urls import reverse
+
+        self.client.force_login(User.objects.get(username="profiling_employee_0"))
+        response = self.client.get(reverse("bank_ledger_app:profiling-report"), {"format": "json"})
+        assert response.status_code == 302
+
+
+class ConcurrentTransferTests(TransactionTestCase):
+    """Hammers `Ledger.transfer_money` from many threads, each thread using its own database connection"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        user = User.objects.create(username="concurrent_user", password="test_password")
+        customer = Customer.objects.create(email="concurrent@cust.com", phone_number="12345678", user=user)
+        funding = Account.objects.create(customer=customer, account_name="Funding")
+        self.accounts = [Account.objects.create(customer=customer) for _ in range(6)]
+        Ledger.bulk_record(
+            [Ledger(origin=funding.account_id, destination=account.account_id, amount=100) for account in self.accounts]
+        )
+
+    def test_no_overdraft_under_concurrency(self):
+        a, b, c, d, e, f = [account.account_id for account in self.accounts]
+        # Overlapping pairs, a and b pay each other and c, while e pays f on its own
+        pairs = [(a, b), (b, a), (a, c), (b, c), (c, a), (e, f), (e, f), (d, e)]
+        results = []
+        lock = threading.Lock()
+        start = threading.Barrier(len(pairs))
+
+        def hammer(origin, destination):
+            own_results = []
+            start.wait()
+            try:
+                for _ in range(15):
+                    try:
+                        result = Ledger.transfer_money(origin, destination, Decimal(30), "Concurrent")
+                        own_results.append("ok" if "ok" in result else result["error"])
+                    except Exception as error:
+                        own_results.append(repr(error))
+            finally:
+                connections.close_all()
+            with lock:
+                results.extend(own_results)
+
+        threads = [threading.Thread(target=hammer, args=pair) for pair in pairs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == len(pairs) * 15
+        assert set(results) <= {"ok", "InsufficientFunds"}, set(results)
+        for account in self.accounts:
+            assert Ledger.balance(account.account_id) >= 0
+            assert Ledger.computed_balance(account.account_id) >= 0
+        assert AccountBalance.drift() == []
+        # The 600 put in can never have turned into more than 600
+        assert sum(Ledger.balance(account.account_id) for account in self.accounts) == 600
+
+
+@skipUnless(connection.vendor == "sqlite", "The pragmas are only set on SQLite connections")
+class SQLiteConnectionTests(TestCase):
+    def test_connection_pragmas(self):
+        from django.conf import settings
+
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            assert cursor.fetchone()[0] == settings.SQLITE_BUSY_TIMEOUT
+            # 1 is NORMAL
+            cursor.execute("PRAGMA synchronous")
+            assert cursor.fetchone()[0] == 1
+
+
 def is_err(dictionary: dict) -> bool:
     if dictionary.get("ok") == None:
         return True
@@ -720,3 +1232,359 @@ def is_ok(dictionary: dict) -> bool:
         return True
     else:
         return False
+
+
+class BalanceCacheTests(TransactionTestCase):
+    """Balances and history pages are read through the cache outside of transactions, and dropped on every ledger write"""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django.core.cache import cache
+        from . import balance_cache
+
+        cache.clear()
+        balance_cache.stats.clear()
+        user = User.objects.create(username="cache_user", password="test_password")
+        customer = Customer.objects.create(email="cache@cust.com", phone_number="12345678", user=user)
+        self.main, self.savings = [Account.objects.create(customer=customer) for _ in range(2)]
+        Ledger.bulk_record([Ledger(origin=BANK_ACCOUNT_ID, destination=self.main.account_id, amount=100)])
+
+    def test_balance_invalidated_on_commit(self):
+        from . import balance_cache
+
+        assert Ledger.balance(self.main.account_id) == 100
+        with CaptureQueriesContext(connection) as context:
+            assert Ledger.balance(str(self.main.account_id).upper()) == 100
+        assert len(context.captured_queries) == 0
+
+        Ledger.transfer_money(self.main.account_id, self.savings.account_id, Decimal(30), "Cached")
+        assert Ledger.balance(self.main.account_id) == 70
+        assert Ledger.balance(self.savings.account_id) == 30
+        assert balance_cache.stats.report()["balance"] == {"hits": 1, "misses": 3, "waited": 0, "errors": 0, "hit_ratio": 0.25}
+
+    def test_transaction_reads_skip_cache(self):
+        from django.db import transaction
+
+        assert Ledger.balance(self.main.account_id) == 100
+        try:
+            with transaction.atomic():
+                Ledger.transfer_money(self.main.account_id, self.savings.account_id, Decimal(30), "Rolled back")
+                # The transaction sees its own write, which is neither cached nor invalidated before the commit
+                assert Ledger.balance(self.main.account_id) == 70
+                raise RuntimeError("Roll back")
+        except RuntimeError:
+            pass
+        with CaptureQueriesContext(connection) as context:
+            assert Ledger.balance(self.main.account_id) == 100
+        assert len(context.captured_queries) == 0
+
+    def test_history_page_invalidated(self):
+        assert len(Ledger.history_page(self.main.account_id)[0]) == 1
+        with CaptureQueriesContext(connection) as context:
+            assert len(Ledger.history_page(self.main.account_id)[0]) == 1
+        assert len(context.captured_queries) == 0
+
+        entry = Ledger.objects.create(origin=self.main.account_id, destination=self.savings.account_id, amount=5)
+        assert len(Ledger.history_page(self.main.account_id)[0]) == 2
+        assert len(Ledger.history_page(self.savings.account_id)[0]) == 1
+
+        Ledger.broker_delete_transaction(entry.transaction_id)
+        assert len(Ledger.history_page(self.main.account_id)[0]) == 1
+        assert Ledger.balance(self.savings.account_id) == 0
+
+    @override_settings(BALANCE_CACHE_WAIT_MS=2000)
+    def test_stampede_guard_waits_for_other_reader(self):
+        from django.core.cache import cache
+        from . import balance_cache
+
+        # Another reader is filling in the balance, this one waits for its value instead of querying the database
+        account_key = str(self.main.account_id)
+        key = f"ledger:{account_key}:{balance_cache._version(account_key)}:balance:"
+        cache.add(f"{key}:lock", 1)
+        threading.Timer(0.05, lambda: cache.set(key, Decimal(100))).start()
+
+        with CaptureQueriesContext(connection) as context:
+            assert Ledger.balance(self.main.account_id) == 100
+        assert len(context.captured_queries) == 0
+        assert balance_cache.stats.report()["balance"]["waited"] == 1
+
+
+class LedgerExportTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.user = User.objects.create(username="export_user", password="test_password")
+        customer = Customer.objects.create(email="export@cust.com", phone_number="12345678", user=self.user)
+        self.main, self.savings = [Account.objects.create(customer=customer) for _ in range(2)]
+        other_user = User.objects.create(username="other_export_user", password="test_password")
+        self.other = Account.objects.create(customer=Customer.objects.create(email="other_export@cust.com", phone_number="12345678", user=other_user))
+        Ledger.bulk_record([
+            Ledger(origin=BANK_ACCOUNT_ID, destination=self.main.account_id, amount=100, comment="Funding"),
+            Ledger(origin=self.main.account_id, destination=self.savings.account_id, amount="12.50", comment="Saving, with a comma"),
+            Ledger(origin=BANK_ACCOUNT_ID, destination=self.other.account_id, amount=100),
+        ])
+        self.client.force_login(self.user)
+
+    def export(self, url_name: str, *args, **params):
+        from django.urls import reverse
+
+        return self.client.get(reverse(url_name, args=args), params)
+
+    def test_account_export_csv(self):
+        import csv
+
+        response = self.export("bank_ledger_app:account-export", self.main.account_id)
+        assert response.streaming
+        assert response["Content-Type"] == "text/csv"
+        assert response["Content-Disposition"] == f'attachment; filename="account-{self.main.account_id}.csv"'
+        rows = list(csv.DictReader(b"".join(response.streaming_content).decode().splitlines()))
+        # The entries were saved at once, they may share a timestamp
+        rows.sort(key=lambda row: row["amount"])
+        assert [row["amount"] for row in rows] == ["100.00", "12.50"]
+        assert rows[1]["comment"] == "Saving, with a comma"
+        assert rows[1]["origin"] == str(self.main.account_id)
+
+    def test_account_export_ndjson_date_range(self):
+        import json
+        from datetime import timedelta
+        from django.utils import timezone
+
+        today = timezone.localdate()
+        response = self.export("bank_ledger_app:account-export", self.savings.account_id, format="ndjson", start=today.isoformat(), end=today.isoformat())
+        assert response["Content-Type"] == "application/x-ndjson"
+        entries = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        assert [(entry["amount"], entry["loan_id"]) for entry in entries] == [("12.50", None)]
+
+        response = self.export("bank_ledger_app:account-export", self.savings.account_id, format="ndjson", end=(today - timedelta(days=1)).isoformat())
+        assert b"".join(response.streaming_content) == b""
+
+    def test_export_refused(self):
+        assert self.export("bank_ledger_app:account-export", self.other.account_id).status_code == 404
+        assert self.export("bank_ledger_app:account-export", "not-an-account").status_code == 404
+        assert self.export("bank_ledger_app:account-export", self.main.account_id, format="xml").status_code == 400
+        assert self.export("bank_ledger_app:account-export", self.main.account_id, start="2020-13-01").status_code == 400
+        # The whole bank is for employees only
+        assert self.export("bank_ledger_app:ledger-export").status_code == 302
+
+    def test_ledger_export_command(self):
+        import json
+        from io import StringIO
+        from django.core.management import call_command
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.export("bank_ledger_app:ledger-export", format="ndjson")
+        assert len(b"".join(response.streaming_content).decode().splitlines()) == 3
+
+        stdout = StringIO()
+        call_command("export_ledger", "--account", str(self.main.account_id), "--format", "ndjson", "--chunk-size", "1", stdout=stdout, stderr=StringIO())
+        assert sorted(json.loads(line)["comment"] for line in stdout.getvalue().splitlines()) == ["Funding", "Saving, with a comma"]
+
+
+class BalanceCheckpointTests(TestCase):
+    def setUp(self):
+        from datetime import datetime, timedelta
+        from django.contrib.auth.models import User
+        from django.utils import timezone
+
+        user = User.objects.create(username="checkpoint_user", password="test_password")
+        customer = Customer.objects.create(email="checkpoint@cust.com", phone_number="12345678", user=user)
+        self.main, self.savings = [Account.objects.create(customer=customer) for _ in range(2)]
+        self.days = [timezone.make_aware(datetime(2022, 3, day)) for day in range(1, 6)]
+        # Two entries a day, at 10:00 and 14:00, from March 1st to 4th
+        for day in self.days[:4]:
+            for hour, (origin, destination, amount) in ((10, (BANK_ACCOUNT_ID, self.main.account_id, 100)), (14, (self.main.account_id, self.savings.account_id, 30))):
+                entry = Ledger.objects.create(origin=origin, destination=destination, amount=amount)
+                Ledger.objects.filter(pk=entry.pk).update(timestamp=day + timedelta(hours=hour))
+
+    def test_balance_as_of(self):
+        from datetime import timedelta
+
+        assert BalanceCheckpoint.write(self.days[1]) == 3
+        assert BalanceCheckpoint.write(self.days[3]) == 3
+        # Written again, the same checkpoints replace the old ones
+        assert BalanceCheckpoint.write(self.days[3]) == 3
+        assert BalanceCheckpoint.objects.count() == 6
+        assert BalanceCheckpoint.objects.get(account_id=self.main.account_id, as_of=self.days[3]).balance == 210
+
+        for day in self.days:
+            for hours in (0, 12, 20):
+                as_of = day + timedelta(hours=hours)
+                assert Ledger.balance(self.main.account_id, as_of=as_of) == Ledger.computed_balance(self.main.account_id, until=as_of)
+                assert Ledger.balance(self.savings.account_id, as_of=as_of) == Ledger.computed_balance(self.savings.account_id, until=as_of)
+        assert Ledger.balance(self.main.account_id, as_of=self.days[4]) == Ledger.balance(self.main.account_id) == 280
+
+        # The closest checkpoint, then the entries since it
+        with CaptureQueriesContext(connection) as context:
+            assert Ledger.balance(self.main.account_id, as_of=self.days[3] + timedelta(hours=12)) == 310
+        assert len(context.captured_queries) == 2
+
+    def test_deleted_entry_reverted(self):
+        BalanceCheckpoint.write(self.days[1])
+        BalanceCheckpoint.write(self.days[3])
+        entry = Ledger.objects.filter(destination=self.savings.account_id).order_by("timestamp").first()
+        Ledger.broker_delete_transaction(entry.transaction_id)
+
+        assert BalanceCheckpoint.drift(self.days[1]) == []
+        assert BalanceCheckpoint.drift(self.days[3]) == []
+        assert Ledger.balance(self.savings.account_id, as_of=self.days[3]) == 60
+
+    def test_verify_checkpoints_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        BalanceCheckpoint.write(self.days[1])
+        BalanceCheckpoint.write(self.days[3])
+        call_command("verify_checkpoints", "--all", stdout=StringIO())
+
+        BalanceCheckpoint.objects.filter(account_id=self.main.account_id, as_of=self.days[1]).update(balance=0)
+        assert BalanceCheckpoint.drift(self.days[1]) == [{"account_id": self.main.account_id, "stored": 0, "computed": 70}]
+        # Only the latest checkpoints are verified by default
+        call_command("verify_checkpoints", stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command("verify_checkpoints", "--all", stdout=StringIO())
+
+        call_command("verify_checkpoints", "--all", "--rewrite", stdout=StringIO())
+        assert BalanceCheckpoint.drift(self.days[1]) == []
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        import uuid
+        from django.contrib.auth.models import User
+
+        user = User.objects.create(username="reconcile_user", password="test_password")
+        customer = Customer.objects.create(email="reconcile@cust.com", phone_number="12345678", user=user)
+        self.main, self.savings = [Account.objects.create(customer=customer) for _ in range(2)]
+        # An account of the other bank, only known through the transfers of the broker
+        self.external = uuid.uuid4()
+        for origin, destination, amount in (
+            (BANK_ACCOUNT_ID, self.main.account_id, "100.10"),
+            (self.main.account_id, self.savings.account_id, "30.05"),
+            (self.main.account_id, self.external, "20.01"),
+            (self.external, self.savings.account_id, "5.00"),
+        ):
+            Ledger.objects.create(origin=origin, destination=destination, amount=Decimal(amount))
+
+    def test_trial_balance(self):
+        positions = reconcile.net_positions()
+        assert positions[self.main.account_id] == 5004
+        report = reconcile.trial_balance(positions)
+        assert report["accounts"] == 4
+        assert (report["customers"], report["bank"], report["other_banks"], report["total"]) == (8509, -10010, 1501, 0)
+        assert report["drifted"] == []
+
+        AccountBalance.objects.filter(account_id=self.savings.account_id).update(balance=Decimal("35.00"))
+        report = reconcile.trial_balance(reconcile.net_positions())
+        assert report["drifted"] == [(self.savings.account_id, 3500, 3505)]
+        # Changed without a ledger entry, the stored balances no longer add up to zero
+        assert (report["customers"], report["total"]) == (8504, -5)
+
+    def test_diff_broker_entries(self):
+        ours = list(reconcile.broker_entries("default", chunk_size=1))
+        assert sorted(entry[3] for entry in ours) == [500, 2001]
+        assert ours == sorted(ours)
+
+        only_ours, both = ours
+        changed = both[:3] + (both[3] + 1,)
+        # Read from the database, the ids are compared as text
+        only_theirs = ("0" * len(both[0]), str(self.external), str(self.main.account_id), 100)
+        assert list(reconcile.diff_broker_entries(ours, sorted([only_theirs, changed]))) == sorted([
+            (only_theirs[0], None, only_theirs),
+            (only_ours[0], only_ours, None),
+            (both[0], both, changed),
+        ])
+        assert list(reconcile.diff_broker_entries(ours, ours)) == []
+
+    def test_reconcile_command(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        output = StringIO()
+        call_command("reconcile", "--other-database", "", stdout=output)
+        assert "Trial balance: 0.00 kr" in output.getvalue()
+
+        AccountBalance.objects.filter(account_id=self.main.account_id).update(balance=0)
+        with self.assertRaisesRegex(CommandError, "off by -50.04 kr; 1 materialized balance"):
+            call_command("reconcile", "--other-database", "", stdout=StringIO())
+        with self.assertRaisesRegex(CommandError, "different database"):
+            call_command("reconcile", "--other-database", "default", stdout=StringIO())
+
+    def test_reconcile_through_api(self):
+        """The other bank is read from its `api/broker-transfers/` endpoint when no database of it is set"""
+        import json
+        from io import StringIO
+        from unittest import mock
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        with override_settings(RECONCILE_TOKEN="secret"):
+            assert self.client.get("/api/broker-transfers/").status_code == 403
+            assert self.client.get("/api/broker-transfers/", HTTP_AUTHORIZATION="Bearer wrong").status_code == 403
+            response = self.client.get("/api/broker-transfers/", HTTP_AUTHORIZATION="Bearer secret")
+        # Closed while no token is configured
+        assert self.client.get("/api/broker-transfers/", HTTP_AUTHORIZATION="Bearer ").status_code == 403
+        assert response["Content-Type"] == "application/x-ndjson"
+        lines = b"".join(response.streaming_content).splitlines()
+        assert [tuple(json.loads(line)) for line in lines] == list(reconcile.broker_entries("default"))
+
+        # The other bank answers with the same transfers, served by this one
+        other_bank = mock.MagicMock()
+        other_bank.__enter__.return_value.iter_lines.return_value = lines
+        with mock.patch.object(reconcile.requests, "get", return_value=other_bank) as get, override_settings(RECONCILE_TOKEN="secret"):
+            output = StringIO()
+            call_command("reconcile", "--other-database", "", "--other-bank-url", "http://nginx/", stdout=output)
+        assert get.call_args.args == ("http://nginx/api/broker-transfers/",)
+        assert get.call_args.kwargs["headers"] == {"Host": f"{settings.OTHER_BANK_IP}.nginx", "Authorization": "Bearer secret"}
+        assert "Compared the transfers of the broker with http://nginx/" in output.getvalue()
+
+        other_bank.__enter__.return_value.iter_lines.return_value = lines[:1]
+        with mock.patch.object(reconcile.requests, "get", return_value=other_bank):
+            with self.assertRaisesRegex(CommandError, "1 transfer\\(s\\) are missing in http://nginx/"):
+                call_command("reconcile", "--other-database", "", "--other-bank-url", "http://nginx/", stdout=StringIO())
+
+        with mock.patch.object(reconcile.requests, "get", side_effect=reconcile.requests.ConnectionError("refused")):
+            with self.assertRaisesRegex(CommandError, "Could not read the transfers of the broker from http://nginx/"):
+                call_command("reconcile", "--other-database", "", "--other-bank-url", "http://nginx/", stdout=StringIO())
+
+
+@skipUnless("other_bank" in settings.DATABASES, "Needs OTHER_BANK_SQLITE_PATH or OTHER_BANK_POSTGRES_DB for a second bank")
+class ReconcileOtherBankTests(TestCase):
+    # The test runner checks the aliases of skipped tests too
+    databases = {"default", "other_bank"} if "other_bank" in settings.DATABASES else {"default"}
+
+    def test_broker_transfers_compared(self):
+        import uuid
+        from io import StringIO
+        from django.contrib.auth.models import User
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        accounts = {}
+        for database in ("default", "other_bank"):
+            user = User.objects.db_manager(database).create(username="reconcile_user", password="test_password")
+            customer = Customer.objects.using(database).create(email="reconcile@cust.com", phone_number="12345678", user=user)
+            accounts[database] = Account.objects.using(database).create(customer=customer).account_id
+        ours, theirs = accounts["default"], accounts["other_bank"]
+
+        same, only_ours, different = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        for transaction_id, amount in ((same, 20), (only_ours, 7), (different, 3)):
+            Ledger.objects.create(transaction_id=transaction_id, origin=ours, destination=theirs, amount=amount)
+        Ledger.objects.using("other_bank").bulk_create([
+            Ledger(transaction_id=same, origin=ours, destination=theirs, amount=20),
+            Ledger(transaction_id=different, origin=ours, destination=theirs, amount=4),
+            # Only between the accounts of the other bank, never compared
+            Ledger(origin=theirs, destination=theirs, amount=1),
+        ])
+
+        output = StringIO()
+        with self.assertRaisesRegex(CommandError, "1 transfer\\(s\\) are missing in 'other_bank', 0 only exist there and 1 were recorded differently"):
+            call_command("reconcile", stdout=output)
+        # SQLite stores the ids without dashes
+        assert f"{only_ours.hex} (only ours)" in output.getvalue().replace("-", "")
+
+        Ledger.objects.using("other_bank").filter(pk=different).update(amount=3)
+        Ledger.objects.using("other_bank").bulk_create([Ledger(transaction_id=only_ours, origin=ours, destination=theirs, amount=7)])
+        call_command("reconcile", stdout=StringIO())
@@ -10,6 +10,7 @@ urlpatterns = [
     #CUSTOMER
     path('customer/profile-info/<str:pk>/', views.profile_info, name='profile-info'),
     path('customer/account-info/<str:pk>/', views.account_info, name='account-info'),
+    path('customer/account-export/<str:pk>/', views.account_export, name='account-export'),
     path('customer/loan-info/<str:pk>/', views.loan_info, name='loan-info'),
 
     path('customer/loan/', views.loan, name='loan'),
@@ -18,6 +19,7 @@ urlpatterns = [
     path('customer/other-transfer/', views.other_transfer, name='other-transfer'),
 
     # EMPLOYEE
+    path('employee/ledger-export/', views.ledger_export, name='ledger-export'),
     path('employee/customer-list-info/', views.customer_list_info, name='customer-list-info'),
     path('employee/customer-list-partial/', views.customer_list_partial, name='customer-list-partial'), 
     path('employee/customer-profile-info/<str:pk>/', views.customer_profile_info, name='customer-profile-info'),
@@ -31,6 +33,7 @@ urlpatterns = [
     # SUPERUSER
     path('superuser/employee-list-info/', views.employee_list_info, name='employee-list-info'),
     path('superuser/create-employee/', views.create_employee, name='create-employee'),
+    path('superuser/profiling-report/', views.profiling_report, name='profiling-report'),
 
     # API
     path('api/', include('api.urls')),
@@ -1,7 +1,7 @@
 from secrets import token_urlsafe
 from django.shortcuts import render, reverse, redirect
 from django.contrib.auth.models import User
-from .models import Employee, Customer, Account
+from .models import Employee, Customer, Account, Ledger
 from .forms import (
     CreateCustomerForm,
     UpdateCustomerRankForm,
@@ -13,8 +13,11 @@ from .forms import (
     CreateUserForm,
     CreateEmployeeForm,
 )
-from django.http import HttpResponseRedirect
-from django.contrib.auth.decorators import login_required
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.contrib.auth.decorators import login_required, user_passes_test
+from . import balance_cache, export, profiling
 from api.views import create_transaction
 
 
@@ -56,11 +59,46 @@ def profile_info(request, pk):
 
 def account_info(request, pk):
     account = Account.objects.get(account_id=pk)
-    account_history = account.history
-    context = {"account": account, "account_history": account_history}
+    try:
+        account_history, next_cursor = Ledger.history_page(account.account_id, cursor=request.GET.get("after"))
+    except ValueError:
+        # A malformed cursor starts over from the first page
+        account_history, next_cursor = Ledger.history_page(account.account_id)
+    context = {"account": account, "account_history": account_history, "next_cursor": next_cursor}
     return render(request, "bank_ledger_app/customer/account-info.html", context)
 
 
+def account_export(request, pk):
+    """Streams the history of an account, see `ledger_export_response`. Customers may only export their own accounts"""
+    try:
+        account = Account.objects.select_related("customer").filter(account_id=pk).first()
+    except ValidationError:
+        account = None
+    if account is None or not (request.user.is_staff or account.customer.user_id == request.user.id):
+        return JsonResponse({"error": "NotFoundError", "detail": f"Account {pk} was not found"}, status=404)
+    return ledger_export_response(request, account.account_id, f"account-{account.account_id}")
+
+
+def ledger_export_response(request, account_id, file_name: str):
+    """`StreamingHttpResponse` of the ledger entries of `account_id`, or of the whole bank when it is None
+
+    `?format=csv` (default) or `?format=ndjson`, `?start=` and `?end=` are inclusive `YYYY-MM-DD` dates.
+    The rows are written as they are read, the first bytes go out before the whole export has been read.
+    """
+    format_name = request.GET.get("format", "csv")
+    if format_name not in export.FORMATS:
+        return JsonResponse({"error": "InvalidFormatError", "detail": f"Format must be one of: {', '.join(export.FORMATS)}"}, status=400)
+    try:
+        start, end = export.parse_range(request.GET.get("start"), request.GET.get("end"))
+    except ValueError as error:
+        return JsonResponse({"error": "InvalidDateError", "detail": f"Dates must be written as YYYY-MM-DD: {error}"}, status=400)
+
+    to_lines, content_type, extension = export.FORMATS[format_name]
+    response = StreamingHttpResponse(to_lines(export.export_rows(account_id, start, end)), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{file_name}.{extension}"'
+    return response
+
+
 def loan_info(request, pk):
     loan_id = pk
     customer = request.user.customer
@@ -304,6 +342,12 @@ def other_transfer(request):
 ###################################################
 #                 EMPLOYEE
 ###################################################
+@user_passes_test(lambda user: user.is_staff)
+def ledger_export(request):
+    """Streams every entry of the bank, see `ledger_export_response`"""
+    return ledger_export_response(request, None, "ledger")
+
+
 def customer_list_info(request):
     return render(request, "bank_ledger_app/employee/customer-list-info.html")
 
@@ -459,6 +503,17 @@ def employee_list_info(request):
     return render(request, "bank_ledger_app/superuser/employee-list-info.html", context)
 
 
+@user_passes_test(lambda user: user.is_superuser)
+def profiling_report(request):
+    """p50/p95/p99 of the requests per URL name and the balance cache hit ratio, `?format=json` for the raw report"""
+    report = profiling.store.report()
+    cache_report = balance_cache.stats.report()
+    if request.GET.get("format") == "json":
+        return JsonResponse({"enabled": settings.PROFILING_ENABLED, "urls": report, "cache": cache_report})
+    context = {"enabled": settings.PROFILING_ENABLED, "report": report, "cache_report": cache_report}
+    return render(request, "bank_ledger_app/superuser/profiling-report.html", context)
+
+
 def create_employee(request):
     if request.method == "POST":
         user_form = CreateUserForm(request.POST)
@@ -23,6 +23,16 @@ HOST = os.environ.get("SERVER_HOSTNAME") or "localhost"
 SECRET_KEY = 'django-insecure-+^=ss-mqfu&9w!!eongtbylbp3)5_^xx*5cp2#!@n*atu@-ioa'
 OWN_BANK_IP = os.environ.get("SERVER_HOSTNAME") or "localhost"
 OTHER_BANK_IP = os.environ.get("OTHER_BANK_HOST") or "localhost"
+# Responses to broker transfers kept in memory, in front of the `IdempotencyRecord` table
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE") or 10_000)
+# Seconds, also how long other processes may still answer a deleted transfer from their cache
+IDEMPOTENCY_CACHE_TTL = int(os.environ.get("IDEMPOTENCY_CACHE_TTL") or 30)
+# Per-request timing and SQL statement counts, reported per URL name at `superuser/profiling-report/`
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED") == "1"
+PROFILING_SAMPLES = int(os.environ.get("PROFILING_SAMPLES") or 1000)  # Kept per URL name
+PROFILING_SLOW_MS = float(os.environ.get("PROFILING_SLOW_MS") or 500)
+# A request running the same statement this many times is flagged as an N+1 pattern
+PROFILING_DUPLICATE_THRESHOLD = int(os.environ.get("PROFILING_DUPLICATE_THRESHOLD") or 3)
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -61,6 +71,8 @@ CSRF_TRUSTED_ORIGINS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the queries of the other middleware are counted as well
+    'bank_ledger_app.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -105,12 +117,92 @@ WSGI_APPLICATION = 'bank_ledger_project.wsgi.application'
 
 
 
-DATABASES = {
-    'default': {
+# DATABASE_ENGINE picks the backend, "sqlite" (default) or "postgres"
+DATABASE_ENGINE = os.environ.get("DATABASE_ENGINE") or "sqlite"
+
+if DATABASE_ENGINE == "postgres":
+    # Needs the `postgres` extra (psycopg)
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("POSTGRES_DB") or "bank_ledger",
+            'USER': os.environ.get("POSTGRES_USER") or "postgres",
+            'PASSWORD': os.environ.get("POSTGRES_PASSWORD") or "",
+            'HOST': os.environ.get("POSTGRES_HOST") or "localhost",
+            'PORT': os.environ.get("POSTGRES_PORT") or "5432",
+            # Seconds a connection is kept open for the next requests, instead of reconnecting for each of them.
+            # Every worker thread holds its own connection, to share fewer server connections between all the
+            # processes point POSTGRES_HOST/POSTGRES_PORT at PgBouncer in transaction pooling mode
+            'CONN_MAX_AGE': int(os.environ.get("DATABASE_CONN_MAX_AGE") or 60),
+            # A connection dropped by the server (or PgBouncer) is replaced at the start of the next request
+            'CONN_HEALTH_CHECKS': True,
+            # Set DATABASE_PGBOUNCER=1 behind PgBouncer's transaction pooling, which cannot keep the server-side
+            # cursors of `.iterator()` (exports, reconcile) open, those results are then read in full by the client
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get("DATABASE_PGBOUNCER") == "1",
+            'OPTIONS': {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("SQLITE_PATH") or os.path.join(BASE_DIR, 'database/db.sqlite3'),
+            # A file instead of the shared in-memory database, which fails concurrent writers at once
+            # ("database table is locked") instead of letting them wait on `busy_timeout`
+            'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+        }
+    }
+
+# Base URL the `reconcile` command reads the transfers of the broker of the other bank from, its API is reached
+# through nginx like the broker does, on the host "<OTHER_BANK_HOST>.nginx"
+OTHER_BANK_API_URL = os.environ.get("OTHER_BANK_API_URL")
+# Shared by both banks, `api/broker-transfers/` only answers requests carrying it as "Authorization: Bearer <token>".
+# The endpoint is closed while it is unset
+RECONCILE_TOKEN = os.environ.get("RECONCILE_TOKEN")
+
+# Database of the other bank, read by the `reconcile` command instead of its API, when both run on one machine.
+# Same engine and credentials as `default`, OTHER_BANK_POSTGRES_DB/OTHER_BANK_POSTGRES_HOST or
+# OTHER_BANK_SQLITE_PATH point it at the other bank
+if DATABASE_ENGINE == "postgres" and os.environ.get("OTHER_BANK_POSTGRES_DB"):
+    DATABASES['other_bank'] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get("OTHER_BANK_POSTGRES_DB"),
+        'HOST': os.environ.get("OTHER_BANK_POSTGRES_HOST") or DATABASES['default']['HOST'],
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {},
+    }
+elif DATABASE_ENGINE != "postgres" and os.environ.get("OTHER_BANK_SQLITE_PATH"):
+    DATABASES['other_bank'] = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'database/db.sqlite3'),
+        'NAME': os.environ.get("OTHER_BANK_SQLITE_PATH"),
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_other_bank.sqlite3')},
     }
-}
+
+# Milliseconds a SQLite connection waits for the write lock before failing with "database is locked",
+# set with the other pragmas in `bank_ledger_app.signals`
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5000)
+
+# Balances and account histories are cached in Redis when CACHE_URL is set (redis://host:port/db),
+# in the memory of every process otherwise. Both banks may share one Redis, the keys are prefixed with the host
+CACHE_URL = os.environ.get("CACHE_URL")
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+            'KEY_PREFIX': HOST,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+BALANCE_CACHE_TTL = int(os.environ.get("BALANCE_CACHE_TTL") or 300)  # Seconds
+# While one reader fills in a missing entry the others wait up to this long for it, then query the database
+BALANCE_CACHE_WAIT_MS = int(os.environ.get("BALANCE_CACHE_WAIT_MS") or 200)
+BALANCE_CACHE_LOCK_TIMEOUT = 5  # Seconds, frees the entry of a reader that died while filling it in
 
 RQ_QUEUES = {
     'default': {
@@ -167,7 +259,9 @@ STATICFILES_DIRS = [
 CRONJOBS = [
     ('0 0 1 * *', 'bank_ledger_app.cron.add_late_fee', '>> /tmp/add_late_fee.log'),
     ('0 0 1 * *', 'bank_ledger_app.cron.add_interest', '>> /tmp/add_interest.log'),
-    ('* * * * *', 'bank_ledger_app.cron.recusive_payment', '>> /tmp/recusive_payment.log')
+    ('* * * * *', 'bank_ledger_app.cron.recusive_payment', '>> /tmp/recusive_payment.log'),
+    ('15 0 * * *', 'bank_ledger_app.cron.write_balance_checkpoints', '>> /tmp/write_balance_checkpoints.log'),
+    ('30 2 * * *', 'bank_ledger_app.cron.reconcile', '>> /tmp/reconcile.log 2>&1'),
 ]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
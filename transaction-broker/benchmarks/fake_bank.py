@@ -0,0 +1,123 @@
+#!/bin/env python3
+"""Stand-in for the `api` endpoints of a bank, used to benchmark the broker without the Django stack
+
+Every bank host is served by the same process and every account exists with a large balance.
+`--delay-ms` adds an artificial delay to every response to mimic a slow bank, `--bank-delay` overrides
+it for a single bank, picked from the `Host` header the broker sends (`<bank ip>.nginx`).
+`--failing-bank` makes a bank refuse every transfer.
+
+    python benchmarks/fake_bank.py --port 8090 --delay-ms 20 --bank-delay 10.0.0.3=200
+"""
+import argparse
+import asyncio
+import json
+from fastapi import FastAPI, Request, Response
+import uvicorn
+
+bank = FastAPI()
+bank.state.delay = 0.0
+bank.state.bank_delays = {}
+bank.state.failing_banks = set()
+bank.state.ledger = {}
+# Transfers received per bank, deletes do not lower it
+bank.state.received = {}
+
+
+def _bank_ip(request: Request) -> str:
+    return request.headers.get("host", "").removesuffix(".nginx")
+
+
+async def _delay(request: Request):
+    bank_ip = _bank_ip(request)
+    delay = bank.state.bank_delays.get(bank_ip, bank.state.delay)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+async def _parse_transfer(request: Request) -> dict:
+    # The broker sends the transfer as a JSON encoded string inside the JSON body
+    body = await request.json()
+    return json.loads(body) if isinstance(body, str) else body
+
+
+@bank.get("/api/balance/{account_id}")
+@bank.get("/api/balance/{account_id}/")
+async def balance(account_id: str, request: Request):
+    await _delay(request)
+    return {"ok": 1_000_000}
+
+
+@bank.post("/api/transfer-funds/")
+async def transfer_funds(request: Request):
+    await _delay(request)
+    if _bank_ip(request) in bank.state.failing_banks:
+        return Response('{"error": "UnexpectedError"}', status_code=500, media_type="application/json")
+    transfer = await _parse_transfer(request)
+    bank.state.ledger.setdefault(_bank_ip(request), {})[transfer["transaction_id"]] = transfer
+    bank.state.received[_bank_ip(request)] = bank.state.received.get(_bank_ip(request), 0) + 1
+    return {"ok": json.dumps(transfer)}
+
+
+@bank.post("/api/transfer-funds/batch/")
+async def transfer_funds_batch(request: Request):
+    await _delay(request)
+    if _bank_ip(request) in bank.state.failing_banks:
+        return Response('{"error": "UnexpectedError"}', status_code=500, media_type="application/json")
+    ledger = bank.state.ledger.setdefault(_bank_ip(request), {})
+    results = []
+    transfers = await request.json()
+    bank.state.received[_bank_ip(request)] = bank.state.received.get(_bank_ip(request), 0) + len(transfers)
+    for transfer in transfers:
+        ledger[transfer["transaction_id"]] = transfer
+        results.append({"transaction_id": transfer["transaction_id"], "ok": "Transaction saved"})
+    return {"ok": results}
+
+
+@bank.get("/_fake/stats")
+async def stats():
+    return {
+        "transfers": {bank_ip: len(ledger) for bank_ip, ledger in bank.state.ledger.items()},
+        "received": bank.state.received,
+    }
+
+
+@bank.delete("/api/transaction/{transaction_id}")
+@bank.delete("/api/transaction/{transaction_id}/")
+async def delete_transaction(transaction_id: str, request: Request):
+    await _delay(request)
+    if bank.state.ledger.get(_bank_ip(request), {}).pop(transaction_id, None) is None:
+        return {"ok": "Transaction does not exist"}
+    return {"ok": "Transaction has been deleted"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Delay added to every response")
+    parser.add_argument(
+        "--bank-delay",
+        action="append",
+        default=[],
+        metavar="IP=MS",
+        help="Delay added to the responses of a single bank, can be given more than once",
+    )
+    parser.add_argument(
+        "--failing-bank",
+        action="append",
+        default=[],
+        metavar="IP",
+        help="Bank that refuses every transfer, to exercise the rollbacks of the broker",
+    )
+    args = parser.parse_args()
+
+    bank.state.delay = args.delay_ms / 1000
+    for bank_delay in args.bank_delay:
+        bank_ip, delay_ms = bank_delay.split("=")
+        bank.state.bank_delays[bank_ip] = float(delay_ms) / 1000
+    bank.state.failing_banks = set(args.failing_bank)
+    uvicorn.run(bank, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/bin/env python3
+"""Fires concurrent transfers at a running broker and reports the achieved transfers/second and latencies
+
+Start a stand-in bank and the broker pointed at it first, for example:
+
+    python benchmarks/fake_bank.py --port 8090
+    BANK_GATEWAY_URL=http://127.0.0.1:8090 BROKER_PORT=3000 BROKER_HOST=127.0.0.1 RELOAD_UVICORN=0 python main.py
+    python benchmarks/load_test.py --broker-url http://127.0.0.1:3000 --transfers 2000 --concurrency 50
+
+The broker answers once a transfer is accepted and commits it in the background, pass `--fake-bank-url`
+to also wait until the fake bank has received every transfer and report the committed transfers/second.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+from uuid import uuid4
+import httpx
+
+
+def transfer_payload(own_bank_ip: str, other_bank_ip: str) -> dict:
+    return {
+        "transaction_id": str(uuid4()),
+        "own_bank_ip": own_bank_ip,
+        "other_bank_ip": other_bank_ip,
+        "own_account_id": str(uuid4()),
+        "other_account_id": str(uuid4()),
+        "amount": "1.00",
+        "comment": "load test",
+    }
+
+
+async def committed_transfers(fake_bank_url: str) -> int:
+    async with httpx.AsyncClient(base_url=fake_bank_url) as client:
+        response = await client.get("/_fake/stats")
+    return min(response.json()["received"].values(), default=0)
+
+
+async def run(
+    broker_url: str,
+    transfers: int,
+    concurrency: int,
+    own_bank_ip: str,
+    other_bank_ip: str,
+    fake_bank_url: str | None = None,
+) -> dict:
+    latencies = []
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=broker_url, timeout=120, limits=limits) as client:
+        async def one_transfer():
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post("/transaction", json=transfer_payload(own_bank_ip, other_bank_ip))
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as error:
+                    statuses[type(error).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        committed_before = await committed_transfers(fake_bank_url) if fake_bank_url else 0
+        started = time.perf_counter()
+        await asyncio.gather(*(one_transfer() for _ in range(transfers)))
+        elapsed = time.perf_counter() - started
+
+        committed_elapsed = None
+        if fake_bank_url:
+            accepted = sum(count for status, count in statuses.items() if status in (200, 202))
+            while await committed_transfers(fake_bank_url) - committed_before < accepted:
+                if time.perf_counter() - started > 120:
+                    break
+                await asyncio.sleep(0.01)
+            committed_elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "transfers": transfers,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "transfers_per_s": round(transfers / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "statuses": dict(statuses),
+    }
+    if committed_elapsed:
+        result["committed_per_s"] = round(transfers / committed_elapsed, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker-url", default="http://127.0.0.1:3000")
+    parser.add_argument("--transfers", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--own-bank-ip", default="long-shire")
+    parser.add_argument("--other-bank-ip", default="goldman-sherbert")
+    parser.add_argument("--fake-bank-url", default=None, help="Fake bank to poll for the committed transfers")
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        print(asyncio.run(run(
+            args.broker_url, args.transfers, concurrency, args.own_bank_ip, args.other_bank_ip, args.fake_bank_url
+        )))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,30 @@ _secrets = {
 }
 
 
+# Optional tuning knobs, these fall back to a default instead of being required
+_settings = {
+    "BANK_GATEWAY_URL": _envs.get("BANK_GATEWAY_URL") or os.environ.get("BANK_GATEWAY_URL") or "http://nginx",
+    "HTTP_POOL_SIZE": _envs.get("HTTP_POOL_SIZE") or os.environ.get("HTTP_POOL_SIZE") or "100",
+    "HTTP_KEEPALIVE_SIZE": _envs.get("HTTP_KEEPALIVE_SIZE") or os.environ.get("HTTP_KEEPALIVE_SIZE") or "20",
+    "HTTP_CONNECT_TIMEOUT": _envs.get("HTTP_CONNECT_TIMEOUT") or os.environ.get("HTTP_CONNECT_TIMEOUT") or "1",
+    "HTTP_TIMEOUT": _envs.get("HTTP_TIMEOUT") or os.environ.get("HTTP_TIMEOUT") or "5",
+    "BALANCE_DEADLINE": _envs.get("BALANCE_DEADLINE") or os.environ.get("BALANCE_DEADLINE") or "2",
+    "COMMIT_DEADLINE": _envs.get("COMMIT_DEADLINE") or os.environ.get("COMMIT_DEADLINE") or "10",
+    "BREAKER_FAILURE_THRESHOLD": _envs.get("BREAKER_FAILURE_THRESHOLD") or os.environ.get("BREAKER_FAILURE_THRESHOLD") or "5",
+    "COMMIT_BATCH_SIZE": _envs.get("COMMIT_BATCH_SIZE") or os.environ.get("COMMIT_BATCH_SIZE") or "100",
+    "COMMIT_BATCH_LINGER_MS": _envs.get("COMMIT_BATCH_LINGER_MS") or os.environ.get("COMMIT_BATCH_LINGER_MS") or "5",
+    "SAGA_LOG_PATH": _envs.get("SAGA_LOG_PATH") or os.environ.get("SAGA_LOG_PATH") or "transfers.sqlite3",
+    "RECONCILE_INTERVAL": _envs.get("RECONCILE_INTERVAL") or os.environ.get("RECONCILE_INTERVAL") or "5",
+    "RECONCILE_MAX_DELAY": _envs.get("RECONCILE_MAX_DELAY") or os.environ.get("RECONCILE_MAX_DELAY") or "300",
+    "BREAKER_RESET_TIMEOUT": _envs.get("BREAKER_RESET_TIMEOUT") or os.environ.get("BREAKER_RESET_TIMEOUT") or "10",
+    "EVENT_LOOP_LAG_INTERVAL": _envs.get("EVENT_LOOP_LAG_INTERVAL") or os.environ.get("EVENT_LOOP_LAG_INTERVAL") or "0.5",
+}
+
+
+def get_setting(setting: str) -> str:
+    return _settings[setting]
+
+
 def get_env(env: str) -> str:
     if _secrets[env] is not None:
         return _secrets[env]  # type: ignore | can only be str
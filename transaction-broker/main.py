@@ -1,18 +1,28 @@
 #!/bin/env python3
-from config.secrets import get_env, validate_envs
+from config.secrets import get_env, get_setting, validate_envs
 from fastapi.middleware.cors import CORSMiddleware
 from models.objects import TransactionPostObject, TransactionRequestObject
 from utility.logger import log
+from utility.retry import RetryPolicy, retry_metrics
+from utility.batching import batch_metrics, submit_transfer
+from utility.metrics import IN_FLIGHT, ROLLBACKS, TRANSFER_DURATION, monitor_event_loop_lag, registry, since
 from utility.functions import (
-    create_transfer,
+    BankCallError,
+    close_http_client,
     delete_transfer,
-    function_with_retries,
     get_account_balance,
+    get_http_client,
+    run_concurrently,
+    with_deadline,
 )
+from utility.saga import COMMITTED, COMPENSATED, COMPENSATING, PENDING, SagaLog
 from fastapi import FastAPI, Response, HTTPException
 import uvicorn
-from uuid import uuid4
-from requests.models import Response as Res
+import asyncio
+import sqlite3
+import time
+from uuid import UUID, uuid4
+from httpx import Response as Res
 from ipaddress import ip_address
 
 server = FastAPI()
@@ -24,6 +34,56 @@ server.add_middleware(
     allow_headers=["*"],
 )
 
+# Commits are retried quickly, they have to fit in the commit deadline
+commit_retry = RetryPolicy(
+    "commit", attempts=3, base_delay=0.5, max_delay=2, deadline=float(get_setting("COMMIT_DEADLINE"))
+)
+# Rollbacks keep trying for longer, a bank left with half a transaction is worse than a slow reply
+rollback_retry = RetryPolicy("rollback", attempts=5, base_delay=1, max_delay=5, deadline=25)
+
+
+# Durable log of every transfer, opened on startup
+saga_log: SagaLog
+# Ids of the transfers this process is committing or compensating right now
+_in_flight: set[str] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+@server.on_event("startup")
+async def open_bank_connections():
+    global saga_log
+    get_http_client()
+    saga_log = SagaLog(get_setting("SAGA_LOG_PATH"))
+    IN_FLIGHT.function = lambda: len(_in_flight)
+    server.state.reconciler = asyncio.create_task(reconcile_forever())
+    server.state.lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+
+
+@server.on_event("shutdown")
+async def close_bank_connections():
+    server.state.reconciler.cancel()
+    server.state.lag_monitor.cancel()
+    if _background_tasks:
+        # Give the transfers in flight a chance to finish, the reconciler picks up whatever is left after a restart
+        await asyncio.wait(_background_tasks, timeout=float(get_setting("COMMIT_DEADLINE")))
+    await close_http_client()
+    saga_log.close()
+
+
+@server.get("/retries")
+def retries():
+    return retry_metrics(commit_retry, rollback_retry)
+
+
+@server.get("/batches")
+def batches():
+    return batch_metrics()
+
+
+@server.get("/metrics")
+def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
 
 @server.get("/balance")
 def temp():
@@ -32,8 +92,9 @@ def temp():
     return {"balance": decimal.Decimal(100.00)}
 
 
-@server.post("/transaction")
+@server.post("/transaction", status_code=202)
 async def incoming_transaction(payload: TransactionRequestObject):
+    received = time.monotonic()
     log.info(f"Received a request on /transaction with the payload: {payload}")
 
     # Validate amount
@@ -47,8 +108,22 @@ async def incoming_transaction(payload: TransactionRequestObject):
         )
 
     # Get both account balances, this ensures that both banks are online and both accounts exist
-    own_balance: Res = get_account_balance(payload.own_bank_ip, payload.own_account_id)
-    other_balance: Res = get_account_balance(payload.other_bank_ip, payload.other_account_id)
+    # Both banks are asked at the same time, if one of them fails the other request is cancelled
+    balance_deadline = float(get_setting("BALANCE_DEADLINE"))
+    own_balance: Res
+    other_balance: Res
+    own_balance, other_balance = await run_concurrently(
+        with_deadline(
+            get_account_balance(payload.own_bank_ip, payload.own_account_id),
+            deadline=balance_deadline,
+            bank_ip=payload.own_bank_ip,
+        ),
+        with_deadline(
+            get_account_balance(payload.other_bank_ip, payload.other_account_id),
+            deadline=balance_deadline,
+            bank_ip=payload.other_bank_ip,
+        ),
+    )
 
     log.debug(f"Balance One: {own_balance}")
     log.debug(f"Balance Two: {other_balance}")
@@ -81,69 +156,140 @@ async def incoming_transaction(payload: TransactionRequestObject):
         destination_id=payload.other_account_id,
         comment=payload.comment,
     )
-    transaction_result_one: dict["str", "str"]
-    transaction_result_two: dict["str", "str"]
-
-    # Flag for failed transaction
-    transaction_failed = False
-
-    # Attempt to make the transaction on both banks
-    # will try to do it 3 times, then consider it failed if no replies
-    transaction_result_one = function_with_retries(
-        delay=2,
-        retries=3,
-        function=lambda: create_transfer(
-            transfer_obj=transaction_obj, bank_ip=payload.own_bank_ip
-        ),
-    )
-    transaction_result_two = function_with_retries(
-        delay=2,
-        retries=3,
-        function=lambda: create_transfer(
-            transfer_obj=transaction_obj, bank_ip=payload.other_bank_ip
-        ),
-    )
-    if transaction_result_one.get("error") or transaction_result_two.get("error"):
-        # TODO: figure out how to reply before doing this...
-        print("A transaction has failed, undoing...")
-
-        # send delete request with the transaction_id to both banks
-        # Does nothing if not found, deletes if it does exist
-        transaction_failed = True
-        result_one = function_with_retries(
-            delay=5,
-            retries=5,
-            function=lambda: delete_transfer(
-                payload.transaction_id, bank_ip=payload.own_bank_ip
-            ),
-        )  # total time = 25 seconds
-        result_two = function_with_retries(
-            delay=5,
-            retries=5,
-            function=lambda: delete_transfer(
-                payload.transaction_id, bank_ip=payload.other_bank_ip
-            ),
-        )  # total time = 25 seconds
-
-        print(result_one)  # TODO: do something with this.
-        print(result_two)  # TODO: do something with this.
-
-    if transaction_failed:  # TODO: find out how to do this sooner.
+    # Record the transfer before touching the banks, so it can be cleaned up even if the broker dies midway
+    try:
+        await saga_log.begin(transaction_obj, payload.own_bank_ip, payload.other_bank_ip)
+    except sqlite3.IntegrityError:
         raise HTTPException(
-            status_code=503,
-            detail=f"One or more banks are unavailable right now, transaction has been cancelled, and any pending transaction have been deleted.",
+            status_code=409,
+            detail=f"Transaction '{payload.transaction_id}' has already been received.",
         )
 
-    # TODO: parse responses for correctness
-    print("Transaction One: ", transaction_result_one)
-    print("Transaction Two: ", transaction_result_two)
+    # The banks are committed to (or compensated) in the background, the caller can follow it on status_url
+    task = asyncio.create_task(
+        commit_transfer(transaction_obj, payload.own_bank_ip, payload.other_bank_ip, received)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
     return {
-        "status": "success",
-        "transactions": [transaction_result_one, transaction_result_two],
+        "status": "accepted",
+        "transaction_id": str(payload.transaction_id),
+        "status_url": f"/transaction/{payload.transaction_id}",
     }
 
 
+@server.get("/transaction/{transaction_id}")
+async def transaction_status(transaction_id: UUID):
+    transfer = await saga_log.get(str(transaction_id))
+    if transfer is None:
+        raise HTTPException(
+            status_code=404, detail=f"Transaction '{transaction_id}' was not found."
+        )
+    return transfer
+
+
+async def commit_transfer(transaction_obj: TransactionPostObject, own_bank_ip: str, other_bank_ip: str, received: float):
+    """Commits the transfer on both banks, `received` is when the broker got it (time.monotonic)"""
+    transaction_id = str(transaction_obj.transaction_id)
+    _in_flight.add(transaction_id)
+    try:
+        async def commit_on(bank_ip: str) -> dict:
+            # will try to do it 3 times, then consider it failed if no replies
+            result = await with_deadline(
+                commit_retry.run(
+                    bank_ip,
+                    lambda: submit_transfer(transaction_obj, bank_ip=bank_ip),
+                ),
+                deadline=float(get_setting("COMMIT_DEADLINE")),
+                bank_ip=bank_ip,
+            )
+            if result.get("error"):
+                raise BankCallError(bank_ip, result)
+            return result
+
+        # Attempt to make the transaction on both banks at the same time
+        # if one of them fails, the commit still running on the other bank is cancelled
+        try:
+            transaction_result_one, transaction_result_two = await run_concurrently(
+                commit_on(own_bank_ip),
+                commit_on(other_bank_ip),
+            )
+        except (BankCallError, HTTPException) as error:
+            log.error(f"Transaction '{transaction_id}' has failed, undoing... {error}")
+            await saga_log.move(transaction_id, COMPENSATING, error=str(error))
+            await compensate_transfer(transaction_id, own_bank_ip, other_bank_ip, attempts=1)
+            TRANSFER_DURATION.observe(since(received), outcome="rolled_back")
+            return
+
+        log.info(f"Transaction '{transaction_id}' committed: {transaction_result_one}, {transaction_result_two}")
+        await saga_log.move(transaction_id, COMMITTED)
+        TRANSFER_DURATION.observe(since(received), outcome="committed")
+    finally:
+        _in_flight.discard(transaction_id)
+
+
+async def compensate_transfer(transaction_id: str, own_bank_ip: str, other_bank_ip: str, attempts: int):
+    """Deletes the transfer on both banks, on failure the reconciler tries again later with a growing delay"""
+    # Does nothing if not found, deletes if it does exist
+    results = await asyncio.gather(
+        rollback_retry.run(
+            own_bank_ip,
+            lambda: delete_transfer(transaction_id, bank_ip=own_bank_ip),
+        ),
+        rollback_retry.run(
+            other_bank_ip,
+            lambda: delete_transfer(transaction_id, bank_ip=other_bank_ip),
+        ),
+    )  # at most 25 seconds
+    errors = [str(result["error"]) for result in results if result.get("error")]
+    if errors:
+        ROLLBACKS.inc(outcome="deferred")
+        interval = float(get_setting("RECONCILE_INTERVAL"))
+        await saga_log.move(
+            transaction_id,
+            COMPENSATING,
+            error="; ".join(errors),
+            retry_in=min(interval * 2 ** attempts, float(get_setting("RECONCILE_MAX_DELAY"))),
+        )
+    else:
+        ROLLBACKS.inc(outcome="done")
+        log.info(f"Transaction '{transaction_id}' has been deleted on both banks")
+        await saga_log.move(transaction_id, COMPENSATED)
+
+
+async def reconcile():
+    """Drives every unfinished transfer left in the log to compensation"""
+    # A pending transfer that has not moved for this long is not being committed by anyone anymore
+    stale_before = time.time() - 2 * float(get_setting("COMMIT_DEADLINE"))
+    for transfer in await saga_log.due(stale_before=stale_before):
+        transaction_id = transfer["transaction_id"]
+        if transaction_id in _in_flight:
+            continue
+        if transfer["state"] == PENDING:
+            # The broker stopped while committing it, so there is no telling which banks have it
+            await saga_log.move(
+                transaction_id, COMPENSATING, error="Transfer was left pending by a previous run of the broker"
+            )
+        _in_flight.add(transaction_id)
+        try:
+            await compensate_transfer(
+                transaction_id, transfer["own_bank_ip"], transfer["other_bank_ip"], attempts=transfer["attempts"] + 1
+            )
+        finally:
+            _in_flight.discard(transaction_id)
+
+
+async def reconcile_forever():
+    interval = float(get_setting("RECONCILE_INTERVAL"))
+    while True:
+        try:
+            await reconcile()
+        except Exception as error:
+            log.error(f"Reconciling the transfer log failed: {error}")
+        await asyncio.sleep(interval)
+
+
 if __name__ == "__main__":
     validate_envs().data()
     port = int(get_env("BROKER_PORT"))
@@ -0,0 +1,153 @@
+import asyncio
+import unittest
+import uuid
+from decimal import Decimal
+from unittest import mock
+import httpx
+from models.objects import TransactionPostObject
+from utility import batching
+from utility.batching import CommitBatcher
+
+
+def new_transfer(comment: str = "Batch") -> TransactionPostObject:
+    return TransactionPostObject(
+        transaction_id=uuid.uuid4(), origin_id=uuid.uuid4(), destination_id=uuid.uuid4(), amount=Decimal("10"), comment=comment
+    )
+
+
+class FakeBank:
+    """Stands in for `bank_request`, answering every batch with `answer(items)` and keeping the batches it got"""
+
+    def __init__(self, answer=None) -> None:
+        self.batches = []
+        self.answer = answer or (lambda items: httpx.Response(200, json={"ok": [
+            {"transaction_id": item["transaction_id"], "ok": "Transaction saved"} for item in items
+        ]}))
+
+    async def __call__(self, method, url, operation, json, headers):
+        self.batches.append(json)
+        return self.answer(json)
+
+
+class CommitBatcherTests(unittest.IsolatedAsyncioTestCase):
+    def patch_bank(self, bank):
+        patcher = mock.patch.object(batching, "bank_request", bank)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return bank
+
+    async def test_each_caller_gets_its_own_result(self):
+        transfers = [new_transfer() for _ in range(3)]
+        self.patch_bank(FakeBank(lambda items: httpx.Response(200, json={"ok": [
+            {"transaction_id": item["transaction_id"], "ok": item["comment"]} for item in reversed(items)
+        ]})))
+        for index, transfer in enumerate(transfers):
+            transfer.comment = f"Transfer {index}"
+
+        batcher = CommitBatcher("10.0.0.1", max_size=3, linger=10)
+        results = await asyncio.gather(*(batcher.submit(transfer) for transfer in transfers))
+        self.assertEqual(
+            results,
+            [{"ok": {"transaction_id": str(transfer.transaction_id), "ok": transfer.comment}} for transfer in transfers],
+        )
+
+    async def test_flushes_on_size(self):
+        bank = self.patch_bank(FakeBank())
+        batcher = CommitBatcher("10.0.0.1", max_size=2, linger=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(*(batcher.submit(new_transfer()) for _ in range(4))), timeout=1
+        )
+        self.assertEqual([len(batch) for batch in bank.batches], [2, 2])
+        self.assertTrue(all("ok" in result for result in results))
+        self.assertEqual(batcher.metrics()["batch_sizes"], {2: 2})
+
+    async def test_flushes_on_linger(self):
+        bank = self.patch_bank(FakeBank())
+        batcher = CommitBatcher("10.0.0.1", max_size=100, linger=0.01)
+        first = asyncio.ensure_future(batcher.submit(new_transfer()))
+        second = asyncio.ensure_future(batcher.submit(new_transfer()))
+        await asyncio.sleep(0)
+        self.assertEqual(bank.batches, [])
+
+        await asyncio.wait_for(asyncio.gather(first, second), timeout=1)
+        self.assertEqual([len(batch) for batch in bank.batches], [2])
+
+    async def test_cancelled_caller_is_left_out(self):
+        bank = self.patch_bank(FakeBank())
+        batcher = CommitBatcher("10.0.0.1", max_size=100, linger=0.01)
+        kept, cancelled = new_transfer(), new_transfer()
+        waiting = asyncio.ensure_future(batcher.submit(kept))
+        gave_up = asyncio.ensure_future(batcher.submit(cancelled))
+        await asyncio.sleep(0)
+        # Like a caller cancelled by its deadline before the batch went out
+        gave_up.cancel()
+
+        self.assertIn("ok", await asyncio.wait_for(waiting, timeout=1))
+        self.assertEqual([[item["transaction_id"] for item in batch] for batch in bank.batches], [[str(kept.transaction_id)]])
+
+    async def test_transfer_missing_from_reply(self):
+        transfers = [new_transfer() for _ in range(2)]
+        self.patch_bank(FakeBank(lambda items: httpx.Response(200, json={"ok": [
+            {"transaction_id": items[0]["transaction_id"], "ok": "Transaction saved"}
+        ]})))
+        batcher = CommitBatcher("10.0.0.1", max_size=2, linger=10)
+        saved, missing = await asyncio.gather(*(batcher.submit(transfer) for transfer in transfers))
+        self.assertIn("ok", saved)
+        # Not final, the transfer is sent again
+        self.assertEqual(missing, {"error": "Transfer missing from the reply of the bank"})
+
+    async def test_refused_item_is_final(self):
+        transfers = [new_transfer() for _ in range(2)]
+        refusal = {"transaction_id": str(transfers[1].transaction_id), "error": "ValidationError", "detail": "Invalid origin"}
+        self.patch_bank(FakeBank(lambda items: httpx.Response(200, json={"ok": [
+            {"transaction_id": items[0]["transaction_id"], "ok": "Transaction saved"}, refusal
+        ]})))
+        batcher = CommitBatcher("10.0.0.1", max_size=2, linger=10)
+        saved, refused = await asyncio.gather(*(batcher.submit(transfer) for transfer in transfers))
+        self.assertIn("ok", saved)
+        self.assertEqual(refused, {"error": refusal, "final": True})
+
+    async def test_bank_not_responding(self):
+        async def bank_request(*args, **kwargs):
+            raise httpx.ConnectError("refused")
+
+        self.patch_bank(bank_request)
+        batcher = CommitBatcher("10.0.0.1", max_size=2, linger=10)
+        results = await asyncio.gather(*(batcher.submit(new_transfer()) for _ in range(2)))
+        self.assertEqual(results, [{"error": "Bank on ip: '10.0.0.1' did not respond."}] * 2)
+
+    async def test_conflict_commits_transfers_one_by_one(self):
+        bank = self.patch_bank(FakeBank(lambda items: httpx.Response(409, json={"error": "IntegrityError"})))
+        transfers = [new_transfer() for _ in range(3)]
+        # Sent on its own, the transfer saved by the other request is answered as a replay like the rest
+        create_transfer = mock.AsyncMock(side_effect=lambda transfer_obj, bank_ip: {"ok": str(transfer_obj.transaction_id)})
+
+        batcher = CommitBatcher("10.0.0.1", max_size=3, linger=10)
+        with mock.patch.object(batching, "create_transfer", create_transfer):
+            results = await asyncio.gather(*(batcher.submit(transfer) for transfer in transfers))
+
+        self.assertEqual(len(bank.batches), 1)
+        self.assertEqual(results, [{"ok": str(transfer.transaction_id)} for transfer in transfers])
+        self.assertEqual(
+            sorted(str(call.kwargs["transfer_obj"].transaction_id) for call in create_transfer.await_args_list),
+            sorted(str(transfer.transaction_id) for transfer in transfers),
+        )
+
+    async def test_conflict_fails_only_the_transfers_that_fail(self):
+        self.patch_bank(FakeBank(lambda items: httpx.Response(409, json={"error": "IntegrityError"})))
+        transfers = [new_transfer() for _ in range(3)]
+
+        async def create_transfer(transfer_obj, bank_ip):
+            if transfer_obj is transfers[1]:
+                raise Exception("connection reset")
+            return {"ok": "Transaction saved"}
+
+        batcher = CommitBatcher("10.0.0.1", max_size=3, linger=10)
+        with mock.patch.object(batching, "create_transfer", create_transfer):
+            results = await asyncio.gather(*(batcher.submit(transfer) for transfer in transfers))
+        self.assertEqual([result.get("ok") for result in results], ["Transaction saved", None, "Transaction saved"])
+        self.assertIn("did not respond", results[1]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import asyncio
+import unittest
+from fastapi import HTTPException
+from utility.functions import run_concurrently, with_deadline
+
+
+class RunConcurrentlyTests(unittest.IsolatedAsyncioTestCase):
+    async def test_results_in_order(self):
+        async def answer(value, delay):
+            await asyncio.sleep(delay)
+            return value
+
+        self.assertEqual(await run_concurrently(answer("own", 0.02), answer("other", 0)), ["own", "other"])
+
+    async def test_first_failure_cancels_sibling(self):
+        sibling_cancelled = asyncio.Event()
+
+        async def slow_bank():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                sibling_cancelled.set()
+                raise
+
+        async def failing_bank():
+            await asyncio.sleep(0)
+            raise HTTPException(status_code=503, detail="Bank on ip: '10.0.0.2' did not respond.")
+
+        with self.assertRaises(HTTPException):
+            await asyncio.wait_for(run_concurrently(slow_bank(), failing_bank()), timeout=1)
+        # Cancelled and awaited before the failure is raised
+        self.assertTrue(sibling_cancelled.is_set())
+
+
+class WithDeadlineTests(unittest.IsolatedAsyncioTestCase):
+    async def test_answer_within_deadline(self):
+        async def bank():
+            return "ok"
+
+        self.assertEqual(await with_deadline(bank(), deadline=1, bank_ip="10.0.0.1"), "ok")
+
+    async def test_deadline_passed(self):
+        with self.assertRaises(HTTPException) as caught:
+            await with_deadline(asyncio.sleep(10), deadline=0.01, bank_ip="10.0.0.1")
+        self.assertEqual(caught.exception.status_code, 503)
+        self.assertEqual(caught.exception.detail, "Bank on ip: '10.0.0.1' did not respond within 0.01 seconds.")
+
+
+if __name__ == "__main__":
+    unittest.main()
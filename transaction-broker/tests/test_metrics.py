@@ -0,0 +1,65 @@
+import unittest
+from utility.metrics import Counter, Gauge, Histogram, Registry
+
+
+class RenderTests(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter("broker_retries_total", "Bank calls retried", ("policy", "bank"))
+        counter.inc(policy="commit", bank="10.0.0.2")
+        counter.inc(2, policy="commit", bank="10.0.0.1")
+        counter.inc(policy="commit", bank="10.0.0.2")
+        self.assertEqual(counter.value(policy="commit", bank="10.0.0.2"), 2)
+        self.assertEqual(counter.render(), "\n".join([
+            "# HELP broker_retries_total Bank calls retried",
+            "# TYPE broker_retries_total counter",
+            'broker_retries_total{policy="commit",bank="10.0.0.1"} 2',
+            'broker_retries_total{policy="commit",bank="10.0.0.2"} 2',
+        ]))
+
+    def test_wrong_labels(self):
+        counter = Counter("broker_retries_total", "Bank calls retried", ("policy",))
+        with self.assertRaises(ValueError):
+            counter.inc(bank="10.0.0.1")
+
+    def test_label_values_escaped(self):
+        counter = Counter("errors_total", "Errors", ("detail",))
+        counter.inc(detail='said "no"\n')
+        self.assertEqual(counter.samples(), ['errors_total{detail="said \\"no\\"\\n"} 1'])
+
+    def test_histogram(self):
+        histogram = Histogram("broker_bank_call_duration_seconds", "Latency", ("bank",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(value, bank="10.0.0.1")
+        self.assertEqual(histogram.count(bank="10.0.0.1"), 4)
+        # Buckets are cumulative and end with +Inf
+        self.assertEqual(histogram.samples(), [
+            'broker_bank_call_duration_seconds_bucket{bank="10.0.0.1",le="0.1"} 1',
+            'broker_bank_call_duration_seconds_bucket{bank="10.0.0.1",le="1.0"} 3',
+            'broker_bank_call_duration_seconds_bucket{bank="10.0.0.1",le="+Inf"} 4',
+            'broker_bank_call_duration_seconds_sum{bank="10.0.0.1"} 4.05',
+            'broker_bank_call_duration_seconds_count{bank="10.0.0.1"} 4',
+        ])
+
+    def test_unlabelled_gauge_function(self):
+        gauge = Gauge("broker_transfers_in_flight", "In flight", function=lambda: 3)
+        self.assertEqual(gauge.samples(), ["broker_transfers_in_flight 3"])
+
+    def test_registry(self):
+        registry = Registry()
+        counter = registry.register(Counter("a_total", "A"))
+        registry.register(Gauge("b", "B", ("bank",), function=lambda: {("10.0.0.1",): 1}))
+        counter.inc()
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP a_total A",
+            "# TYPE a_total counter",
+            "a_total 1",
+            "# HELP b B",
+            "# TYPE b gauge",
+            'b{bank="10.0.0.1"} 1',
+        ]) + "\n")
+        with self.assertRaises(ValueError):
+            registry.register(Counter("a_total", "A again"))
+
+
+if __name__ == "__main__":
+    unittest.main()
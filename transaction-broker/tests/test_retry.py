@@ -0,0 +1,169 @@
+import unittest
+from unittest import mock
+import httpx
+from utility import retry
+from utility.functions import bank_result
+from utility.retry import CircuitBreaker, RetryPolicy
+
+
+def calls_returning(*results):
+    """A bank call returning `results` one after the other, the number of calls is kept in `calls.count`"""
+    results = list(results)
+
+    async def calls():
+        calls.count += 1
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    calls.count = 0
+    return calls
+
+
+class CircuitBreakerTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(retry.time, "monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker("10.0.0.1", failure_threshold=3, reset_timeout=10)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.metrics()["times_opened"], 1)
+        self.assertEqual(self.breaker.metrics()["short_circuited"], 1)
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_lets_one_trial_through(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 10
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertTrue(self.breaker.allow())
+        # The next trial waits for another reset_timeout
+        self.assertFalse(self.breaker.allow())
+
+    def test_failed_trial_keeps_circuit_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.now += 9
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.metrics()["times_opened"], 1)
+
+    def test_successful_trial_closes_circuit(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(self.breaker.failures, 0)
+
+
+class RetryPolicyTests(unittest.IsolatedAsyncioTestCase):
+    bank_ip = "10.0.0.2"
+
+    def setUp(self):
+        retry._breakers.clear()
+        self.addCleanup(retry._breakers.clear)
+        self.policy = RetryPolicy("test", attempts=3, base_delay=0, max_delay=0, deadline=10)
+
+    async def test_ok_is_returned_at_once(self):
+        call = calls_returning({"ok": "done"})
+        self.assertEqual(await self.policy.run(self.bank_ip, call), {"ok": "done"})
+        self.assertEqual(call.count, 1)
+        self.assertEqual(self.policy.metrics()["retries"], 0)
+
+    async def test_final_error_is_not_retried(self):
+        refused = {"error": {"error": "ValidationError"}, "final": True}
+        call = calls_returning(refused)
+        self.assertEqual(await self.policy.run(self.bank_ip, call), refused)
+        self.assertEqual(call.count, 1)
+        self.assertEqual(self.policy.metrics()["gave_up"], 0)
+        self.assertEqual(retry.get_breaker(self.bank_ip).failures, 0)
+
+    async def test_refusals_do_not_open_circuit(self):
+        breaker = retry.get_breaker(self.bank_ip)
+        for _ in range(breaker.failure_threshold * 2):
+            await self.policy.run(self.bank_ip, calls_returning({"error": "IntegrityError", "final": True}))
+        self.assertEqual(breaker.state, "closed")
+
+    async def test_failing_bank_is_retried(self):
+        call = calls_returning({"error": "UnknownError"}, Exception("connection reset"), {"ok": "done"})
+        self.assertEqual(await self.policy.run(self.bank_ip, call), {"ok": "done"})
+        self.assertEqual(call.count, 3)
+        self.assertEqual(self.policy.metrics()["retries"], 2)
+        self.assertEqual(retry.get_breaker(self.bank_ip).failures, 0)
+
+    async def test_gives_up_after_attempts(self):
+        call = calls_returning(*[{"error": "UnknownError"}] * 3)
+        self.assertEqual(await self.policy.run(self.bank_ip, call), {"error": "UnknownError"})
+        self.assertEqual(call.count, 3)
+        self.assertEqual(self.policy.metrics()["gave_up"], 1)
+        self.assertEqual(retry.get_breaker(self.bank_ip).failures, 3)
+
+    async def test_gives_up_at_deadline(self):
+        policy = RetryPolicy("test", attempts=5, base_delay=1, max_delay=1, deadline=0.5, jitter=0)
+        call = calls_returning({"error": "UnknownError"})
+        self.assertEqual(await policy.run(self.bank_ip, call), {"error": "UnknownError"})
+        self.assertEqual(call.count, 1)
+        self.assertEqual(policy.metrics()["gave_up"], 1)
+
+    async def test_open_circuit_short_circuits(self):
+        breaker = retry.get_breaker(self.bank_ip)
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        call = calls_returning({"ok": "done"})
+        result = await self.policy.run(self.bank_ip, call)
+        self.assertIn("circuit is open", result["error"])
+        self.assertEqual(call.count, 0)
+        self.assertEqual(self.policy.metrics()["short_circuited"], 1)
+
+    def test_backoff_grows_up_to_max_delay(self):
+        policy = RetryPolicy("test", attempts=5, base_delay=0.5, max_delay=2, deadline=10, jitter=0)
+        self.assertEqual([policy.backoff(attempt) for attempt in range(1, 5)], [0.5, 1, 2, 2])
+
+
+class BankResultTests(unittest.TestCase):
+    def test_refusal_is_final(self):
+        for status in (400, 401, 403, 404, 405, 422):
+            with self.subTest(status=status):
+                response = httpx.Response(status, json={"error": "ValidationError"})
+                self.assertEqual(bank_result(response), {"error": {"error": "ValidationError"}, "final": True})
+
+    def test_conflict_and_overload_are_retried(self):
+        for status in (409, 429):
+            with self.subTest(status=status):
+                response = httpx.Response(status, json={"error": "IntegrityError"})
+                self.assertEqual(bank_result(response), {"error": {"error": "IntegrityError"}})
+
+    def test_server_error_is_retried(self):
+        for status in (500, 502, 503):
+            with self.subTest(status=status):
+                response = httpx.Response(status, json={"error": "UnknownError"})
+                self.assertEqual(bank_result(response), {"error": {"error": "UnknownError"}})
+
+    def test_ok(self):
+        self.assertEqual(bank_result(httpx.Response(201, json={"ok": "done"})), {"ok": {"ok": "done"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+import uuid
+from decimal import Decimal
+from unittest import mock
+import httpx
+from fastapi.testclient import TestClient
+import main
+from models.objects import TransactionPostObject
+from utility import retry
+from utility.saga import COMMITTED, COMPENSATED, COMPENSATING, PENDING, SagaLog
+
+
+def new_transfer() -> TransactionPostObject:
+    return TransactionPostObject(
+        transaction_id=uuid.uuid4(), origin_id=uuid.uuid4(), destination_id=uuid.uuid4(), amount=Decimal("10"), comment="Saga"
+    )
+
+
+def open_saga_log(test: unittest.TestCase) -> SagaLog:
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup(directory.cleanup)
+    saga_log = SagaLog(os.path.join(directory.name, "transfers.sqlite3"))
+    test.addCleanup(saga_log.close)
+    return saga_log
+
+
+def make_stale(saga_log: SagaLog, transaction_id: str, seconds: float = 3600) -> None:
+    # As if the transfer had been left alone for `seconds`
+    saga_log._connection.execute(
+        "UPDATE transfers SET updated_at = updated_at - ? WHERE transaction_id = ?", (seconds, transaction_id)
+    )
+
+
+class SagaLogTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.saga_log = open_saga_log(self)
+
+    async def test_begin_duplicate(self):
+        transfer = new_transfer()
+        await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        with self.assertRaises(sqlite3.IntegrityError):
+            await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+
+        stored = await self.saga_log.get(str(transfer.transaction_id))
+        self.assertEqual(stored["state"], PENDING)
+        self.assertEqual([event["state"] for event in stored["events"]], [PENDING])
+
+    async def test_move(self):
+        transfer = new_transfer()
+        transaction_id = str(transfer.transaction_id)
+        await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        await self.saga_log.move(transaction_id, COMPENSATING, error="Bank on ip: '10.0.0.2' failed", retry_in=60)
+        stored = await self.saga_log.get(transaction_id)
+        self.assertEqual((stored["state"], stored["attempts"]), (COMPENSATING, 1))
+        self.assertEqual(stored["last_error"], "Bank on ip: '10.0.0.2' failed")
+        self.assertGreater(stored["next_attempt_at"], time.time() + 50)
+
+        # Moving on without an error keeps the last one and does not count an attempt
+        await self.saga_log.move(transaction_id, COMPENSATED)
+        stored = await self.saga_log.get(transaction_id)
+        self.assertEqual((stored["state"], stored["attempts"]), (COMPENSATED, 1))
+        self.assertEqual(stored["last_error"], "Bank on ip: '10.0.0.2' failed")
+        self.assertEqual([event["state"] for event in stored["events"]], [PENDING, COMPENSATING, COMPENSATED])
+        self.assertIsNone(await self.saga_log.get(str(uuid.uuid4())))
+
+    async def test_due(self):
+        fresh, stale, committed, waiting, compensating = [new_transfer() for _ in range(5)]
+        for transfer in (fresh, stale, committed, waiting, compensating):
+            await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        await self.saga_log.move(str(committed.transaction_id), COMMITTED)
+        await self.saga_log.move(str(waiting.transaction_id), COMPENSATING, error="Failed", retry_in=60)
+        await self.saga_log.move(str(compensating.transaction_id), COMPENSATING, error="Failed")
+        for transfer in (stale, committed):
+            make_stale(self.saga_log, str(transfer.transaction_id))
+
+        due = await self.saga_log.due(stale_before=time.time() - 60)
+        # Pending only once it went stale, compensating once its next attempt is due, never committed
+        self.assertEqual(
+            sorted(transfer["transaction_id"] for transfer in due),
+            sorted([str(stale.transaction_id), str(compensating.transaction_id)]),
+        )
+
+
+class ReconcileTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        retry._breakers.clear()
+        self.addCleanup(retry._breakers.clear)
+        patcher = mock.patch.object(main, "saga_log", open_saga_log(self), create=True)
+        self.saga_log = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Rollbacks are retried without waiting
+        for name in ("base_delay", "max_delay"):
+            patcher = mock.patch.object(main.rollback_retry, name, 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_stale_pending_is_compensated(self):
+        stale, fresh = new_transfer(), new_transfer()
+        for transfer in (stale, fresh):
+            await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        make_stale(self.saga_log, str(stale.transaction_id))
+
+        delete_transfer = mock.AsyncMock(return_value={"ok": {"ok": "Transaction has been deleted"}})
+        with mock.patch.object(main, "delete_transfer", delete_transfer):
+            await main.reconcile()
+
+        self.assertEqual(
+            sorted(call.kwargs["bank_ip"] for call in delete_transfer.await_args_list), ["10.0.0.1", "10.0.0.2"]
+        )
+        self.assertEqual({call.args[0] for call in delete_transfer.await_args_list}, {str(stale.transaction_id)})
+        stored = await self.saga_log.get(str(stale.transaction_id))
+        self.assertEqual([event["state"] for event in stored["events"]], [PENDING, COMPENSATING, COMPENSATED])
+        self.assertEqual((await self.saga_log.get(str(fresh.transaction_id)))["state"], PENDING)
+
+    async def test_failed_compensation_is_deferred(self):
+        transfer = new_transfer()
+        transaction_id = str(transfer.transaction_id)
+        await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        make_stale(self.saga_log, transaction_id)
+
+        async def delete_transfer(transaction_id, bank_ip):
+            if bank_ip == "10.0.0.2":
+                return {"error": {"error": "UnknownError"}}
+            return {"ok": {"ok": "Transaction has been deleted"}}
+
+        with mock.patch.object(main, "delete_transfer", delete_transfer):
+            await main.reconcile()
+        stored = await self.saga_log.get(transaction_id)
+        self.assertEqual(stored["state"], COMPENSATING)
+        self.assertGreater(stored["next_attempt_at"], time.time())
+        # Not due again until its delay has passed
+        self.assertEqual(await self.saga_log.due(stale_before=time.time()), [])
+
+    async def test_in_flight_transfer_is_left_alone(self):
+        transfer = new_transfer()
+        transaction_id = str(transfer.transaction_id)
+        await self.saga_log.begin(transfer, "10.0.0.1", "10.0.0.2")
+        make_stale(self.saga_log, transaction_id)
+
+        delete_transfer = mock.AsyncMock()
+        with mock.patch.object(main, "delete_transfer", delete_transfer), mock.patch.object(main, "_in_flight", {transaction_id}):
+            await main.reconcile()
+        delete_transfer.assert_not_awaited()
+        self.assertEqual((await self.saga_log.get(transaction_id))["state"], PENDING)
+
+
+class TransactionEndpointTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(main, "saga_log", open_saga_log(self), create=True)
+        self.saga_log = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Not entered as a context manager, so the reconciler and the lag monitor are not started
+        self.client = TestClient(main.server)
+
+    def payload(self, transaction_id: str) -> dict:
+        return {
+            "transaction_id": transaction_id,
+            "own_bank_ip": "10.0.0.1",
+            "other_bank_ip": "10.0.0.2",
+            "own_account_id": str(uuid.uuid4()),
+            "other_account_id": str(uuid.uuid4()),
+            "amount": "10",
+            "comment": "Saga",
+        }
+
+    def test_accepted_then_duplicate(self):
+        transaction_id = str(uuid.uuid4())
+        balance = mock.AsyncMock(return_value=httpx.Response(200, json={"ok": 100}))
+        commit_transfer = mock.AsyncMock()
+        with mock.patch.object(main, "get_account_balance", balance), mock.patch.object(main, "commit_transfer", commit_transfer):
+            response = self.client.post("/transaction", json=self.payload(transaction_id))
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.json()["status_url"], f"/transaction/{transaction_id}")
+            commit_transfer.assert_awaited_once()
+
+            response = self.client.post("/transaction", json=self.payload(transaction_id))
+            self.assertEqual(response.status_code, 409)
+            commit_transfer.assert_awaited_once()
+
+        response = self.client.get(f"/transaction/{transaction_id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["state"], PENDING)
+        self.assertEqual(response.json()["transfer"]["transaction_id"], transaction_id)
+
+    def test_unknown_transaction(self):
+        response = self.client.get(f"/transaction/{uuid.uuid4()}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_insufficient_funds_is_not_logged(self):
+        transaction_id = str(uuid.uuid4())
+        balance = mock.AsyncMock(return_value=httpx.Response(200, json={"ok": 5}))
+        with mock.patch.object(main, "get_account_balance", balance):
+            response = self.client.post("/transaction", json=self.payload(transaction_id))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(f"/transaction/{transaction_id}").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
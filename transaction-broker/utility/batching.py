@@ -0,0 +1,142 @@
+import asyncio
+import json
+from models.objects import TransactionPostObject
+from config.secrets import get_setting
+from utility.functions import ObjectDecoder, bank_request, bank_result, create_transfer
+from utility.logger import log
+from utility.metrics import BATCH_SIZE
+
+
+class CommitBatcher:
+    """Queues the transfers going to a single bank and commits them together
+
+    A batch is sent once it holds `max_size` transfers, or `linger` seconds after its first transfer
+    was queued, whichever comes first. Every caller waits on its own future, resolved with the result
+    the bank gave for its transfer in the shape `create_transfer` returns: {"ok": ...} or {"error": ...}.
+    """
+
+    def __init__(self, bank_ip: str, max_size: int, linger: float) -> None:
+        self.bank_ip = bank_ip
+        self.max_size = max_size
+        self.linger = linger
+        self._queue: list[tuple[TransactionPostObject, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._sending: set[asyncio.Task] = set()
+        # Number of batches sent, keyed by how many transfers they held
+        self.batch_sizes: dict[int, int] = {}
+
+    async def submit(self, transfer: TransactionPostObject) -> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((transfer, future))
+        if len(self._queue) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Callers that gave up (cancelled by a deadline) are left out
+        batch = [(transfer, future) for transfer, future in self._queue if not future.done()]
+        self._queue = []
+        if not batch:
+            return
+        task = asyncio.create_task(self._send(batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: list[tuple[TransactionPostObject, asyncio.Future]]) -> None:
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        BATCH_SIZE.observe(len(batch), bank=self.bank_ip)
+        try:
+            response = await bank_request(
+                "POST",
+                url="/api/transfer-funds/batch/",
+                operation="commit_batch",
+                json=[json.loads(json.dumps(transfer.__dict__, cls=ObjectDecoder)) for transfer, _ in batch],
+                headers={"Host": f"{self.bank_ip}.nginx", "Content-Type": "application/json"},
+            )
+            reply = response.json()
+        except Exception as err:
+            log.error(f"Batch of {len(batch)} transfers to bank '{self.bank_ip}' failed: {err}")
+            self._resolve_all(batch, {"error": f"Bank on ip: '{self.bank_ip}' did not respond."})
+            return
+
+        if response.status_code == 409:
+            # Another request saved one of these transfers meanwhile and nothing of the batch was saved,
+            # each transfer is committed on its own so the others are not failed along with it
+            log.warning(f"Batch of {len(batch)} transfers to bank '{self.bank_ip}' conflicted, committing them one by one")
+            await asyncio.gather(*(self._send_one(transfer, future) for transfer, future in batch))
+            return
+        if response.is_error:
+            self._resolve_all(batch, bank_result(response))
+            return
+
+        results = {result.get("transaction_id"): result for result in reply["ok"]}
+        for transfer, future in batch:
+            if future.done():
+                continue
+            result = results.get(str(transfer.transaction_id))
+            if result is None:
+                future.set_result({"error": "Transfer missing from the reply of the bank"})
+            elif "error" in result:
+                # Refused by the bank like a 4xx of a single transfer
+                future.set_result({"error": result, "final": True})
+            else:
+                future.set_result({"ok": result})
+
+    async def _send_one(self, transfer: TransactionPostObject, future: asyncio.Future) -> None:
+        if future.done():
+            return
+        try:
+            result = await create_transfer(transfer_obj=transfer, bank_ip=self.bank_ip)
+        except Exception as err:
+            log.error(f"Transfer '{transfer.transaction_id}' to bank '{self.bank_ip}' failed: {err}")
+            result = {"error": f"Bank on ip: '{self.bank_ip}' did not respond."}
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _resolve_all(batch: list[tuple[TransactionPostObject, asyncio.Future]], result: dict) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        transfers = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "batches": batches,
+            "transfers": transfers,
+            "mean_batch_size": round(transfers / batches, 2) if batches else 0,
+            "max_batch_size": max(self.batch_sizes, default=0),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+
+_batchers: dict[str, CommitBatcher] = {}
+
+
+def get_batcher(bank_ip: str) -> CommitBatcher:
+    bank_ip = str(bank_ip)
+    if bank_ip not in _batchers:
+        _batchers[bank_ip] = CommitBatcher(
+            bank_ip,
+            max_size=int(get_setting("COMMIT_BATCH_SIZE")),
+            linger=float(get_setting("COMMIT_BATCH_LINGER_MS")) / 1000,
+        )
+    return _batchers[bank_ip]
+
+
+async def submit_transfer(transfer: TransactionPostObject, bank_ip: str) -> dict:
+    """Commits `transfer` on the bank, batched with other transfers unless COMMIT_BATCH_SIZE is 1"""
+    if int(get_setting("COMMIT_BATCH_SIZE")) <= 1:
+        return await create_transfer(transfer_obj=transfer, bank_ip=bank_ip)
+    return await get_batcher(bank_ip).submit(transfer)
+
+
+def batch_metrics() -> dict:
+    return {bank_ip: batcher.metrics() for bank_ip, batcher in _batchers.items()}
@@ -1,27 +1,128 @@
+import asyncio
+import time
 import uuid
 import json
 import decimal
 from ipaddress import IPv4Address
 from uuid import UUID
+from typing import Awaitable
 from fastapi import HTTPException
 from models.objects import TransactionPostObject
-import requests
+import httpx
+from config.secrets import get_setting
 from utility.logger import log
+from utility.metrics import BANK_CALL_DURATION, HTTP_POOL_WAIT, since
+from utility.retry import get_breaker
 
+# Shared client, every call to a bank goes through the same keep-alive connection pool to the gateway
+_client: httpx.AsyncClient | None = None
+# Calls waiting for a free connection queue here rather than in the pool of the client,
+# which rescans its whole queue on every change and slows to a crawl with thousands of waiting calls
+_slots: asyncio.Semaphore | None = None
 
-def get_account_balance(bank_ip: str, account_id: UUID):
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client, _slots
+    if _client is None:
+        _slots = asyncio.Semaphore(int(get_setting("HTTP_POOL_SIZE")))
+        _client = httpx.AsyncClient(
+            base_url=get_setting("BANK_GATEWAY_URL"),
+            limits=httpx.Limits(
+                max_connections=int(get_setting("HTTP_POOL_SIZE")),
+                max_keepalive_connections=int(get_setting("HTTP_KEEPALIVE_SIZE")),
+            ),
+            timeout=httpx.Timeout(
+                float(get_setting("HTTP_TIMEOUT")),
+                connect=float(get_setting("HTTP_CONNECT_TIMEOUT")),
+            ),
+        )
+    return _client
+
+
+async def bank_request(method: str, url: str, operation: str, **kwargs) -> httpx.Response:
+    """Sends a request to a bank through the shared client, at most HTTP_POOL_SIZE at a time
+
+    The call is timed per bank (taken from the Host header) and `operation`, calls that got no answer
+    are counted with the outcome "failed".
+    """
+    client = get_http_client()
+    bank_ip = kwargs.get("headers", {}).get("Host", "").removesuffix(".nginx")
+    queued = time.monotonic()
+    async with _slots:
+        HTTP_POOL_WAIT.observe(since(queued))
+        started = time.monotonic()
+        outcome = "failed"
+        try:
+            response = await client.request(method, url, **kwargs)
+            outcome = "error" if response.is_error else "ok"
+            return response
+        finally:
+            BANK_CALL_DURATION.observe(since(started), bank=bank_ip, operation=operation, outcome=outcome)
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+class BankCallError(Exception):
+    """Raised when a bank answered a call with an error, after all retries"""
+
+    def __init__(self, bank_ip: str, result: dict) -> None:
+        super().__init__(f"Bank on ip: '{bank_ip}' failed: {result}")
+        self.bank_ip = bank_ip
+        self.result = result
+
+
+async def with_deadline(call: Awaitable, deadline: float, bank_ip: str):
+    """Awaits `call`, giving up with a 503 when the bank has not answered within `deadline` seconds"""
     try:
-        response = requests.get(
-            url=f"http://nginx/api/balance/{account_id}",
+        return await asyncio.wait_for(call, timeout=deadline)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503, detail=f"Bank on ip: '{bank_ip}' did not respond within {deadline} seconds."
+        )
+
+
+async def run_concurrently(*calls: Awaitable) -> list:
+    """Runs all `calls` at the same time and returns their results in order
+
+    As soon as one of them raises, the ones still running are cancelled and the exception is raised again
+    """
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def get_account_balance(bank_ip: str, account_id: UUID) -> httpx.Response:
+    breaker = get_breaker(bank_ip)
+    if not breaker.allow():
+        raise HTTPException(
+            status_code=503, detail=f"Bank on host: '{bank_ip}.nginx' is unavailable, circuit is open."
+        )
+    try:
+        response = await bank_request(
+            "GET",
+            url=f"/api/balance/{account_id}/",
+            operation="balance",
             timeout=1,
             headers={'Host': f"{bank_ip}.nginx", 'Content-Type': 'application/json'},
         )
         log.info(f"Response was: {response}")
     except Exception as error:
-        log.error("Error has occurred while trying to get balance!: ", error)
+        log.error(f"Error has occurred while trying to get balance!: {error}")
+        breaker.record_failure()
         raise HTTPException(
             status_code=503, detail=f"Bank on host: '{bank_ip}.nginx' did not respond."
         )
+    breaker.record_success()
     return response
 
 
@@ -38,50 +139,55 @@ class ObjectDecoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, o)
 
 
-def create_transfer(transfer_obj: TransactionPostObject, bank_ip: IPv4Address | str):
+# Client errors that may pass when the call is sent again: a conflict with a transfer another request is
+# saving (the batch endpoint saves nothing then), or a bank shedding load
+RETRYABLE_CLIENT_ERRORS = frozenset({409, 429})
+
+
+def bank_result(response: httpx.Response) -> dict:
+    """The answer of a bank as {"ok": ...} or {"error": ...}
+
+    Any other 4xx is the bank refusing the call (bad request, unknown account), it would refuse it again:
+    the error is marked "final" so `RetryPolicy` returns it at once and does not count it against the
+    circuit of the bank. A 5xx is a failing bank and may be retried.
+    """
+    if not response.is_error:
+        return {"ok": response.json()}
+    if response.is_client_error and response.status_code not in RETRYABLE_CLIENT_ERRORS:
+        return {"error": response.json(), "final": True}
+    return {"error": response.json()}
+
+
+async def create_transfer(transfer_obj: TransactionPostObject, bank_ip: IPv4Address | str):
     try:
-        response = requests.post(
-            url=f"http://nginx/api/transfer-funds/",
+        response = await bank_request(
+            "POST",
+            url=f"/api/transfer-funds/",
+            operation="commit",
             json=json.dumps(transfer_obj.__dict__, cls=ObjectDecoder),
             headers={"Host": f"{bank_ip}.nginx", "Content-Type": "application/json"}
         )
-        log.debug("create_transfer response as JSON: ", response.json())
+        log.debug(f"create_transfer response as JSON: {response.json()}")
     except Exception as err:
-        log.error("create_transfer error: ", err)
+        log.error(f"create_transfer error: {err}")
         raise HTTPException(
             status_code=503, detail=f"Bank on ip: '{bank_ip}' did not respond."
         )
-    return {"ok": response.json()}
+    return bank_result(response)
 
 
-def delete_transfer(transaction_id: UUID, bank_ip: IPv4Address | str):
+async def delete_transfer(transaction_id: UUID, bank_ip: IPv4Address | str):
     try:
-        response = requests.delete(
-            url=f"http://nginx/api/transaction/{transaction_id}",
+        response = await bank_request(
+            "DELETE",
+            url=f"/api/transaction/{transaction_id}/",
+            operation="delete",
             headers={"Host": f"{bank_ip}.nginx", "Content-Type": "application/json"}
         )
-        log.debug("delete_transfer response as JSON: ", response.json())
+        log.debug(f"delete_transfer response as JSON: {response.json()}")
     except Exception as err:
         print("delete_transfer error: ", err)
         raise HTTPException(
             status_code=503, detail=f"Bank on ip: '{bank_ip}' did not respond."
         )
-    return {"ok": response.json()}
-
-
-def function_with_retries(retries: int, delay: int, function):
-    import time
-
-    try:
-        result = function()
-    except Exception as error:
-        print(f"Function {function.__name__} hit an exception! {error}")
-        result = {"error": f"Function hit an exception! {error}"}
-
-    if retries > 0:
-        if result.get("ok"):
-            return result
-        if result.get("error"):
-            time.sleep(delay)
-            return function_with_retries(retries - 1, delay,  function)
-    return result
+    return bank_result(response)
@@ -0,0 +1,226 @@
+import asyncio
+import time
+from typing import Callable
+from config.secrets import get_setting
+from utility.logger import log
+
+# Seconds, from a fast local bank call up to the commit deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of the metrics in the registry, one value per combination of label values
+
+    Metrics are only touched from the event loop, so they need no locking.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric '{self.name}' takes the labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from `function` every time the metrics are rendered
+
+    `function` returns the value of an unlabelled gauge, or a `{label values: value}` dict for a labelled one.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), function: Callable = None) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[tuple, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> list[str]:
+        values = self._values
+        if self.function is not None:
+            result = self.function()
+            values = result if self.label_names else {(): result}
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per label values: the count of every bucket (not cumulative), the sum and the count of observations
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts, _, _ = entry = self._values[key]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_label = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+TRANSFER_DURATION = registry.register(Histogram(
+    "broker_transfer_duration_seconds",
+    "Time from receiving a transfer until it is committed on both banks or compensated",
+    ("outcome",),
+))
+BANK_CALL_DURATION = registry.register(Histogram(
+    "broker_bank_call_duration_seconds",
+    "Latency of the calls to the banks, once a connection is free",
+    ("bank", "operation", "outcome"),
+))
+HTTP_POOL_WAIT = registry.register(Histogram(
+    "broker_http_pool_wait_seconds",
+    "Time bank calls waited for a free connection of the shared client",
+    buckets=LAG_BUCKETS,
+))
+RETRIES = registry.register(Counter(
+    "broker_retries_total",
+    "Bank calls retried by a retry policy",
+    ("policy", "bank"),
+))
+RETRIES_EXHAUSTED = registry.register(Counter(
+    "broker_retries_exhausted_total",
+    "Bank calls a retry policy gave up on",
+    ("policy", "bank"),
+))
+SHORT_CIRCUITED = registry.register(Counter(
+    "broker_short_circuited_total",
+    "Bank calls skipped because the circuit of the bank was open",
+    ("policy", "bank"),
+))
+ROLLBACKS = registry.register(Counter(
+    "broker_rollbacks_total",
+    "Compensations of failed transfers, 'deferred' ones are retried by the reconciler",
+    ("outcome",),
+))
+IN_FLIGHT = registry.register(Gauge(
+    "broker_transfers_in_flight",
+    "Transfers being committed or compensated right now",
+    function=lambda: 0,
+))
+BATCH_SIZE = registry.register(Histogram(
+    "broker_commit_batch_size",
+    "Transfers per batched commit sent to a bank",
+    ("bank",),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+))
+EVENT_LOOP_LAG = registry.register(Histogram(
+    "broker_event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task, high values mean the loop is blocked or saturated",
+    buckets=LAG_BUCKETS,
+))
+
+
+async def monitor_event_loop_lag():
+    """Sleeps EVENT_LOOP_LAG_INTERVAL seconds at a time and records how much later than asked it woke up"""
+    interval = float(get_setting("EVENT_LOOP_LAG_INTERVAL"))
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        if lag > 1:
+            log.warn(f"Event loop was blocked for {lag:.3f} seconds")
+
+
+def since(started: float) -> float:
+    return time.monotonic() - started
@@ -0,0 +1,178 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable
+from config.secrets import get_setting
+from utility.logger import log
+from utility.metrics import RETRIES, RETRIES_EXHAUSTED, SHORT_CIRCUITED, Gauge, registry
+
+
+class CircuitBreaker:
+    """Keeps track of consecutive failures of a single bank
+
+    After `failure_threshold` failures in a row the circuit opens and calls to the bank fail fast.
+    Once `reset_timeout` seconds have passed a single trial call is let through (half open),
+    its outcome closes the circuit again or keeps it open for another `reset_timeout`.
+    """
+
+    def __init__(self, bank_ip: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.bank_ip = bank_ip
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open":
+            # Let this one call through, the next trial is only allowed after another reset_timeout
+            self.opened_at = time.monotonic()
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            log.info(f"Circuit for bank '{self.bank_ip}' closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None:
+            # The trial call failed, stay open
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.failure_threshold:
+            log.error(f"Circuit for bank '{self.bank_ip}' opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+
+    def metrics(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(bank_ip: str) -> CircuitBreaker:
+    bank_ip = str(bank_ip)
+    if bank_ip not in _breakers:
+        _breakers[bank_ip] = CircuitBreaker(
+            bank_ip,
+            failure_threshold=int(get_setting("BREAKER_FAILURE_THRESHOLD")),
+            reset_timeout=float(get_setting("BREAKER_RESET_TIMEOUT")),
+        )
+    return _breakers[bank_ip]
+
+
+BREAKER_OPEN = registry.register(Gauge(
+    "broker_circuit_open",
+    "1 while the circuit of a bank is open or half open, 0 while it is closed",
+    ("bank",),
+    function=lambda: {(bank_ip,): int(breaker.state != "closed") for bank_ip, breaker in _breakers.items()},
+))
+
+
+class RetryPolicy:
+    """Retries a call to a bank with exponential backoff and jitter, without blocking the event loop
+
+    The call is attempted at most `attempts` times, and never retried once the next wait would go past
+    `deadline` seconds since the first attempt. Calls are skipped when the circuit of the bank is open.
+    The call must return a dict holding either "ok" or "error", like the functions in `utility.functions`.
+    Exceptions, timeouts and 5xx errors are retried and count as failures of the bank. Errors marked
+    "final" (the bank refused the call with a 4xx) are returned at once: the bank answered, so they count
+    as a success for its circuit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attempts: int,
+        base_delay: float,
+        max_delay: float,
+        deadline: float,
+        jitter: float = 0.5,
+    ) -> None:
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.calls = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.short_circuited = 0
+        self.time_waiting = 0.0
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait after the `attempt`th failed attempt"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    async def run(self, bank_ip: str, function: Callable[[], Awaitable[dict]]) -> dict:
+        breaker = get_breaker(bank_ip)
+        self.calls += 1
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.short_circuited += 1
+                SHORT_CIRCUITED.inc(policy=self.name, bank=bank_ip)
+                return {"error": f"Bank on ip: '{bank_ip}' is unavailable, circuit is open."}
+
+            attempt += 1
+            try:
+                result = await function()
+            except Exception as error:
+                log.error(f"{self.name} call to bank '{bank_ip}' hit an exception! {error}")
+                result = {"error": f"Function hit an exception! {error}"}
+
+            if not result.get("error") or result.get("final"):
+                breaker.record_success()
+                return result
+            breaker.record_failure()
+
+            delay = self.backoff(attempt)
+            if attempt >= self.attempts or time.monotonic() - started + delay > self.deadline:
+                self.gave_up += 1
+                RETRIES_EXHAUSTED.inc(policy=self.name, bank=bank_ip)
+                return result
+
+            self.retries += 1
+            RETRIES.inc(policy=self.name, bank=bank_ip)
+            self.time_waiting += delay
+            await asyncio.sleep(delay)
+
+    def metrics(self) -> dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "gave_up": self.gave_up,
+            "short_circuited": self.short_circuited,
+            "seconds_waiting": round(self.time_waiting, 3),
+        }
+
+
+def retry_metrics(*policies: RetryPolicy) -> dict:
+    return {
+        "policies": {policy.name: policy.metrics() for policy in policies},
+        "banks": {bank_ip: breaker.metrics() for bank_ip, breaker in _breakers.items()},
+    }
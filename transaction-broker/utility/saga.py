@@ -0,0 +1,135 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from models.objects import TransactionPostObject
+from utility.logger import log
+
+# States of a transfer in the log
+PENDING = "pending"  # recorded, commits on the banks may be in flight
+COMMITTED = "committed"  # both banks have the transfer
+COMPENSATING = "compensating"  # a commit failed, the transfer has to be deleted on both banks
+COMPENSATED = "compensated"  # the transfer has been deleted on both banks
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    transaction_id TEXT PRIMARY KEY,
+    own_bank_ip TEXT NOT NULL,
+    other_bank_ip TEXT NOT NULL,
+    transfer TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_unfinished_idx
+    ON transfers (next_attempt_at) WHERE state IN ('pending', 'compensating');
+CREATE TABLE IF NOT EXISTS transfer_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    detail TEXT,
+    at REAL NOT NULL
+);
+"""
+
+
+class SagaLog:
+    """Durable log of the transfers going through the broker, kept in a local SQLite file
+
+    Every change of state is committed before the broker acts on it, so after a crash the reconciler
+    knows which transfers may be left on a single bank. The blocking SQLite calls run in a thread
+    to keep the event loop free.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        self._connection.executescript(_SCHEMA)
+
+    def _write(self, transaction_id: str, state: str, detail: str | None, statement: str, params: tuple):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(statement, params)
+                self._connection.execute(
+                    "INSERT INTO transfer_events (transaction_id, state, detail, at) VALUES (?, ?, ?, ?)",
+                    (transaction_id, state, detail, now),
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _read(self, statement: str, params: tuple) -> list[dict]:
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(statement, params)]
+
+    async def begin(self, transfer: TransactionPostObject, own_bank_ip: str, other_bank_ip: str) -> None:
+        """Records a new transfer as pending, raises sqlite3.IntegrityError if its id is already known"""
+        now = time.time()
+        transaction_id = str(transfer.transaction_id)
+        await asyncio.to_thread(
+            self._write,
+            transaction_id,
+            PENDING,
+            None,
+            "INSERT INTO transfers (transaction_id, own_bank_ip, other_bank_ip, transfer, state, "
+            "next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (transaction_id, own_bank_ip, other_bank_ip, transfer.json(), PENDING, now, now, now),
+        )
+
+    async def move(self, transaction_id: str, state: str, error: str | None = None, retry_in: float = 0) -> None:
+        """Moves a transfer to `state`, counting an attempt and scheduling the next one when `error` is set"""
+        now = time.time()
+        await asyncio.to_thread(
+            self._write,
+            transaction_id,
+            state,
+            error,
+            "UPDATE transfers SET state = ?, last_error = COALESCE(?, last_error), attempts = attempts + ?, next_attempt_at = ?, "
+            "updated_at = ? WHERE transaction_id = ?",
+            (state, error, 1 if error else 0, now + retry_in, now, transaction_id),
+        )
+
+    async def get(self, transaction_id: str) -> dict | None:
+        rows = await asyncio.to_thread(
+            self._read, "SELECT * FROM transfers WHERE transaction_id = ?", (transaction_id,)
+        )
+        if not rows:
+            return None
+        transfer = rows[0]
+        transfer["transfer"] = json.loads(transfer["transfer"])
+        transfer["events"] = await asyncio.to_thread(
+            self._read,
+            "SELECT state, detail, at FROM transfer_events WHERE transaction_id = ? ORDER BY id",
+            (transaction_id,),
+        )
+        return transfer
+
+    async def due(self, stale_before: float, limit: int = 100) -> list[dict]:
+        """Unfinished transfers whose next attempt is due
+
+        Pending transfers are only returned once they have not moved since `stale_before`, as the
+        request that recorded them may still be committing them.
+        """
+        now = time.time()
+        return await asyncio.to_thread(
+            self._read,
+            "SELECT * FROM transfers WHERE (state = 'compensating' AND next_attempt_at <= ?) "
+            "OR (state = 'pending' AND updated_at <= ?) ORDER BY next_attempt_at LIMIT ?",
+            (now, stale_before, limit),
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+        log.info(f"Closed the transfer log '{self.path}'")